@@ -0,0 +1,99 @@
+import sys
+import threading
+import Queue
+
+import numpy
+
+
+class PaddedBatchIterator(object):
+
+    #
+    # Iterator that traverses the data sequentially in slices of size
+    # (batch_size), starting from sample (start). Each step returns the index
+    # of the first sample, the number of valid samples and the batch itself.
+    # If pad is True, the ragged last batch is zero-padded up to (batch_size)
+    # so that it can be fed to models with a fixed minibatch size.
+    #
+
+    def __init__(self, X, batch_size, start=0, pad=True, axes=None):
+        self.X = X
+        self.batch_size = batch_size
+        self.num_samples = X.shape[0]
+        self.pad = pad
+        # Optional transpose applied to every batch, e.g. (1, 2, 3, 0) to go
+        # from bc01 storage to c01b models.
+        self.axes = axes
+
+        # Sample Counter
+        self.sample_count = start
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.sample_count >= self.num_samples:
+            raise StopIteration()
+
+        start = self.sample_count
+        stop = min(start + self.batch_size, self.num_samples)
+        num_valid = stop - start
+
+        batch = numpy.asarray(self.X[start:stop], dtype=numpy.float32)
+        if self.pad and num_valid < self.batch_size:
+            padded_batch = numpy.zeros((self.batch_size,) + batch.shape[1:],
+                                       dtype=numpy.float32)
+            padded_batch[0:num_valid] = batch
+            batch = padded_batch
+
+        if self.axes is not None:
+            batch = batch.transpose(self.axes)
+
+        self.sample_count = stop
+        return start, num_valid, batch
+
+
+class BatchPrefetcher(object):
+
+    #
+    # Wraps a batch iterator and pulls its batches in a background thread,
+    # so that reading (e.g. from a memory-mapped array) the next batch
+    # overlaps with the computation on the current one. An optional func
+    # is applied to every item in the background thread as well.
+    #
+
+    def __init__(self, iterator, func=None, buffer_size=2):
+        self.queue = Queue.Queue(maxsize=buffer_size)
+        self.done = False
+
+        self.thread = threading.Thread(target=self._produce,
+                                       args=(iterator, func))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.done:
+            raise StopIteration()
+
+        has_item, item = self.queue.get()
+        if has_item:
+            return item
+
+        self.done = True
+        if item is not None:
+            # Re-raise the exception from the background thread
+            raise item[0], item[1], item[2]
+        raise StopIteration()
+
+    def _produce(self, iterator, func):
+        try:
+            for item in iterator:
+                if func is not None:
+                    item = func(item)
+                self.queue.put((True, item))
+        except Exception:
+            self.queue.put((False, sys.exc_info()))
+            return
+        self.queue.put((False, None))
@@ -56,8 +56,11 @@ class SupervisedDataLoader(object):
 
 
 class SupervisedDataLoaderCrossVal(object):
-    def __init__(self, dataset_path):
+    def __init__(self, dataset_path, mmap_mode=None):
         self.dataset_path = dataset_path
+        # X.npy is memory-mapped with e.g. mmap_mode='r' instead of read
+        self.mmap_mode = mmap_mode
+        self.arrays = None
 
         # Check if dataset_path exists
         assert os.path.exists(self.dataset_path), \
@@ -67,30 +70,46 @@ class SupervisedDataLoaderCrossVal(object):
         assert mode == 'train' or mode == 'test', \
             'Please enter train or test mode!'
 
-        fold_path = os.path.join(self.dataset_path, 'folds.npy')
-        assert os.path.exists(fold_path), \
-            'There is folds.npy in specified dataset directory.'
-
         supervised_data_container = self._load_with_folds(fold, mode)
 
         return supervised_data_container
 
-    def _load_with_folds(self, fold, mode='train'):
-        X = numpy.load(os.path.join(self.dataset_path, 'X.npy'))
-        y = numpy.load(os.path.join(self.dataset_path, 'y.npy'))
-        folds = numpy.load(os.path.join(self.dataset_path, 'folds.npy'))
+    def load_arrays(self):
+        # X, y and folds, read from disk only on the first call
+        if self.arrays is None:
+            fold_path = os.path.join(self.dataset_path, 'folds.npy')
+            assert os.path.exists(fold_path), \
+                'There is no folds.npy in specified dataset directory.'
+
+            X = numpy.load(os.path.join(self.dataset_path, 'X.npy'),
+                           mmap_mode=self.mmap_mode)
+            y = numpy.load(os.path.join(self.dataset_path, 'y.npy'))
+            folds = numpy.load(fold_path)
+            self.arrays = (X, y, folds)
+        return self.arrays
+
+    def get_fold_indices(self, fold):
+        # Indices of the (train, test) samples of a fold
+        __, __, folds = self.load_arrays()
 
         assert fold <= folds.max(), \
             'Fold number exceeds available number of folds. Please try again.'
 
+        return numpy.flatnonzero(folds != fold), numpy.flatnonzero(
+            folds == fold)
+
+    def _load_with_folds(self, fold, mode='train'):
+        X, y, __ = self.load_arrays()
+        train_indices, test_indices = self.get_fold_indices(fold)
+
         if mode == 'train':
-            mask = (folds != fold)
+            indices = train_indices
         else:
             # mode = 'test'
-            mask = (folds == fold)
+            indices = test_indices
 
-        X = X[mask, :, :, :]
-        y = y[mask]
+        X = X[indices, :, :, :]
+        y = y[indices]
 
         # Create supervised data container and return it
         supervised_data_container = SupervisedDataContainer(X, y)
@@ -0,0 +1,199 @@
+"""
+Streaming extraction of intermediate layer activations to disk.
+"""
+import hashlib
+import os
+
+import numpy
+from numpy.lib.format import open_memmap
+import theano
+
+from anna.layers import layers
+from anna.datasets.streaming import PaddedBatchIterator, BatchPrefetcher
+from anna.util import Preprocessor
+
+
+def get_feature_symbol(layer, pool=None):
+    """
+    Returns a (minibatch, features) symbol for the output of the given layer,
+    computed with dropout switched off.
+
+    pool can be None, 'mean', 'max' or 'l2'. It only applies to 4D outputs,
+    where it reduces every feature map to a single value in the graph.
+    """
+    output = layer.output(dropout_active=False)
+    if len(layer.get_output_shape()) == 4:
+        if layers.batch_axis(layer) == 3:
+            # c01b -> bc01
+            output = output.dimshuffle(3, 0, 1, 2)
+        if pool == 'mean':
+            output = output.mean([2, 3])
+        elif pool == 'max':
+            output = output.max([2, 3])
+        elif pool == 'l2':
+            output = theano.tensor.sqrt((output ** 2).mean([2, 3]))
+        elif pool is not None:
+            raise RuntimeError("Invalid pooling function: '%s'" % pool)
+    return output.flatten(2)
+
+
+def get_feature_dim(layer, pool=None):
+    """
+    Number of features per sample returned by get_feature_symbol.
+    """
+    output_shape = list(layer.get_output_shape())
+    del output_shape[layers.batch_axis(layer)]
+    if len(output_shape) == 3 and pool is not None:
+        return output_shape[0]
+    return int(numpy.prod(output_shape))
+
+
+def get_data_digest(X, num_rows=16):
+    """
+    Digest of the shape and dtype of X and of num_rows evenly spaced
+    samples, cheap enough for memory-mapped datasets that do not fit in
+    memory.
+    """
+    digest = hashlib.md5(str((X.shape, str(X.dtype))))
+    if X.shape[0] > 0:
+        rows = numpy.unique(numpy.linspace(0, X.shape[0] - 1,
+                                           num_rows).astype(int))
+        for row in rows:
+            digest.update(numpy.ascontiguousarray(X[row]).tostring())
+    return digest.hexdigest()
+
+
+class FeatureExtractor(object):
+    """
+    Streams the activations of one or more layers of a model into
+    memory-mapped .npy files, one (num_samples, num_features) array per
+    layer. Extractions that were interrupted are resumed from the last
+    flushed batch, as long as the model parameters, the extraction settings
+    and the data are the same as in the interrupted run.
+    """
+    def __init__(self, model, layer_names, output_path, pool=None,
+                 dtype=numpy.float32, preprocessor_module_list=[],
+                 flush_steps=50):
+        self.model = model
+        self.layer_names = layer_names
+        self.output_path = output_path
+        self.pool = pool
+        self.dtype = numpy.dtype(dtype)
+        self.preprocessor = Preprocessor(preprocessor_module_list)
+        self.flush_steps = flush_steps
+        self.batch_size = model.batch
+        self.pad_last_batch = layers.has_static_batch(model.output)
+
+        if self.dtype not in (numpy.float32, numpy.float16):
+            raise ValueError('dtype should be float32 or float16')
+
+        if not os.path.exists(self.output_path):
+            os.makedirs(self.output_path)
+
+        model_layers = [getattr(model, name) for name in layer_names]
+        self.feature_dims = [get_feature_dim(layer, pool)
+                             for layer in model_layers]
+
+        if layers.batch_axis(model.input) == 3:
+            self.input_axes = (1, 2, 3, 0)
+        else:
+            self.input_axes = None
+
+        self.feature_func = theano.function(
+            [model._get_input_symbol()],
+            [get_feature_symbol(layer, pool) for layer in model_layers])
+
+    def run(self, data_container):
+        X = data_container.X
+        num_samples = X.shape[0]
+
+        identity = self._get_identity(X)
+        start = self._load_progress(identity)
+        features = self._open_features(num_samples, resume=(start > 0))
+        if start >= num_samples:
+            return features
+
+        if start > 0:
+            print('Resuming feature extraction at sample %d' % start)
+
+        iterator = BatchPrefetcher(PaddedBatchIterator(
+            X, self.batch_size, start=start, pad=self.pad_last_batch,
+            axes=self.input_axes))
+        for step, (batch_start, num_valid, x_batch) in enumerate(iterator):
+            x_batch = self.preprocessor.run(x_batch)
+            batch_features = self.feature_func(x_batch)
+
+            batch_slice = slice(batch_start, batch_start + num_valid)
+            for feature_array, batch_feature in zip(features,
+                                                    batch_features):
+                feature_array[batch_slice] = numpy.asarray(
+                    batch_feature)[0:num_valid]
+
+            if (step + 1) % self.flush_steps == 0:
+                self._flush(features, batch_start + num_valid, identity)
+
+        self._flush(features, num_samples, identity)
+        return features
+
+    def get_feature_paths(self):
+        return [os.path.join(self.output_path, '%s.npy' % name)
+                for name in self.layer_names]
+
+    def _open_features(self, num_samples, resume):
+        features = []
+        for path, dim in zip(self.get_feature_paths(), self.feature_dims):
+            shape = (num_samples, dim)
+            feature_array = None
+            if resume and os.path.exists(path):
+                feature_array = open_memmap(path, mode='r+')
+                if (feature_array.shape != shape or
+                        feature_array.dtype != self.dtype):
+                    raise Exception('Existing features in %s do not match '
+                                    'the requested extraction.' % path)
+            else:
+                feature_array = open_memmap(path, mode='w+',
+                                            dtype=self.dtype, shape=shape)
+            features.append(feature_array)
+        return features
+
+    def _get_identity(self, X):
+        # What the stored features depend on: the parameter values, the
+        # layers, pooling, dtype and preprocessing, and the data
+        digest = hashlib.md5(str((self.layer_names, self.pool,
+                                  str(self.dtype),
+                                  [type(module).__name__ for module
+                                   in self.preprocessor.module_list])))
+        for param in self.model.all_save_parameters_symbol:
+            value = numpy.ascontiguousarray(param.get_value())
+            digest.update(str((value.shape, str(value.dtype))))
+            digest.update(value.tostring())
+        digest.update(get_data_digest(X))
+        return digest.hexdigest()
+
+    def _flush(self, features, num_done, identity):
+        # Features must reach the disk before the progress marker does.
+        for feature_array in features:
+            feature_array.flush()
+
+        progress_path = os.path.join(self.output_path, 'progress.txt')
+        f = open(progress_path + '.tmp', 'wb')
+        f.write('%d\n%s\n' % (num_done, identity))
+        f.close()
+        os.rename(progress_path + '.tmp', progress_path)
+
+    def _load_progress(self, identity):
+        progress_path = os.path.join(self.output_path, 'progress.txt')
+        if not os.path.exists(progress_path):
+            return 0
+        if not all([os.path.exists(path)
+                    for path in self.get_feature_paths()]):
+            return 0
+
+        f = open(progress_path, 'rb')
+        lines = f.read().split()
+        f.close()
+        if len(lines) != 2 or lines[1] != identity:
+            print('Features in %s come from another model or dataset, '
+                  'extracting them again' % self.output_path)
+            return 0
+        return int(lines[0])
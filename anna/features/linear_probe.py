@@ -0,0 +1,215 @@
+"""
+Linear probes trained directly on extracted feature arrays.
+
+Everything here is plain NumPy, so the probes work on the memory-mapped
+arrays written by FeatureExtractor without touching Theano. Feature arrays
+are read in blocks of rows; blocks are loaded in background threads while
+the BLAS calls of the previous block run.
+"""
+from multiprocessing.pool import ThreadPool
+
+import numpy
+
+
+def load_features(path):
+    # Memory-map the features, blocks are read on demand.
+    return numpy.load(path, mmap_mode='r')
+
+
+def get_block_slices(num_samples, block_size):
+    return [slice(start, min(start + block_size, num_samples))
+            for start in xrange(0, num_samples, block_size)]
+
+
+def _load_block(X, block_slice):
+    return numpy.array(X[block_slice], dtype=numpy.float64)
+
+
+def _block_moments(X, block_slice):
+    X_block = _load_block(X, block_slice)
+    return X_block.sum(axis=0), (X_block ** 2).sum(axis=0)
+
+
+def _block_gram(X, y, num_classes, block_slice):
+    X_block = _load_block(X, block_slice)
+    y_block = y[block_slice]
+    # X^T Y for one-hot Y is the sum of the rows of every class, so Y is
+    # never built
+    class_sums = numpy.zeros((num_classes, X_block.shape[1]))
+    for c in numpy.unique(y_block):
+        class_sums[c] = X_block[y_block == c].sum(axis=0)
+    return (numpy.dot(X_block.T, X_block), class_sums.T,
+            X_block.sum(axis=0))
+
+
+class LinearProbe(object):
+    """
+    Multinomial linear classifier on top of fixed features.
+
+    method can be:
+        - ridge: closed-form ridge regression onto one-hot targets
+        - logistic: multinomial logistic regression trained with momentum
+            SGD, one block of rows at a time
+
+    Features are standardized internally; the learned weights are folded
+    back so that predictions are computed on the raw features.
+    """
+    def __init__(self, method='ridge', l2=1e-4, block_size=8192,
+                 num_threads=4, learning_rate=0.1, momentum=0.9,
+                 batch_size=256, num_epochs=10, rng_seed=0):
+        self.method = method
+        self.l2 = l2
+        self.block_size = block_size
+        self.num_threads = num_threads
+        self.learning_rate = learning_rate
+        self.momentum = momentum
+        self.batch_size = batch_size
+        self.num_epochs = num_epochs
+        self.rng = numpy.random.RandomState(rng_seed)
+
+        self.W = None
+        self.b = None
+
+        if self.method not in ['ridge', 'logistic']:
+            raise RuntimeError("Invalid probe method: '%s'" % self.method)
+
+    def fit(self, X, y, num_classes=None):
+        y = numpy.asarray(y, dtype=numpy.int64)
+        if num_classes is None:
+            num_classes = int(y.max()) + 1
+
+        pool = ThreadPool(self.num_threads)
+        try:
+            if self.method == 'ridge':
+                self._fit_ridge(X, y, num_classes, pool)
+            else:
+                self._fit_logistic(X, y, num_classes, pool)
+        finally:
+            pool.close()
+            pool.join()
+        return self
+
+    def predict_scores(self, X):
+        scores = numpy.zeros((X.shape[0], self.W.shape[1]),
+                             dtype=numpy.float32)
+        for block_slice in get_block_slices(X.shape[0], self.block_size):
+            X_block = numpy.asarray(X[block_slice], dtype=numpy.float32)
+            scores[block_slice] = numpy.dot(X_block, self.W) + self.b
+        return scores
+
+    def predict(self, X):
+        return numpy.argmax(self.predict_scores(X), axis=1)
+
+    def evaluate(self, X, y):
+        # Accuracy in percent, as reported by util.Evaluator
+        predictions = self.predict(X)
+        accuracy = (100.0*numpy.sum(predictions == y))/len(y)
+        return accuracy
+
+    def _fit_ridge(self, X, y, num_classes, pool):
+        num_samples, num_features = X.shape
+
+        # Accumulate X^T X, X^T Y and the column sums block by block
+        gram = numpy.zeros((num_features, num_features))
+        XtY = numpy.zeros((num_features, num_classes))
+        X_sum = numpy.zeros(num_features)
+        block_slices = get_block_slices(num_samples, self.block_size)
+        for gram_block, XtY_block, sum_block in pool.imap_unordered(
+                lambda block_slice: _block_gram(X, y, num_classes,
+                                                block_slice),
+                block_slices):
+            gram += gram_block
+            XtY += XtY_block
+            X_sum += sum_block
+
+        mean = X_sum / num_samples
+        # Mean of the one-hot targets
+        Y_mean = (numpy.bincount(y, minlength=num_classes) /
+                  float(num_samples))
+
+        # Center and standardize the sufficient statistics
+        covariance = gram / num_samples - numpy.outer(mean, mean)
+        std = numpy.sqrt(numpy.maximum(numpy.diag(covariance), 0.0)) + 1e-6
+        covariance /= numpy.outer(std, std)
+        cross_covariance = (XtY / num_samples - numpy.outer(mean, Y_mean))
+        cross_covariance /= std[:, None]
+
+        covariance[numpy.diag_indices(num_features)] += self.l2
+        W = numpy.linalg.solve(covariance, cross_covariance)
+        self._set_weights(W, Y_mean, mean, std)
+
+    def _fit_logistic(self, X, y, num_classes, pool):
+        num_samples, num_features = X.shape
+        block_slices = get_block_slices(num_samples, self.block_size)
+
+        X_sum = numpy.zeros(num_features)
+        X_sq_sum = numpy.zeros(num_features)
+        for sum_block, sq_sum_block in pool.imap_unordered(
+                lambda block_slice: _block_moments(X, block_slice),
+                block_slices):
+            X_sum += sum_block
+            X_sq_sum += sq_sum_block
+        mean = X_sum / num_samples
+        std = numpy.sqrt(numpy.maximum(X_sq_sum / num_samples - mean ** 2,
+                                       0.0)) + 1e-6
+
+        W = numpy.zeros((num_features, num_classes))
+        b = numpy.zeros(num_classes)
+        W_velocity = numpy.zeros_like(W)
+        b_velocity = numpy.zeros_like(b)
+
+        for epoch in xrange(self.num_epochs):
+            order = self.rng.permutation(len(block_slices))
+            # Read the next block while the current one is being used
+            next_block = pool.apply_async(_load_block,
+                                          (X, block_slices[order[0]]))
+            for i, block_index in enumerate(order):
+                X_block = next_block.get()
+                if i + 1 < len(order):
+                    next_block = pool.apply_async(
+                        _load_block, (X, block_slices[order[i + 1]]))
+
+                X_block -= mean
+                X_block /= std
+                y_block = y[block_slices[block_index]]
+
+                batch_order = self.rng.permutation(len(y_block))
+                for start in xrange(0, len(y_block), self.batch_size):
+                    batch_index = batch_order[start:start + self.batch_size]
+                    x_batch = X_block[batch_index]
+                    y_batch = y_block[batch_index]
+
+                    scores = numpy.dot(x_batch, W) + b
+                    scores -= scores.max(axis=1)[:, None]
+                    probabilities = numpy.exp(scores)
+                    probabilities /= probabilities.sum(axis=1)[:, None]
+                    probabilities[numpy.arange(len(y_batch)), y_batch] -= 1.0
+                    probabilities /= len(y_batch)
+
+                    W_grad = numpy.dot(x_batch.T, probabilities) + self.l2 * W
+                    b_grad = probabilities.sum(axis=0)
+
+                    W_velocity *= self.momentum
+                    W_velocity -= self.learning_rate * W_grad
+                    b_velocity *= self.momentum
+                    b_velocity -= self.learning_rate * b_grad
+                    W += W_velocity
+                    b += b_velocity
+
+        self._set_weights(W, b, mean, std)
+
+    def _set_weights(self, W, b, mean, std):
+        # Fold the standardization into the weights and the bias
+        W = W / std[:, None]
+        self.W = numpy.float32(W)
+        self.b = numpy.float32(b - numpy.dot(mean, W))
+
+
+def evaluate_probe(X_train, y_train, X_test, y_test, **kwargs):
+    """
+    Fits a LinearProbe on the training features and returns the test
+    accuracy in percent.
+    """
+    probe = LinearProbe(**kwargs)
+    probe.fit(X_train, y_train)
+    return probe.evaluate(X_test, y_test)
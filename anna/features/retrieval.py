@@ -0,0 +1,389 @@
+"""
+Nearest-neighbour retrieval over extracted feature arrays.
+
+ExactIndex does brute-force k-NN with blocked matrix products. PQIndex
+compresses the corpus with PCA followed by product quantization, so that
+million-scale corpora fit in memory as a few bytes per sample. Both are
+plain NumPy and parallelize over blocks of queries with a thread pool.
+"""
+import os
+from time import time
+from multiprocessing.pool import ThreadPool
+
+import numpy
+
+from anna.features.linear_probe import get_block_slices
+
+
+def _normalize(X):
+    norms = numpy.sqrt((X ** 2).sum(axis=1))
+    return X / numpy.maximum(norms, 1e-12)[:, None]
+
+
+def _merge_top_k(best_scores, best_ids, scores, ids, k):
+    """
+    Merges a new block of candidate scores (higher is better) into the
+    running top k of every query.
+    """
+    if scores.shape[1] > k:
+        part = numpy.argpartition(-scores, k - 1, axis=1)[:, 0:k]
+        rows = numpy.arange(scores.shape[0])[:, None]
+        scores = scores[rows, part]
+        ids = ids[part]
+    else:
+        ids = numpy.tile(ids, (scores.shape[0], 1))
+
+    if best_scores is None:
+        return scores, ids
+
+    scores = numpy.hstack((best_scores, scores))
+    ids = numpy.hstack((best_ids, ids))
+    if scores.shape[1] > k:
+        part = numpy.argpartition(-scores, k - 1, axis=1)[:, 0:k]
+        rows = numpy.arange(scores.shape[0])[:, None]
+        scores = scores[rows, part]
+        ids = ids[rows, part]
+    return scores, ids
+
+
+def _sort_top_k(scores, ids):
+    order = numpy.argsort(-scores, axis=1)
+    rows = numpy.arange(scores.shape[0])[:, None]
+    return scores[rows, order], ids[rows, order]
+
+
+class ExactIndex(object):
+    """
+    Exact k-NN index.
+
+    metric can be:
+        - l2: squared euclidean distance
+        - cosine: cosine similarity
+        - dot: inner product
+    search returns (distances, ids); for l2 the distances are squared
+    euclidean distances, for cosine and dot they are similarities.
+    """
+    def __init__(self, features, metric='l2', block_size=16384,
+                 query_block_size=256, num_threads=4):
+        self.metric = metric
+        self.block_size = block_size
+        self.query_block_size = query_block_size
+        self.num_threads = num_threads
+
+        if self.metric not in ['l2', 'cosine', 'dot']:
+            raise RuntimeError("Invalid metric: '%s'" % self.metric)
+
+        self.features = features
+        self.norms = None
+        if self.metric == 'l2':
+            self.norms = numpy.zeros(features.shape[0], dtype=numpy.float32)
+            for block_slice in get_block_slices(features.shape[0],
+                                                self.block_size):
+                block = numpy.asarray(features[block_slice],
+                                      dtype=numpy.float32)
+                self.norms[block_slice] = (block ** 2).sum(axis=1)
+        elif self.metric == 'cosine':
+            self.norms = numpy.zeros(features.shape[0], dtype=numpy.float32)
+            for block_slice in get_block_slices(features.shape[0],
+                                                self.block_size):
+                block = numpy.asarray(features[block_slice],
+                                      dtype=numpy.float32)
+                self.norms[block_slice] = numpy.maximum(
+                    numpy.sqrt((block ** 2).sum(axis=1)), 1e-12)
+
+    def search(self, queries, k=10):
+        queries = numpy.asarray(queries, dtype=numpy.float32)
+        if self.metric == 'cosine':
+            queries = _normalize(queries)
+
+        query_slices = get_block_slices(queries.shape[0],
+                                        self.query_block_size)
+        pool = ThreadPool(self.num_threads)
+        try:
+            results = pool.map(
+                lambda query_slice: self._search_block(queries[query_slice],
+                                                       k),
+                query_slices)
+        finally:
+            pool.close()
+            pool.join()
+
+        scores = numpy.vstack([r[0] for r in results])
+        ids = numpy.vstack([r[1] for r in results])
+        if self.metric == 'l2':
+            scores = numpy.maximum(-scores + (queries ** 2).sum(
+                axis=1)[:, None], 0.0)
+        return scores, ids
+
+    def save(self, path):
+        if not os.path.exists(path):
+            os.makedirs(path)
+        numpy.save(os.path.join(path, 'features.npy'), self.features)
+        numpy.savez(os.path.join(path, 'index.npz'), kind='exact',
+                    metric=self.metric, block_size=self.block_size)
+
+    def _search_block(self, queries, k):
+        best_scores = None
+        best_ids = None
+        num_samples = self.features.shape[0]
+        for block_slice in get_block_slices(num_samples, self.block_size):
+            block = numpy.asarray(self.features[block_slice],
+                                  dtype=numpy.float32)
+            scores = numpy.dot(queries, block.T)
+            if self.metric == 'l2':
+                # -||q - x||^2 up to the per-query constant ||q||^2
+                scores *= 2.0
+                scores -= self.norms[block_slice][None, :]
+            elif self.metric == 'cosine':
+                scores /= self.norms[block_slice][None, :]
+            ids = numpy.arange(block_slice.start, block_slice.stop)
+            best_scores, best_ids = _merge_top_k(best_scores, best_ids,
+                                                 scores, ids, k)
+        return _sort_top_k(best_scores, best_ids)
+
+
+def kmeans(X, num_clusters, num_iterations=20, rng=None):
+    """
+    Lloyd's algorithm, initialized with randomly drawn samples. With fewer
+    samples than num_clusters, every sample becomes a centroid.
+    """
+    if rng is None:
+        rng = numpy.random.RandomState(0)
+    X = numpy.asarray(X, dtype=numpy.float32)
+    num_clusters = min(num_clusters, X.shape[0])
+    centroids = X[rng.choice(X.shape[0], num_clusters,
+                             replace=False)].copy()
+    for i in xrange(num_iterations):
+        distances = ((centroids ** 2).sum(axis=1)[None, :]
+                     - 2 * numpy.dot(X, centroids.T))
+        assignments = numpy.argmin(distances, axis=1)
+        counts = numpy.bincount(assignments, minlength=num_clusters)
+        for j in xrange(X.shape[1]):
+            centroids[:, j] = numpy.bincount(assignments, weights=X[:, j],
+                                             minlength=num_clusters)
+        empty = (counts == 0)
+        # re-seed empty clusters with random samples
+        centroids[empty] = X[rng.choice(X.shape[0], empty.sum())]
+        centroids[~empty] /= counts[~empty][:, None]
+    return centroids
+
+
+class PQIndex(object):
+    """
+    Compressed k-NN index: features are projected onto their top
+    num_components principal components and split into num_subspaces
+    subvectors, each encoded as one byte (256 centroids per subspace).
+
+    Distances are approximated with asymmetric distance computation. If
+    the original features are given to search, the best rerank candidates
+    are re-scored exactly. Like ExactIndex, search returns squared
+    euclidean distances for l2 and similarities for cosine (computed from
+    the distances of the normalized features).
+    """
+    def __init__(self, num_components=64, num_subspaces=16, metric='l2',
+                 block_size=65536, query_block_size=256, num_threads=4,
+                 num_train=100000, num_iterations=20, rng_seed=0):
+        self.num_components = num_components
+        self.num_subspaces = num_subspaces
+        self.metric = metric
+        self.block_size = block_size
+        self.query_block_size = query_block_size
+        self.num_threads = num_threads
+        self.num_train = num_train
+        self.num_iterations = num_iterations
+        self.rng = numpy.random.RandomState(rng_seed)
+
+        if self.num_components % self.num_subspaces != 0:
+            raise ValueError('num_components should be a multiple of '
+                             'num_subspaces')
+        if self.metric not in ['l2', 'cosine']:
+            raise RuntimeError("Invalid metric: '%s'" % self.metric)
+
+        self.mean = None
+        self.projection = None
+        self.codebooks = None
+        self.codes = None
+
+    def fit(self, features):
+        """
+        Learns the PCA projection and the codebooks on a random subset of
+        the features, then encodes all of them.
+        """
+        num_samples = features.shape[0]
+        num_train = min(self.num_train, num_samples)
+        train_index = numpy.sort(self.rng.choice(num_samples, num_train,
+                                                 replace=False))
+        train = self._prepare(features[train_index])
+
+        self.mean = train.mean(axis=0)
+        train -= self.mean
+        covariance = numpy.dot(train.T, train) / num_train
+        eigenvalues, eigenvectors = numpy.linalg.eigh(covariance)
+        order = numpy.argsort(eigenvalues)[::-1][0:self.num_components]
+        self.projection = numpy.float32(eigenvectors[:, order])
+
+        train = numpy.dot(train, self.projection)
+        sub_dim = self.num_components // self.num_subspaces
+        self.codebooks = numpy.zeros((self.num_subspaces, 256, sub_dim),
+                                     dtype=numpy.float32)
+        for m in xrange(self.num_subspaces):
+            codebook = kmeans(train[:, m * sub_dim:(m + 1) * sub_dim], 256,
+                              self.num_iterations, self.rng)
+            # Small training sets give fewer centroids; the unused codes
+            # repeat the first one and are never chosen by encode
+            self.codebooks[m, 0:len(codebook)] = codebook
+            self.codebooks[m, len(codebook):] = codebook[0]
+
+        self.codes = self.encode(features)
+        return self
+
+    def encode(self, features, codes=None):
+        """
+        Encodes features into (num_samples, num_subspaces) uint8 codes. codes
+        can be a preallocated (e.g. memory-mapped) output array.
+        """
+        num_samples = features.shape[0]
+        if codes is None:
+            codes = numpy.zeros((num_samples, self.num_subspaces),
+                                dtype=numpy.uint8)
+        sub_dim = self.num_components // self.num_subspaces
+        codebook_norms = (self.codebooks ** 2).sum(axis=2)
+        for block_slice in get_block_slices(num_samples, self.block_size):
+            block = self._project(features[block_slice])
+            for m in xrange(self.num_subspaces):
+                sub_block = block[:, m * sub_dim:(m + 1) * sub_dim]
+                distances = (codebook_norms[m][None, :]
+                             - 2 * numpy.dot(sub_block, self.codebooks[m].T))
+                codes[block_slice, m] = numpy.argmin(distances, axis=1)
+        return codes
+
+    def search(self, queries, k=10, features=None, rerank=100):
+        queries = self._prepare(queries)
+        projected_queries = numpy.dot(queries - self.mean, self.projection)
+        num_candidates = k if features is None else max(k, rerank)
+
+        query_slices = get_block_slices(queries.shape[0],
+                                        self.query_block_size)
+        pool = ThreadPool(self.num_threads)
+        try:
+            results = pool.map(
+                lambda query_slice: self._search_block(
+                    projected_queries[query_slice], num_candidates),
+                query_slices)
+        finally:
+            pool.close()
+            pool.join()
+
+        scores = numpy.vstack([r[0] for r in results])
+        ids = numpy.vstack([r[1] for r in results])
+
+        if features is not None:
+            scores, ids = self._rerank(queries, ids, features, k)
+        distances = -scores
+        if self.metric == 'cosine':
+            # ||q - x||^2 = 2 - 2 cos(q, x) for unit vectors
+            return 1.0 - distances / 2.0, ids
+        return distances, ids
+
+    def save(self, path):
+        if not os.path.exists(path):
+            os.makedirs(path)
+        numpy.save(os.path.join(path, 'codes.npy'), self.codes)
+        numpy.savez(os.path.join(path, 'index.npz'), kind='pq',
+                    metric=self.metric, mean=self.mean,
+                    projection=self.projection, codebooks=self.codebooks,
+                    num_components=self.num_components,
+                    num_subspaces=self.num_subspaces,
+                    block_size=self.block_size)
+
+    def _prepare(self, X):
+        X = numpy.array(X, dtype=numpy.float32)
+        if self.metric == 'cosine':
+            X = _normalize(X)
+        return X
+
+    def _project(self, X):
+        return numpy.dot(self._prepare(X) - self.mean, self.projection)
+
+    def _search_block(self, queries, k):
+        sub_dim = self.num_components // self.num_subspaces
+        # Distance tables, (num_queries, num_subspaces, 256)
+        tables = numpy.zeros((queries.shape[0], self.num_subspaces, 256),
+                             dtype=numpy.float32)
+        for m in xrange(self.num_subspaces):
+            sub_queries = queries[:, m * sub_dim:(m + 1) * sub_dim]
+            tables[:, m, :] = (
+                (sub_queries ** 2).sum(axis=1)[:, None]
+                - 2 * numpy.dot(sub_queries, self.codebooks[m].T)
+                + (self.codebooks[m] ** 2).sum(axis=1)[None, :])
+
+        best_scores = None
+        best_ids = None
+        for block_slice in get_block_slices(self.codes.shape[0],
+                                            self.block_size):
+            codes = numpy.asarray(self.codes[block_slice])
+            scores = numpy.zeros((queries.shape[0], codes.shape[0]),
+                                 dtype=numpy.float32)
+            for m in xrange(self.num_subspaces):
+                scores -= tables[:, m, :][:, codes[:, m]]
+            ids = numpy.arange(block_slice.start, block_slice.stop)
+            best_scores, best_ids = _merge_top_k(best_scores, best_ids,
+                                                 scores, ids, k)
+        return _sort_top_k(best_scores, best_ids)
+
+    def _rerank(self, queries, ids, features, k):
+        scores = numpy.zeros(ids.shape, dtype=numpy.float32)
+        for i in xrange(ids.shape[0]):
+            order = numpy.argsort(ids[i])
+            candidates = self._prepare(features[ids[i][order]])
+            scores[i, order] = -((candidates - queries[i]) ** 2).sum(axis=1)
+        scores, ids = _sort_top_k(scores, ids)
+        return scores[:, 0:k], ids[:, 0:k]
+
+
+def load_index(path, mmap_mode='r'):
+    """
+    Loads an index written by ExactIndex.save or PQIndex.save. The corpus
+    features or codes are memory-mapped by default.
+    """
+    params = numpy.load(os.path.join(path, 'index.npz'))
+    kind = str(params['kind'])
+    if kind == 'exact':
+        features = numpy.load(os.path.join(path, 'features.npy'),
+                              mmap_mode=mmap_mode)
+        return ExactIndex(features, metric=str(params['metric']),
+                          block_size=int(params['block_size']))
+    elif kind == 'pq':
+        index = PQIndex(num_components=int(params['num_components']),
+                        num_subspaces=int(params['num_subspaces']),
+                        metric=str(params['metric']),
+                        block_size=int(params['block_size']))
+        index.mean = params['mean']
+        index.projection = params['projection']
+        index.codebooks = params['codebooks']
+        index.codes = numpy.load(os.path.join(path, 'codes.npy'),
+                                 mmap_mode=mmap_mode)
+        return index
+    else:
+        raise RuntimeError("Invalid index kind: '%s'" % kind)
+
+
+def benchmark(index, queries, ground_truth_ids, k=10, num_runs=3,
+              **search_kwargs):
+    """
+    Returns (recall at k, milliseconds per query) of the index, where
+    ground_truth_ids are the ids returned by an ExactIndex for the same
+    queries.
+    """
+    times = []
+    for i in xrange(num_runs):
+        tic = time()
+        __, ids = index.search(queries, k, **search_kwargs)
+        times.append(time() - tic)
+
+    hits = 0
+    for found, expected in zip(ids, ground_truth_ids):
+        hits += len(numpy.intersect1d(found, expected[0:k]))
+    recall = float(hits) / (k * len(queries))
+    milliseconds = 1000.0 * numpy.min(times) / len(queries)
+    return recall, milliseconds
@@ -0,0 +1,286 @@
+"""
+Exports trained anna models to the format run by anna.inference.runtime.
+
+The layer graph below model.output is walked once, every layer is turned
+into a node of the runtime graph and every parameter is stored once, even
+when it is shared between layers (e.g. a Deconv2DLayer and its mirror).
+Dropout is switched off, as in prediction.
+"""
+import numpy
+import theano
+
+from anna.layers import layers, cc_layers
+from anna.inference import runtime
+
+NONLINEARITY_NAMES = [
+    (layers.rectify, 'relu'),
+    (layers.identity, 'identity'),
+    (layers.sigmoid, 'sigmoid'),
+    (layers.tanh, 'tanh'),
+    (layers.softmax, 'softmax'),
+    (layers.trec, 'trec'),
+]
+
+
+def get_nonlinearity_name(nonlinearity):
+    for function, name in NONLINEARITY_NAMES:
+        if nonlinearity is function:
+            return name
+    raise RuntimeError('Nonlinearity %s can not be exported.' % nonlinearity)
+
+
+def get_input_layers(layer):
+    """
+    Returns the layers whose outputs are used by the given layer, in the
+    order the runtime op expects them.
+    """
+    if isinstance(layer, cc_layers.Unpooling2DLayer):
+        return [layer.input_layer, layer.pooling_layer,
+                layer.pooling_layer.input_layer]
+    elif isinstance(layer, layers.ConcatenateLayer):
+        return list(layer.input_layers)
+    elif isinstance(layer, (layers.InputLayer, layers.Input2DLayer)):
+        return []
+    return [layer.input_layer]
+
+
+def get_topological_order(layer):
+    order = []
+    visited = set()
+
+    def visit(current):
+        if id(current) in visited:
+            return
+        visited.add(id(current))
+        for input_layer in get_input_layers(current):
+            visit(input_layer)
+        order.append(current)
+
+    visit(layer)
+    return order
+
+
+class GraphBuilder(object):
+    """
+    Builds the (graph, arrays) pair describing a model. Nodes are named
+    after the attribute of the model holding their layer when there is one.
+    """
+    def __init__(self, model, sparse_threshold=None):
+        self.model = model
+        self.sparse_threshold = sparse_threshold
+        self.layer_names = {}
+        for name in sorted(dir(model)):
+            value = getattr(model, name)
+            if hasattr(value, 'get_output_shape'):
+                self.layer_names.setdefault(id(value), name)
+
+        self.node_names = {}
+        self.nodes = []
+        self.arrays = {}
+        self.param_keys = {}
+
+    def build(self):
+        input_layer = self.model.input
+        if layers.batch_axis(input_layer) == 3:
+            data_order = 'c01b'
+        elif len(input_layer.get_output_shape()) == 4:
+            data_order = 'bc01'
+        else:
+            data_order = 'flat'
+
+        for layer in get_topological_order(self.model.output):
+            self._add_layer(layer)
+
+        input_shape = list(input_layer.get_output_shape())
+        del input_shape[layers.batch_axis(input_layer)]
+        graph = {
+            'format': runtime.FORMAT,
+            'version': runtime.VERSION,
+            'model': self.model.name,
+            'input': {'name': self.node_names[id(input_layer)],
+                      'shape': [int(s) for s in input_shape],
+                      'data_order': data_order},
+            'output': self.node_names[id(self.model.output)],
+            'nodes': self.nodes,
+        }
+        return graph, self.arrays
+
+    def _get_name(self, layer):
+        name = self.layer_names.get(id(layer))
+        if name is None:
+            name = '%s_%d' % (type(layer).__name__, len(self.node_names))
+        return name
+
+    def _add_param(self, param, value=None):
+        # Shared variables are stored once and referenced by key
+        if id(param) not in self.param_keys:
+            key = 'param_%d' % len(self.param_keys)
+            if value is None:
+                value = param.get_value()
+            self.arrays[key] = numpy.asarray(value, dtype=numpy.float32)
+            self.param_keys[id(param)] = key
+        return self.param_keys[id(param)]
+
+    def _add_node(self, layer, node_type, attrs={}, params={},
+                  nonlinearity=None):
+        name = self._get_name(layer)
+        node = {'name': name,
+                'type': node_type,
+                'inputs': [self.node_names[id(input_layer)]
+                           for input_layer in get_input_layers(layer)],
+                'attrs': attrs,
+                'params': params}
+        if nonlinearity is not None:
+            node['nonlinearity'] = get_nonlinearity_name(nonlinearity)
+        self.nodes.append(node)
+        self.node_names[id(layer)] = name
+
+    def _add_layer(self, layer):
+        if isinstance(layer, (layers.InputLayer, layers.Input2DLayer)):
+            self.node_names[id(layer)] = self._get_name(layer)
+
+        elif isinstance(layer, cc_layers.DropoutLayer):
+            # Dropout is the identity at prediction time
+            self.node_names[id(layer)] = self.node_names[id(
+                layer.input_layer)]
+
+        elif isinstance(layer, (layers.DenseLayer, layers.DenseNoBiasLayer)):
+            W = layer.W.get_value()
+            sparsity = 1.0 - numpy.count_nonzero(W) / float(W.size)
+            if (self.sparse_threshold is not None and
+                    sparsity >= self.sparse_threshold):
+                self._add_dense_csr(layer, W)
+            else:
+                params = {'W': self._add_param(layer.W)}
+                if isinstance(layer, layers.DenseLayer):
+                    params['b'] = self._add_param(layer.b)
+                self._add_node(layer, 'dense', params=params,
+                               nonlinearity=layer.nonlinearity)
+
+        elif isinstance(layer, layers.Conv2DLayer):
+            self._add_conv_bc01(layer, layer.border_mode, (1, 1))
+
+        elif isinstance(layer, layers.StridedConv2DLayer):
+            # All implementations compute the same valid, strided convolution
+            self._add_conv_bc01(layer, 'valid',
+                                (layer.stride_x, layer.stride_y))
+
+        elif isinstance(layer, (cc_layers.Conv2DLayer,
+                                cc_layers.Conv2DNoBiasLayer)):
+            params = {'W': self._add_param(layer.W)}
+            if isinstance(layer, cc_layers.Conv2DLayer):
+                params['b'] = self._add_param(layer.b)
+            self._add_node(layer, 'conv_c01b',
+                           attrs={'stride': layer.stride, 'pad': layer.pad},
+                           params=params, nonlinearity=layer.nonlinearity)
+
+        elif isinstance(layer, (cc_layers.Deconv2DLayer,
+                                cc_layers.DeconvUntied2DLayer,
+                                cc_layers.Deconv2DNoBiasLayer)):
+            params = {'W': self._add_param(layer.W)}
+            if not isinstance(layer, cc_layers.Deconv2DNoBiasLayer):
+                params['b'] = self._add_param(layer.b)
+            image_size = [int(s) for s in layer.get_output_shape()[1:3]]
+            self._add_node(layer, 'deconv_c01b',
+                           attrs={'stride': layer.stride, 'pad': layer.pad,
+                                  'image_size': image_size},
+                           params=params, nonlinearity=layer.nonlinearity)
+
+        elif isinstance(layer, layers.Pooling2DLayer):
+            self._add_node(layer, 'max_pool',
+                           attrs={'pool_size': list(layer.pool_size),
+                                  'ignore_border': layer.ignore_border})
+
+        elif isinstance(layer, layers.PoolingLayer):
+            self._add_node(layer, 'max_pool',
+                           attrs={'pool_size': [1, layer.ds_factor],
+                                  'ignore_border': layer.ignore_border})
+
+        elif isinstance(layer, cc_layers.Pooling2DLayer):
+            self._add_node(layer, 'max_pool_c01b',
+                           attrs={'pool_size': layer.pool_size,
+                                  'stride': layer.stride})
+
+        elif isinstance(layer, cc_layers.Unpooling2DLayer):
+            self._add_node(layer, 'unpool_c01b',
+                           attrs={'pool_size': layer.pool_size,
+                                  'stride': layer.stride})
+
+        elif isinstance(layer, layers.GlobalPooling2DLayer):
+            self._add_node(layer, 'global_pool',
+                           attrs={'pooling_function':
+                                  layer.pooling_function},
+                           nonlinearity=layer.nonlinearity)
+
+        elif isinstance(layer, cc_layers.ShuffleC01BToBC01Layer):
+            self._add_node(layer, 'transpose', attrs={'axes': [3, 0, 1, 2]})
+
+        elif isinstance(layer, cc_layers.ShuffleBC01ToC01BLayer):
+            self._add_node(layer, 'transpose', attrs={'axes': [1, 2, 3, 0]})
+
+        elif isinstance(layer, layers.ConcatenateLayer):
+            self._add_node(layer, 'concatenate')
+
+        else:
+            raise RuntimeError('Layer %s can not be exported.'
+                               % type(layer).__name__)
+
+    def _add_dense_csr(self, layer, W):
+        data, indices, indptr = runtime.to_csr(W)
+        key = self._add_param(layer.W, data)
+        self.arrays[key + '_indices'] = indices
+        self.arrays[key + '_indptr'] = indptr
+        params = {'data': key, 'indices': key + '_indices',
+                  'indptr': key + '_indptr'}
+        if isinstance(layer, layers.DenseLayer):
+            params['b'] = self._add_param(layer.b)
+        self._add_node(layer, 'dense_csr',
+                       attrs={'shape': [int(s) for s in W.shape]},
+                       params=params, nonlinearity=layer.nonlinearity)
+
+    def _add_conv_bc01(self, layer, border_mode, stride):
+        # Theano convolutions flip the filters, the runtime correlates.
+        W = layer.W.get_value()[:, :, ::-1, ::-1]
+        filter_width, filter_height = W.shape[2], W.shape[3]
+        if border_mode == 'valid':
+            pad = [0, 0, 0, 0]
+        elif border_mode == 'full':
+            pad = [filter_width - 1, filter_width - 1,
+                   filter_height - 1, filter_height - 1]
+        elif border_mode == 'same':
+            shift_x = (filter_width - 1) // 2
+            shift_y = (filter_height - 1) // 2
+            pad = [filter_width - 1 - shift_x, shift_x,
+                   filter_height - 1 - shift_y, shift_y]
+        else:
+            raise RuntimeError("Invalid border mode: '%s'" % border_mode)
+
+        params = {'W': self._add_param(layer.W, W),
+                  'b': self._add_param(layer.b)}
+        self._add_node(layer, 'conv_bc01',
+                       attrs={'pad': pad, 'stride': list(stride)},
+                       params=params, nonlinearity=layer.nonlinearity)
+
+
+def export_model(model, path, sparse_threshold=None):
+    """
+    Writes the layer graph and parameters of a model to path (.npz).
+
+    Dense layers with at least a fraction sparse_threshold of zero weights
+    (e.g. after pruning.prune_model) are stored in CSR format.
+    """
+    graph, arrays = GraphBuilder(model, sparse_threshold).build()
+    runtime.save_graph(path, graph, arrays)
+    return graph
+
+
+def check_export(model, inference_model, batch):
+    """
+    Returns the largest absolute difference between the outputs of the
+    model (dropout switched off) and of the exported model on a batch.
+    """
+    prediction_func = theano.function(
+        [model._get_input_symbol()],
+        model._get_output_symbol(dropout_active=False))
+    expected = prediction_func(batch)
+    return numpy.abs(inference_model.predict(batch) - expected).max()
@@ -0,0 +1,205 @@
+"""
+Post-training int8 quantization of exported models.
+
+Dense and convolution weights are quantized symmetrically with one scale
+per output channel. The inputs of these layers are quantized with one scale
+per layer, calibrated by streaming a sample of the data through the float32
+model. Like the runtime, this module only depends on NumPy.
+"""
+import json
+from time import time
+
+import numpy
+
+from anna.datasets.streaming import PaddedBatchIterator, BatchPrefetcher
+from anna.inference import runtime
+
+# Quantized node type and output channel axis of the weights of every
+# quantizable node type.
+QUANTIZABLE = {
+    'dense': ('dense_int8', 1),
+    'conv_bc01': ('conv_bc01_int8', 0),
+    'conv_c01b': ('conv_c01b_int8', 3),
+}
+
+
+def get_input_axes(inference_model):
+    # Data containers store bc01 samples
+    if inference_model.data_order == 'c01b':
+        return (1, 2, 3, 0)
+    return None
+
+
+def iterate_batches(inference_model, X, batch_size, preprocessor=None):
+    """
+    Yields (num_valid, batch) over X, laid out for the model and run
+    through the preprocessor if one is given.
+    """
+    iterator = BatchPrefetcher(PaddedBatchIterator(
+        X, batch_size, pad=False, axes=get_input_axes(inference_model)))
+    for __, num_valid, batch in iterator:
+        if preprocessor is not None:
+            batch = preprocessor.run(batch)
+        yield num_valid, batch
+
+
+def quantize_weights(W, axis):
+    """
+    Returns int8 weights and the float32 scale of every slice of W along
+    axis.
+    """
+    reduce_axes = tuple([i for i in xrange(W.ndim) if i != axis])
+    scale = numpy.abs(W).max(axis=reduce_axes) / 127.0
+    scale[scale == 0] = 1.0
+    shape = [1] * W.ndim
+    shape[axis] = -1
+    W_int8 = numpy.clip(numpy.rint(W / scale.reshape(shape)), -127, 127)
+    return W_int8.astype(numpy.int8), scale.astype(numpy.float32)
+
+
+class Calibrator(object):
+    """
+    Collects the range of the inputs of every quantizable node over the
+    batches passed to update.
+
+    If percentile is None, the range is the largest absolute value seen.
+    Otherwise it is the mean over batches of the given percentile of the
+    absolute values, which ignores rare outliers.
+    """
+    def __init__(self, inference_model, percentile=None):
+        self.inference_model = inference_model
+        self.percentile = percentile
+        self.node_names = set([node['name'] for node
+                               in inference_model.graph['nodes']
+                               if node['type'] in QUANTIZABLE])
+        self.ranges = {}
+        self.num_batches = 0
+
+    def update(self, batch):
+        self.inference_model.predict(batch, callback=self._observe)
+        self.num_batches += 1
+
+    def run(self, X, batch_size, num_samples=None, preprocessor=None):
+        if num_samples is not None:
+            X = X[0:num_samples]
+        for __, batch in iterate_batches(self.inference_model, X,
+                                         batch_size, preprocessor):
+            self.update(batch)
+        return self.get_ranges()
+
+    def get_ranges(self):
+        if self.percentile is None:
+            return dict(self.ranges)
+        return dict([(name, value / self.num_batches)
+                     for name, value in self.ranges.items()])
+
+    def _observe(self, name, inputs, output):
+        if name not in self.node_names:
+            return
+        if self.percentile is None:
+            value = float(numpy.abs(inputs[0]).max())
+            self.ranges[name] = max(self.ranges.get(name, 0.0), value)
+        else:
+            value = float(numpy.percentile(numpy.abs(inputs[0]),
+                                           self.percentile))
+            self.ranges[name] = self.ranges.get(name, 0.0) + value
+
+
+def quantize_graph(graph, arrays, ranges, skip_nodes=[]):
+    """
+    Returns a copy of (graph, arrays) where every quantizable node with a
+    calibrated range, except those named in skip_nodes, runs in int8.
+    Float32 weights that are no longer used (e.g. not shared with a
+    Deconv2DLayer) are dropped.
+    """
+    graph = json.loads(json.dumps(graph))
+    arrays = dict(arrays)
+
+    for node in graph['nodes']:
+        if (node['type'] not in QUANTIZABLE or node['name'] in skip_nodes or
+                node['name'] not in ranges):
+            continue
+        node_type, axis = QUANTIZABLE[node['type']]
+        W_key = node['params']['W']
+        W_int8, scale = quantize_weights(arrays[W_key], axis)
+        arrays[W_key + '_int8'] = W_int8
+        arrays[W_key + '_scale'] = scale
+
+        node['type'] = node_type
+        node['params']['W'] = W_key + '_int8'
+        node['params']['scale'] = W_key + '_scale'
+        node['attrs']['input_scale'] = max(ranges[node['name']], 1e-8) / 127.0
+
+    used_keys = set()
+    for node in graph['nodes']:
+        used_keys.update(node.get('params', {}).values())
+    arrays = dict([(key, value) for key, value in arrays.items()
+                   if key in used_keys])
+    return graph, arrays
+
+
+def quantize_model(model_path, output_path, X, batch_size=128,
+                   num_samples=1024, percentile=None, skip_nodes=[],
+                   preprocessor=None):
+    """
+    Calibrates the exported model at model_path on the first num_samples
+    samples of X and writes its int8 version to output_path.
+    """
+    graph, arrays = runtime.load_graph(model_path)
+    calibrator = Calibrator(runtime.InferenceModel(graph, arrays),
+                            percentile=percentile)
+    ranges = calibrator.run(X, batch_size, num_samples=num_samples,
+                            preprocessor=preprocessor)
+    graph, arrays = quantize_graph(graph, arrays, ranges, skip_nodes)
+    runtime.save_graph(output_path, graph, arrays)
+    return runtime.InferenceModel(graph, arrays)
+
+
+def evaluate_accuracy(inference_model, X, y, batch_size=128,
+                      preprocessor=None):
+    """
+    Classification accuracy in percent, computed like util.Evaluator.
+    """
+    predictions = []
+    for num_valid, batch in iterate_batches(inference_model, X, batch_size,
+                                            preprocessor):
+        batch_pred = inference_model.predict(batch)[0:num_valid]
+        predictions.append(numpy.argmax(batch_pred, axis=1))
+    predictions = numpy.hstack(predictions)
+    accuracy = (100.0*numpy.sum(predictions == y))/len(y)
+    return accuracy
+
+
+def measure_throughput(inference_model, X, batch_size, num_batches=20):
+    """
+    Samples per second for repeated predictions on one batch of X.
+    """
+    __, batch = iterate_batches(inference_model, X[0:batch_size],
+                                batch_size).next()
+    # The first call allocates the buffers
+    inference_model.predict(batch)
+    tic = time()
+    for i in xrange(num_batches):
+        inference_model.predict(batch)
+    toc = time()
+    return batch_size * num_batches / (toc - tic)
+
+
+def quantization_report(float_model, int8_model, X, y, batch_size=128,
+                        preprocessor=None, evaluator=None):
+    """
+    Returns the accuracies of the float32 and int8 models and the accuracy
+    drop. If a util.Evaluator of the original model is given, its accuracy
+    is reported as well and the drop is measured against it.
+    """
+    report = {}
+    report['float32'] = evaluate_accuracy(float_model, X, y, batch_size,
+                                          preprocessor)
+    report['int8'] = evaluate_accuracy(int8_model, X, y, batch_size,
+                                       preprocessor)
+    reference = report['float32']
+    if evaluator is not None:
+        report['evaluator'] = evaluator.run()
+        reference = report['evaluator']
+    report['drop'] = reference - report['int8']
+    return report
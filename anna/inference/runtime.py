@@ -0,0 +1,865 @@
+"""
+Pure NumPy runtime for models exported with anna.inference.export.
+
+This module only depends on NumPy, so serving an exported model needs
+neither Theano, pylearn2 nor CUDA. A model file is a .npz archive holding
+a JSON description of the layer graph ('graph') and one array per
+parameter. Convolutions are computed as im2col + one matrix product, and
+activation and scratch buffers are allocated once per input shape and
+reused across calls.
+"""
+import json
+
+import numpy
+from numpy.lib.stride_tricks import as_strided
+
+FORMAT = 'anna-inference'
+VERSION = 1
+
+
+def save_graph(path, graph, arrays):
+    """
+    Writes a graph description and its parameter arrays to a .npz file.
+    """
+    to_save = dict(arrays)
+    to_save['graph'] = numpy.array(json.dumps(graph))
+    f = open(path, 'wb')
+    numpy.savez(f, **to_save)
+    f.close()
+
+
+def load_graph(path):
+    """
+    Returns the (graph, arrays) pair stored in a model file.
+    """
+    archive = numpy.load(path)
+    graph = json.loads(str(archive['graph']))
+    if graph.get('format') != FORMAT:
+        raise RuntimeError('%s is not an exported anna model' % path)
+    arrays = dict([(key, archive[key]) for key in archive.files
+                   if key != 'graph'])
+    archive.close()
+    return graph, arrays
+
+
+def load(path):
+    graph, arrays = load_graph(path)
+    return InferenceModel(graph, arrays)
+
+
+# nonlinearities, applied in place
+
+
+def _relu(x):
+    numpy.maximum(x, 0.0, out=x)
+
+
+def _identity(x):
+    pass
+
+
+def _sigmoid(x):
+    numpy.negative(x, out=x)
+    numpy.exp(x, out=x)
+    x += 1.0
+    numpy.reciprocal(x, out=x)
+
+
+def _tanh(x):
+    numpy.tanh(x, out=x)
+
+
+def _softmax(x):
+    # Over axis 1, so it also applies per position of bc01 score maps
+    x -= x.max(axis=1, keepdims=True)
+    numpy.exp(x, out=x)
+    x /= x.sum(axis=1, keepdims=True)
+
+
+def _trec(x):
+    x *= (x > 1)
+
+
+NONLINEARITIES = {
+    'relu': _relu,
+    'identity': _identity,
+    'sigmoid': _sigmoid,
+    'tanh': _tanh,
+    'softmax': _softmax,
+    'trec': _trec,
+}
+
+
+class Op(object):
+    """
+    Base class of the runtime ops. Every op is built from its node
+    description and the parameter arrays, reports its output shape for given
+    input shapes, allocates its scratch buffers once per input shape, and
+    writes its result into a preallocated output buffer.
+    """
+    def __init__(self, node, arrays):
+        self.node = node
+        self.attrs = node.get('attrs', {})
+        self.nonlinearity = NONLINEARITIES[node.get('nonlinearity',
+                                                    'identity')]
+        self.params = dict([(name, arrays[key]) for name, key
+                            in node.get('params', {}).items()])
+
+    def get_output_shape(self, input_shapes):
+        raise NotImplementedError(str(type(self)) +
+                                  " does not implement this method")
+
+    def allocate(self, input_shapes):
+        return {}
+
+    def run(self, inputs, out, scratch):
+        raise NotImplementedError(str(type(self)) +
+                                  " does not implement this method")
+
+
+class GemmOp(Op):
+    """
+    Base class of the ops built around one matrix product with the weights.
+    Subclasses (see the int8 ops) can change how the input is prepared and
+    how the product is computed.
+    """
+    weight_dtype = numpy.float32
+
+    def _prepare_input(self, x, scratch):
+        return x
+
+    def _gemm(self, a, b, out, scratch):
+        numpy.dot(a, b, out=out)
+
+
+class Dense(GemmOp):
+    def __init__(self, node, arrays):
+        super(Dense, self).__init__(node, arrays)
+        self.W = numpy.ascontiguousarray(self.params['W'],
+                                         dtype=self.weight_dtype)
+        self.b = self.params.get('b')
+
+    def get_output_shape(self, input_shapes):
+        return (input_shapes[0][0], self.W.shape[1])
+
+    def run(self, inputs, out, scratch):
+        x = self._prepare_input(inputs[0], scratch)
+        x = x.reshape(x.shape[0], -1)
+        self._gemm(x, self.W, out, scratch)
+        if self.b is not None:
+            out += self.b
+        self.nonlinearity(out)
+
+
+def to_csr(W):
+    """
+    Returns the (data, indices, indptr) arrays of W.T in CSR format, i.e.
+    one row per output unit of a Dense layer.
+    """
+    W_T = numpy.asarray(W).T
+    rows, indices = numpy.nonzero(W_T)
+    data = W_T[rows, indices].astype(numpy.float32)
+    indptr = numpy.zeros(W_T.shape[0] + 1, dtype=numpy.int32)
+    numpy.cumsum(numpy.bincount(rows, minlength=W_T.shape[0]),
+                 out=indptr[1:])
+    return data, indices.astype(numpy.int32), indptr
+
+
+class DenseCSR(Op):
+    """
+    Dense layer with pruned weights stored in CSR format (see to_csr). The
+    product uses scipy.sparse when it is installed; otherwise every output
+    unit sums its gathered inputs with numpy.add.reduceat.
+    """
+    def __init__(self, node, arrays):
+        super(DenseCSR, self).__init__(node, arrays)
+        self.n_inputs, self.n_outputs = self.attrs['shape']
+        self.data = numpy.asarray(self.params['data'], dtype=numpy.float32)
+        self.indices = self.params['indices']
+        self.indptr = self.params['indptr']
+        self.b = self.params.get('b')
+
+        try:
+            import scipy.sparse
+            self.W_T = scipy.sparse.csr_matrix(
+                (self.data, self.indices, self.indptr),
+                shape=(self.n_outputs, self.n_inputs))
+        except ImportError:
+            self.W_T = None
+            self.non_empty = numpy.nonzero(numpy.diff(self.indptr))[0]
+
+    def get_output_shape(self, input_shapes):
+        return (input_shapes[0][0], self.n_outputs)
+
+    def allocate(self, input_shapes):
+        if self.W_T is not None:
+            return {}
+        return {'gathered': numpy.zeros((input_shapes[0][0], len(self.data)),
+                                        dtype=numpy.float32)}
+
+    def run(self, inputs, out, scratch):
+        x = inputs[0].reshape(inputs[0].shape[0], -1)
+        if self.W_T is not None:
+            numpy.copyto(out, self.W_T.dot(x.T).T)
+        else:
+            gathered = scratch['gathered']
+            numpy.take(x, self.indices, axis=1, out=gathered)
+            gathered *= self.data
+            out[...] = 0.0
+            if len(self.data) > 0:
+                out[:, self.non_empty] = numpy.add.reduceat(
+                    gathered, self.indptr[self.non_empty], axis=1)
+        if self.b is not None:
+            out += self.b
+        self.nonlinearity(out)
+
+
+def _im2col_view(padded, shape, strides):
+    return as_strided(padded, shape=shape, strides=strides)
+
+
+class ConvBC01(GemmOp):
+    """
+    Cross-correlation of bc01 input with (filters, channels, rows, cols)
+    filters. Theano's true convolutions are exported with flipped filters.
+    """
+    def __init__(self, node, arrays):
+        super(ConvBC01, self).__init__(node, arrays)
+        W = self.params['W']
+        self.n_filters, self.n_channels, self.kh, self.kw = W.shape
+        self.W_matrix = numpy.ascontiguousarray(
+            W.reshape(self.n_filters, -1).T, dtype=self.weight_dtype)
+        self.b = self.params.get('b')
+        self.pad = self.attrs.get('pad', [0, 0, 0, 0])
+        self.stride = self.attrs.get('stride', [1, 1])
+
+    def _get_padded_shape(self, input_shape):
+        top, bottom, left, right = self.pad
+        return (input_shape[0], input_shape[1],
+                input_shape[2] + top + bottom, input_shape[3] + left + right)
+
+    def get_output_shape(self, input_shapes):
+        padded_shape = self._get_padded_shape(input_shapes[0])
+        rows = (padded_shape[2] - self.kh) // self.stride[0] + 1
+        cols = (padded_shape[3] - self.kw) // self.stride[1] + 1
+        return (padded_shape[0], self.n_filters, rows, cols)
+
+    def allocate(self, input_shapes):
+        batch, __, rows, cols = self.get_output_shape(input_shapes)
+        scratch = {}
+        if any(self.pad):
+            scratch['padded'] = numpy.zeros(
+                self._get_padded_shape(input_shapes[0]), dtype=numpy.float32)
+        scratch['columns'] = numpy.zeros(
+            (batch, rows, cols, self.n_channels, self.kh, self.kw),
+            dtype=numpy.float32)
+        scratch['product'] = numpy.zeros((batch * rows * cols,
+                                          self.n_filters),
+                                         dtype=numpy.float32)
+        return scratch
+
+    def run(self, inputs, out, scratch):
+        x = self._prepare_input(inputs[0], scratch)
+        if 'padded' in scratch:
+            top, bottom, left, right = self.pad
+            padded = scratch['padded']
+            padded[:, :, top:top + x.shape[2], left:left + x.shape[3]] = x
+            x = padded
+
+        columns = scratch['columns']
+        s_b, s_c, s_r, s_col = x.strides
+        numpy.copyto(columns, _im2col_view(
+            x, columns.shape,
+            (s_b, self.stride[0] * s_r, self.stride[1] * s_col, s_c, s_r,
+             s_col)))
+
+        product = scratch['product']
+        self._gemm(columns.reshape(product.shape[0], -1), self.W_matrix,
+                   product, scratch)
+        numpy.copyto(out, product.reshape(
+            out.shape[0], out.shape[2], out.shape[3],
+            out.shape[1]).transpose(0, 3, 1, 2))
+        if self.b is not None:
+            out += self.b[None, :, None, None]
+        self.nonlinearity(out)
+
+
+def _cc_output_size(size, filter_size, stride, pad):
+    # Output size of the cuda-convnet convolutions.
+    return int(numpy.ceil((size + 2 * pad - filter_size + stride)
+                          * 1.0 / stride))
+
+
+class ConvC01B(GemmOp):
+    """
+    cuda-convnet style convolution of c01b input with (channels, rows, cols,
+    filters) filters, with optional untied biases.
+    """
+    def __init__(self, node, arrays):
+        super(ConvC01B, self).__init__(node, arrays)
+        W = self.params['W']
+        self.n_channels, self.k, __, self.n_filters = W.shape
+        self.W_matrix = numpy.ascontiguousarray(
+            W.reshape(-1, self.n_filters).T, dtype=self.weight_dtype)
+        self.b = self.params.get('b')
+        self.stride = self.attrs.get('stride', 1)
+        self.pad = self.attrs.get('pad', 0)
+
+    def get_output_shape(self, input_shapes):
+        channels, rows, cols, batch = input_shapes[0]
+        return (self.n_filters,
+                _cc_output_size(rows, self.k, self.stride, self.pad),
+                _cc_output_size(cols, self.k, self.stride, self.pad),
+                batch)
+
+    def _get_padded_shape(self, input_shapes):
+        __, rows, cols, batch = self.get_output_shape(input_shapes)
+        return (self.n_channels, (rows - 1) * self.stride + self.k,
+                (cols - 1) * self.stride + self.k, batch)
+
+    def allocate(self, input_shapes):
+        __, rows, cols, batch = self.get_output_shape(input_shapes)
+        scratch = {}
+        padded_shape = self._get_padded_shape(input_shapes)
+        if padded_shape != tuple(input_shapes[0]) or self.pad:
+            scratch['padded'] = numpy.zeros(padded_shape,
+                                            dtype=numpy.float32)
+        scratch['columns'] = numpy.zeros(
+            (self.n_channels, self.k, self.k, rows, cols, batch),
+            dtype=numpy.float32)
+        return scratch
+
+    def run(self, inputs, out, scratch):
+        x = self._prepare_input(inputs[0], scratch)
+        if 'padded' in scratch:
+            padded = scratch['padded']
+            rows = min(x.shape[1], padded.shape[1] - self.pad)
+            cols = min(x.shape[2], padded.shape[2] - self.pad)
+            padded[:, self.pad:self.pad + rows,
+                   self.pad:self.pad + cols, :] = x[:, 0:rows, 0:cols, :]
+            x = padded
+
+        columns = scratch['columns']
+        s_c, s_r, s_col, s_b = x.strides
+        numpy.copyto(columns, _im2col_view(
+            x, columns.shape,
+            (s_c, s_r, s_col, self.stride * s_r, self.stride * s_col, s_b)))
+
+        self._gemm(self.W_matrix, columns.reshape(self.W_matrix.shape[1], -1),
+                   out.reshape(self.n_filters, -1), scratch)
+        if self.b is not None:
+            if self.b.ndim == 3:
+                out += self.b[:, :, :, None]
+            else:
+                out += self.b[:, None, None, None]
+        self.nonlinearity(out)
+
+
+class DeconvC01B(Op):
+    """
+    Transpose of ConvC01B (cuda-convnet's ImageActs), used by the Deconv
+    layers. The bias of the mirrored convolution is subtracted first.
+    """
+    def __init__(self, node, arrays):
+        super(DeconvC01B, self).__init__(node, arrays)
+        W = self.params['W']
+        self.n_channels, self.k, __, self.n_filters = W.shape
+        self.W_matrix = numpy.ascontiguousarray(
+            W.reshape(-1, self.n_filters), dtype=numpy.float32)
+        self.b = self.params.get('b')
+        self.stride = self.attrs['stride']
+        self.pad = self.attrs['pad']
+        self.image_size = self.attrs['image_size']
+
+    def get_output_shape(self, input_shapes):
+        return (self.n_channels, self.image_size[0], self.image_size[1],
+                input_shapes[0][3])
+
+    def allocate(self, input_shapes):
+        __, rows, cols, batch = input_shapes[0]
+        scratch = {}
+        if self.b is not None:
+            scratch['hidden'] = numpy.zeros(input_shapes[0],
+                                            dtype=numpy.float32)
+        scratch['columns'] = numpy.zeros(
+            (self.n_channels, self.k, self.k, rows, cols, batch),
+            dtype=numpy.float32)
+        scratch['padded'] = numpy.zeros(
+            (self.n_channels,
+             max((rows - 1) * self.stride + self.k,
+                 self.image_size[0] + self.pad),
+             max((cols - 1) * self.stride + self.k,
+                 self.image_size[1] + self.pad),
+             batch), dtype=numpy.float32)
+        return scratch
+
+    def run(self, inputs, out, scratch):
+        hidden = inputs[0]
+        if self.b is not None:
+            if self.b.ndim == 3:
+                bias = self.b[:, :, :, None]
+            else:
+                bias = self.b[:, None, None, None]
+            hidden = numpy.subtract(hidden, bias, out=scratch['hidden'])
+
+        columns = scratch['columns']
+        numpy.dot(self.W_matrix, hidden.reshape(self.n_filters, -1),
+                  out=columns.reshape(self.W_matrix.shape[0], -1))
+
+        # col2im: scatter-add every filter tap back into the image
+        padded = scratch['padded']
+        padded[...] = 0.0
+        rows, cols = columns.shape[3], columns.shape[4]
+        s = self.stride
+        for i in xrange(self.k):
+            for j in xrange(self.k):
+                padded[:, i:i + s * rows:s, j:j + s * cols:s, :] += \
+                    columns[:, i, j]
+
+        numpy.copyto(out, padded[:, self.pad:self.pad + self.image_size[0],
+                                 self.pad:self.pad + self.image_size[1], :])
+        self.nonlinearity(out)
+
+
+class MaxPool(Op):
+    """
+    Theano's max_pool_2d: non-overlapping pooling over the last two axes.
+    """
+    def __init__(self, node, arrays):
+        super(MaxPool, self).__init__(node, arrays)
+        self.pool_size = self.attrs['pool_size']
+        self.ignore_border = self.attrs.get('ignore_border', False)
+
+    def get_output_shape(self, input_shapes):
+        shape = list(input_shapes[0])
+        for axis, size in zip([-2, -1], self.pool_size):
+            if self.ignore_border:
+                shape[axis] = shape[axis] // size
+            else:
+                shape[axis] = -(-shape[axis] // size)
+        return tuple(shape)
+
+    def allocate(self, input_shapes):
+        output_shape = self.get_output_shape(input_shapes)
+        padded_shape = (tuple(output_shape[:-2])
+                        + (output_shape[-2] * self.pool_size[0],
+                           output_shape[-1] * self.pool_size[1]))
+        padded = numpy.empty(padded_shape, dtype=numpy.float32)
+        padded.fill(-numpy.inf)
+        return {'padded': padded}
+
+    def run(self, inputs, out, scratch):
+        padded = scratch['padded']
+        rows = min(inputs[0].shape[-2], padded.shape[-2])
+        cols = min(inputs[0].shape[-1], padded.shape[-1])
+        padded[..., 0:rows, 0:cols] = inputs[0][..., 0:rows, 0:cols]
+        windows = padded.reshape(tuple(out.shape[:-2])
+                                 + (out.shape[-2], self.pool_size[0],
+                                    out.shape[-1], self.pool_size[1]))
+        numpy.max(windows, axis=(-3, -1), out=out)
+
+
+class MaxPoolC01B(Op):
+    """
+    cuda-convnet's MaxPool: square, possibly overlapping windows; borders
+    are never ignored.
+    """
+    def __init__(self, node, arrays):
+        super(MaxPoolC01B, self).__init__(node, arrays)
+        self.pool_size = self.attrs['pool_size']
+        self.stride = self.attrs['stride']
+
+    def get_output_shape(self, input_shapes):
+        channels, rows, cols, batch = input_shapes[0]
+        return (channels, _cc_output_size(rows, self.pool_size,
+                                          self.stride, 0),
+                _cc_output_size(cols, self.pool_size, self.stride, 0), batch)
+
+    def allocate(self, input_shapes):
+        channels, rows, cols, batch = self.get_output_shape(input_shapes)
+        padded = numpy.empty((channels,
+                              (rows - 1) * self.stride + self.pool_size,
+                              (cols - 1) * self.stride + self.pool_size,
+                              batch), dtype=numpy.float32)
+        padded.fill(-numpy.inf)
+        return {'padded': padded}
+
+    def run(self, inputs, out, scratch):
+        x = inputs[0]
+        padded = scratch['padded']
+        padded[:, 0:x.shape[1], 0:x.shape[2], :] = x
+        rows, cols = out.shape[1], out.shape[2]
+        s = self.stride
+        out.fill(-numpy.inf)
+        for i in xrange(self.pool_size):
+            for j in xrange(self.pool_size):
+                numpy.maximum(out, padded[:, i:i + s * rows:s,
+                                          j:j + s * cols:s, :], out=out)
+
+
+class UnpoolC01B(Op):
+    """
+    cuda-convnet's MaxPoolGrad: routes every pooled value back to the
+    positions of the pooling input that attained the maximum. Inputs are
+    (pooled values, pooling output, pooling input).
+    """
+    def __init__(self, node, arrays):
+        super(UnpoolC01B, self).__init__(node, arrays)
+        self.pool_size = self.attrs['pool_size']
+        self.stride = self.attrs['stride']
+
+    def get_output_shape(self, input_shapes):
+        return tuple(input_shapes[2])
+
+    def allocate(self, input_shapes):
+        channels, rows, cols, batch = input_shapes[1]
+        padded_shape = (channels, (rows - 1) * self.stride + self.pool_size,
+                        (cols - 1) * self.stride + self.pool_size, batch)
+        padded_input = numpy.empty(padded_shape, dtype=numpy.float32)
+        padded_input.fill(-numpy.inf)
+        return {'padded_input': padded_input,
+                'padded': numpy.zeros(padded_shape, dtype=numpy.float32),
+                'mask': numpy.zeros(input_shapes[1], dtype=numpy.bool_),
+                'routed': numpy.zeros(input_shapes[1], dtype=numpy.float32)}
+
+    def run(self, inputs, out, scratch):
+        values, pooled, pool_input = inputs
+        padded_input = scratch['padded_input']
+        padded_input[:, 0:pool_input.shape[1], 0:pool_input.shape[2], :] = \
+            pool_input
+        padded = scratch['padded']
+        padded[...] = 0.0
+        mask = scratch['mask']
+        routed = scratch['routed']
+
+        rows, cols = pooled.shape[1], pooled.shape[2]
+        s = self.stride
+        for i in xrange(self.pool_size):
+            for j in xrange(self.pool_size):
+                window = (slice(None), slice(i, i + s * rows, s),
+                          slice(j, j + s * cols, s), slice(None))
+                numpy.equal(padded_input[window], pooled, out=mask)
+                numpy.multiply(values, mask, out=routed)
+                padded[window] += routed
+
+        numpy.copyto(out, padded[:, 0:out.shape[1], 0:out.shape[2], :])
+
+
+class GlobalPool(Op):
+    def __init__(self, node, arrays):
+        super(GlobalPool, self).__init__(node, arrays)
+        self.pooling_function = self.attrs['pooling_function']
+
+    def get_output_shape(self, input_shapes):
+        return tuple(input_shapes[0][0:2])
+
+    def run(self, inputs, out, scratch):
+        x = inputs[0]
+        if self.pooling_function == 'mean':
+            numpy.mean(x, axis=(2, 3), out=out)
+        elif self.pooling_function == 'max':
+            numpy.max(x, axis=(2, 3), out=out)
+        elif self.pooling_function == 'l2':
+            numpy.mean(x ** 2, axis=(2, 3), out=out)
+            numpy.sqrt(out, out=out)
+        self.nonlinearity(out)
+
+
+class WindowPool(Op):
+    """
+    Pooling over every window of a fixed size with stride 1, i.e. a global
+    pooling layer slid over a larger bc01 input.
+    """
+    def __init__(self, node, arrays):
+        super(WindowPool, self).__init__(node, arrays)
+        self.pooling_function = self.attrs['pooling_function']
+        self.window = self.attrs['window']
+
+    def get_output_shape(self, input_shapes):
+        batch, channels, rows, cols = input_shapes[0]
+        return (batch, channels, rows - self.window[0] + 1,
+                cols - self.window[1] + 1)
+
+    def run(self, inputs, out, scratch):
+        x = inputs[0]
+        if self.pooling_function == 'l2':
+            x = x ** 2
+        windows = as_strided(x, shape=out.shape + tuple(self.window),
+                             strides=x.strides + x.strides[2:])
+        if self.pooling_function == 'max':
+            numpy.max(windows, axis=(4, 5), out=out)
+        else:
+            numpy.mean(windows, axis=(4, 5), out=out)
+        if self.pooling_function == 'l2':
+            numpy.sqrt(out, out=out)
+        self.nonlinearity(out)
+
+
+class Transpose(Op):
+    def __init__(self, node, arrays):
+        super(Transpose, self).__init__(node, arrays)
+        self.axes = self.attrs['axes']
+
+    def get_output_shape(self, input_shapes):
+        return tuple([input_shapes[0][axis] for axis in self.axes])
+
+    def run(self, inputs, out, scratch):
+        numpy.copyto(out, inputs[0].transpose(self.axes))
+
+
+class Concatenate(Op):
+    # Along axis 1, for flat outputs as well as bc01 score maps
+    def get_output_shape(self, input_shapes):
+        shape = list(input_shapes[0])
+        shape[1] = sum([input_shape[1] for input_shape in input_shapes])
+        return tuple(shape)
+
+    def run(self, inputs, out, scratch):
+        start = 0
+        for x in inputs:
+            out[:, start:start + x.shape[1]] = x
+            start += x.shape[1]
+
+
+# int8 ops, written by anna.inference.quantize
+
+# Products of int8 values summed over at most this many terms are exact in
+# float32 (256 * 127 * 127 < 2 ** 24). It is also the number of rows of int8
+# weights converted to float32 at a time.
+INT8_BLOCK_SIZE = 256
+
+
+def quantize(x, scale, out):
+    """
+    Symmetric int8 quantization of x with the given scale. The int8 values
+    are written to out, which can be float32.
+    """
+    numpy.multiply(x, 1.0 / scale, out=out)
+    numpy.rint(out, out=out)
+    numpy.clip(out, -127, 127, out=out)
+    return out
+
+
+def _as_float32(x, buffer=None):
+    # x if it is float32, else x converted into the start of the flat
+    # float32 buffer (or a new array without one)
+    if x.dtype == numpy.float32:
+        return x
+    if buffer is None:
+        return x.astype(numpy.float32)
+    converted = buffer[0:x.size].reshape(x.shape)
+    numpy.copyto(converted, x)
+    return converted
+
+
+def int8_dot(a, b, out, accumulator=None, buffer=None,
+             block_size=INT8_BLOCK_SIZE):
+    """
+    Exact product of two matrices holding int8 values, int8 arrays or
+    float32 ones, written to the float32 array out.
+
+    NumPy has no int8 GEMM, so the inner dimension is split into blocks
+    small enough for a float32 BLAS product to be exact. int8 operands are
+    converted one block at a time into buffer (a flat float32 array with
+    room for a block), and the block products are accumulated in the int32
+    array accumulator.
+    """
+    num_inner = a.shape[1]
+    if num_inner <= block_size:
+        numpy.dot(_as_float32(a, buffer), _as_float32(b, buffer), out=out)
+        return out
+
+    if accumulator is None:
+        accumulator = numpy.zeros(out.shape, dtype=numpy.int32)
+    accumulator[...] = 0
+    for start in xrange(0, num_inner, block_size):
+        stop = min(start + block_size, num_inner)
+        numpy.dot(_as_float32(a[:, start:stop], buffer),
+                  _as_float32(b[start:stop], buffer), out=out)
+        numpy.add(accumulator, out, out=accumulator, casting='unsafe')
+    numpy.copyto(out, accumulator, casting='unsafe')
+    return out
+
+
+class Int8GemmOp(GemmOp):
+    """
+    Base of the int8 dense and convolution ops: the weights are stored as
+    int8 with one scale per output channel ('scale'), the input is quantized
+    with the calibrated attrs['input_scale'], and the int32 products are
+    rescaled to float32 before the bias and the nonlinearity.
+
+    The weights stay int8 in memory, a quarter of their float32 size, plus
+    one float32 buffer for INT8_BLOCK_SIZE rows of them. The only fast
+    matrix product in NumPy is the float BLAS one, so int8_dot converts the
+    weights a block at a time and multiplies the blocks in float32: the
+    results are those of an int8 kernel, but the throughput is that of
+    float32 products over short inner dimensions plus the conversion, i.e.
+    somewhat below the float32 model's.
+    """
+    weight_dtype = numpy.int8
+
+    def _get_output_scale(self):
+        return (self.attrs['input_scale'] *
+                numpy.asarray(self.params['scale'], dtype=numpy.float32))
+
+    def _allocate_weight_buffer(self, weights, num_inner):
+        # Room for INT8_BLOCK_SIZE rows (along the inner dimension) of the
+        # weights in float32
+        self.weight_buffer = numpy.empty(
+            weights.size // num_inner * min(num_inner, INT8_BLOCK_SIZE),
+            dtype=numpy.float32)
+
+    def allocate(self, input_shapes):
+        scratch = super(Int8GemmOp, self).allocate(input_shapes)
+        scratch['quantized'] = numpy.zeros(input_shapes[0],
+                                           dtype=numpy.float32)
+        return scratch
+
+    def _prepare_input(self, x, scratch):
+        return quantize(x, self.attrs['input_scale'], scratch['quantized'])
+
+    def _gemm(self, a, b, out, scratch):
+        accumulator = scratch.get('accumulator')
+        if a.shape[1] > INT8_BLOCK_SIZE and accumulator is None:
+            accumulator = numpy.zeros(out.shape, dtype=numpy.int32)
+            scratch['accumulator'] = accumulator
+        int8_dot(a, b, out, accumulator, self.weight_buffer)
+        out *= self.output_scale
+
+
+class DenseInt8(Int8GemmOp, Dense):
+    def __init__(self, node, arrays):
+        super(DenseInt8, self).__init__(node, arrays)
+        self.output_scale = self._get_output_scale()[None, :]
+        self._allocate_weight_buffer(self.W, self.W.shape[0])
+
+
+class ConvBC01Int8(Int8GemmOp, ConvBC01):
+    def __init__(self, node, arrays):
+        super(ConvBC01Int8, self).__init__(node, arrays)
+        self.output_scale = self._get_output_scale()[None, :]
+        self._allocate_weight_buffer(self.W_matrix, self.W_matrix.shape[0])
+
+
+class ConvC01BInt8(Int8GemmOp, ConvC01B):
+    def __init__(self, node, arrays):
+        super(ConvC01BInt8, self).__init__(node, arrays)
+        self.output_scale = self._get_output_scale()[:, None]
+        self._allocate_weight_buffer(self.W_matrix, self.W_matrix.shape[1])
+
+
+OPS = {
+    'dense': Dense,
+    'dense_csr': DenseCSR,
+    'conv_bc01': ConvBC01,
+    'conv_c01b': ConvC01B,
+    'deconv_c01b': DeconvC01B,
+    'max_pool': MaxPool,
+    'max_pool_c01b': MaxPoolC01B,
+    'unpool_c01b': UnpoolC01B,
+    'global_pool': GlobalPool,
+    'window_pool': WindowPool,
+    'transpose': Transpose,
+    'concatenate': Concatenate,
+    'dense_int8': DenseInt8,
+    'conv_bc01_int8': ConvBC01Int8,
+    'conv_c01b_int8': ConvC01BInt8,
+}
+
+
+class InferenceModel(object):
+    """
+    Executes an exported layer graph. predict takes a batch laid out like
+    the input of the original model (see data_order) and returns the output
+    of its last layer.
+    """
+    def __init__(self, graph, arrays, max_plans=4):
+        self.graph = graph
+        self.input_name = graph['input']['name']
+        self.data_order = graph['input']['data_order']
+        self.output_name = graph['output']
+        self.max_plans = max_plans
+
+        self.nodes = []
+        for node in graph['nodes']:
+            op_class = OPS.get(node['type'])
+            if op_class is None:
+                raise RuntimeError("Invalid node type: '%s'" % node['type'])
+            self.nodes.append((node['name'], op_class(node, arrays),
+                               node['inputs']))
+
+        # Plans (buffers for one input shape), most recently used last
+        self.plans = []
+
+    def predict(self, x, callback=None):
+        """
+        If given, callback(name, inputs, output) is called after every node,
+        e.g. to collect activation statistics.
+        """
+        x = numpy.asarray(x, dtype=numpy.float32)
+        plan = self._get_plan(x.shape)
+        activations = {self.input_name: x}
+        for name, op, input_names, out, scratch in plan:
+            inputs = [activations[i] for i in input_names]
+            op.run(inputs, out, scratch)
+            activations[name] = out
+            if callback is not None:
+                callback(name, inputs, out)
+        return activations[self.output_name].copy()
+
+    def _get_plan(self, input_shape):
+        for i, (shape, plan) in enumerate(self.plans):
+            if shape == input_shape:
+                self.plans.append(self.plans.pop(i))
+                return plan
+
+        plan = self._make_plan(input_shape)
+        self.plans.append((input_shape, plan))
+        if len(self.plans) > self.max_plans:
+            self.plans.pop(0)
+        return plan
+
+    def get_shapes(self, input_shape):
+        """
+        Returns the output shape of every node for the given input shape.
+        """
+        shapes = {self.input_name: tuple(input_shape)}
+        for name, op, input_names in self.nodes:
+            shapes[name] = tuple(op.get_output_shape(
+                [shapes[n] for n in input_names]))
+        return shapes
+
+    def get_input_shape(self, batch_size):
+        input_shape = list(self.graph['input']['shape'])
+        if self.data_order == 'c01b':
+            return tuple(input_shape + [batch_size])
+        return tuple([batch_size] + input_shape)
+
+    def _make_plan(self, input_shape):
+        shapes = self.get_shapes(input_shape)
+        last_use = {}
+        for i, (name, op, input_names) in enumerate(self.nodes):
+            for n in input_names:
+                last_use[n] = i
+
+        # Activation buffers are recycled once the node that needs them
+        # last has run. The output buffer is never recycled.
+        free_buffers = []
+        plan = []
+        for i, (name, op, input_names) in enumerate(self.nodes):
+            out = None
+            for j, free_buffer in enumerate(free_buffers):
+                if free_buffer.shape == shapes[name]:
+                    out = free_buffers.pop(j)
+                    break
+            if out is None:
+                out = numpy.zeros(shapes[name], dtype=numpy.float32)
+            scratch = op.allocate([shapes[n] for n in input_names])
+            plan.append((name, op, input_names, out, scratch))
+
+            for n in set(input_names):
+                if (last_use[n] == i and n != self.input_name and
+                        n != self.output_name):
+                    free_buffers.append([p[3] for p in plan
+                                         if p[0] == n][0])
+        return plan
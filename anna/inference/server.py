@@ -0,0 +1,313 @@
+"""
+Local inference server that groups single-sample requests into batches.
+
+Requests are queued by a MicroBatcher, which runs a batch as soon as
+max_batch_size samples are waiting or the oldest one has waited max_delay
+seconds, and hands every caller its own row of the output. InferenceServer
+exposes a batcher on a Unix socket; InferenceClient talks to it.
+
+A Theano model is served with its dropout-free prediction:
+
+    batcher = MicroBatcher(model.deterministic_prediction, model.batch,
+                           batch_axis=layers.batch_axis(model.input),
+                           pad_batches=layers.has_static_batch(model.output))
+
+and an exported model with runtime.load(path).predict.
+"""
+import io
+import json
+import os
+import socket
+import struct
+import threading
+import Queue
+import SocketServer
+from time import time
+
+import numpy
+
+REQUEST_PREDICT = 0
+REQUEST_STATS = 1
+RESPONSE_OK = 0
+RESPONSE_ERROR = 1
+
+
+class LatencyHistogram(object):
+    """
+    Thread-safe histogram of latencies (in seconds) with logarithmically
+    spaced buckets from min_latency to max_latency.
+    """
+    def __init__(self, min_latency=1e-5, max_latency=100.0,
+                 buckets_per_decade=20):
+        num_buckets = int(numpy.log10(max_latency / min_latency)
+                          * buckets_per_decade) + 1
+        self.edges = numpy.logspace(numpy.log10(min_latency),
+                                    numpy.log10(max_latency), num_buckets)
+        self.counts = numpy.zeros(num_buckets + 1, dtype=numpy.int64)
+        self.total = 0.0
+        self.lock = threading.Lock()
+
+    def record(self, latency):
+        bucket = numpy.searchsorted(self.edges, latency)
+        with self.lock:
+            self.counts[bucket] += 1
+            self.total += latency
+
+    def reset(self):
+        with self.lock:
+            self.counts[...] = 0
+            self.total = 0.0
+
+    def count(self):
+        return int(self.counts.sum())
+
+    def percentile(self, p):
+        # Upper edge of the bucket holding the p-th percentile
+        with self.lock:
+            counts = self.counts.copy()
+        if counts.sum() == 0:
+            return 0.0
+        bucket = numpy.searchsorted(numpy.cumsum(counts),
+                                    p / 100.0 * counts.sum())
+        return float(self.edges[min(bucket, len(self.edges) - 1)])
+
+    def summary(self):
+        num_samples = self.count()
+        return {'count': num_samples,
+                'mean': self.total / max(num_samples, 1),
+                'p50': self.percentile(50),
+                'p90': self.percentile(90),
+                'p99': self.percentile(99)}
+
+
+class Request(object):
+    def __init__(self, sample):
+        self.sample = sample
+        self.submit_time = time()
+        self.output = None
+        self.error = None
+        self.done = threading.Event()
+
+    def get(self):
+        self.done.wait()
+        if self.error is not None:
+            raise RuntimeError(self.error)
+        return self.output
+
+
+class MicroBatcher(object):
+    """
+    Runs predict_func on batches of queued samples in a background thread.
+
+    Samples are stacked along batch_axis (3 for c01b models) into a buffer
+    allocated once; outputs are split along output_batch_axis. With
+    pad_batches, partial batches are zero-padded to max_batch_size for
+    models compiled with a fixed minibatch size.
+    """
+    def __init__(self, predict_func, max_batch_size, max_delay=0.005,
+                 batch_axis=0, output_batch_axis=0, pad_batches=False):
+        self.predict_func = predict_func
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.batch_axis = batch_axis
+        self.output_batch_axis = output_batch_axis
+        self.pad_batches = pad_batches
+
+        self.queue = Queue.Queue()
+        self.buffer = None
+        self.latencies = LatencyHistogram()
+        self.batch_sizes = numpy.zeros(max_batch_size + 1, dtype=numpy.int64)
+
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, sample):
+        request = Request(numpy.asarray(sample, dtype=numpy.float32))
+        self.queue.put(request)
+        return request
+
+    def predict(self, sample):
+        return self.submit(sample).get()
+
+    def stop(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def stats(self):
+        stats = self.latencies.summary()
+        num_batches = self.batch_sizes.sum()
+        stats['batches'] = int(num_batches)
+        stats['mean_batch_size'] = float(
+            numpy.dot(numpy.arange(len(self.batch_sizes)), self.batch_sizes)
+            / float(max(num_batches, 1)))
+        return stats
+
+    def _collect(self):
+        request = self.queue.get()
+        if request is None:
+            return None
+        requests = [request]
+        deadline = request.submit_time + self.max_delay
+        while len(requests) < self.max_batch_size:
+            timeout = deadline - time()
+            try:
+                if timeout > 0:
+                    request = self.queue.get(timeout=timeout)
+                else:
+                    request = self.queue.get_nowait()
+            except Queue.Empty:
+                break
+            if request is None:
+                # Serve what was collected, then stop
+                self.queue.put(None)
+                break
+            requests.append(request)
+        return requests
+
+    def _get_batch(self, requests):
+        sample_shape = requests[0].sample.shape
+        batch_shape = list(sample_shape)
+        batch_shape.insert(self.batch_axis, self.max_batch_size)
+        if self.buffer is None or self.buffer.shape != tuple(batch_shape):
+            self.buffer = numpy.zeros(batch_shape, dtype=numpy.float32)
+
+        index = [slice(None)] * len(batch_shape)
+        for i, request in enumerate(requests):
+            index[self.batch_axis] = i
+            self.buffer[tuple(index)] = request.sample
+
+        if self.pad_batches:
+            index[self.batch_axis] = slice(len(requests), None)
+            self.buffer[tuple(index)] = 0.0
+            return self.buffer
+        index[self.batch_axis] = slice(0, len(requests))
+        return self.buffer[tuple(index)]
+
+    def _run(self):
+        while True:
+            requests = self._collect()
+            if requests is None:
+                return
+            try:
+                outputs = self.predict_func(self._get_batch(requests))
+                outputs = numpy.rollaxis(numpy.asarray(outputs),
+                                         self.output_batch_axis)
+                for request, output in zip(requests, outputs):
+                    request.output = output.copy()
+            except Exception as e:
+                for request in requests:
+                    request.error = '%s: %s' % (type(e).__name__, e)
+
+            self.batch_sizes[len(requests)] += 1
+            for request in requests:
+                self.latencies.record(time() - request.submit_time)
+                request.done.set()
+
+
+# Wire format: every message is a 4 byte length followed by one type byte
+# and the payload, arrays in .npy format and stats as JSON.
+
+
+def _recv_exact(sock, num_bytes):
+    chunks = []
+    while num_bytes > 0:
+        chunk = sock.recv(num_bytes)
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        num_bytes -= len(chunk)
+    return ''.join(chunks)
+
+
+def send_message(sock, message_type, payload):
+    sock.sendall(struct.pack('!IB', len(payload), message_type) + payload)
+
+
+def recv_message(sock):
+    header = _recv_exact(sock, 5)
+    if header is None:
+        return None, None
+    length, message_type = struct.unpack('!IB', header)
+    payload = _recv_exact(sock, length) if length > 0 else ''
+    return message_type, payload
+
+
+def array_to_bytes(array):
+    f = io.BytesIO()
+    numpy.save(f, array)
+    return f.getvalue()
+
+
+def bytes_to_array(payload):
+    return numpy.load(io.BytesIO(payload))
+
+
+class _RequestHandler(SocketServer.BaseRequestHandler):
+    # One connection can send any number of requests
+    def handle(self):
+        batcher = self.server.batcher
+        while True:
+            message_type, payload = recv_message(self.request)
+            if message_type is None:
+                return
+            if message_type == REQUEST_STATS:
+                send_message(self.request, RESPONSE_OK,
+                             json.dumps(batcher.stats()))
+                continue
+            try:
+                output = batcher.predict(bytes_to_array(payload))
+                send_message(self.request, RESPONSE_OK,
+                             array_to_bytes(output))
+            except Exception as e:
+                send_message(self.request, RESPONSE_ERROR, str(e))
+
+
+class InferenceServer(SocketServer.ThreadingMixIn,
+                      SocketServer.UnixStreamServer):
+    """
+    Serves a MicroBatcher on a Unix socket, one thread per connection.
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path, batcher):
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        SocketServer.UnixStreamServer.__init__(self, socket_path,
+                                               _RequestHandler)
+        self.batcher = batcher
+
+    def start(self):
+        # Serve in a background thread
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.batcher.stop()
+        os.remove(self.server_address)
+
+
+class InferenceClient(object):
+    def __init__(self, socket_path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(socket_path)
+
+    def predict(self, sample):
+        send_message(self.sock, REQUEST_PREDICT,
+                     array_to_bytes(numpy.asarray(sample,
+                                                  dtype=numpy.float32)))
+        message_type, payload = recv_message(self.sock)
+        if message_type == RESPONSE_ERROR:
+            raise RuntimeError(payload)
+        return bytes_to_array(payload)
+
+    def stats(self):
+        send_message(self.sock, REQUEST_STATS, '')
+        message_type, payload = recv_message(self.sock)
+        return json.loads(payload)
+
+    def close(self):
+        self.sock.close()
@@ -0,0 +1,204 @@
+"""
+Dense (fully-convolutional) inference of exported patch classifiers.
+
+convolutionize rewrites the head of an exported graph so that it accepts
+inputs larger than the patches it was trained on: a Dense layer on top of a
+feature map becomes a convolution with the size of that map, later Dense
+layers become 1x1 convolutions and a global pooling layer becomes a pooling
+window. Running the rewritten graph on a large image yields the score map
+of all patches at multiples of the network's total stride in one pass,
+sharing the convolutions of overlapping patches.
+
+The score map matches patch-wise predictions exactly when the convolutions
+are unpadded ('valid', pad=0) and the pooling windows of a patch cover it
+exactly; otherwise patches differ at their borders.
+"""
+import json
+
+import numpy
+
+from anna.inference import runtime
+
+C01B_TYPES = ['conv_c01b', 'conv_c01b_int8', 'deconv_c01b', 'max_pool_c01b',
+              'unpool_c01b']
+
+
+def get_total_stride(graph):
+    """
+    Returns the (rows, cols) distance, in input pixels, between neighbouring
+    positions of the score map.
+    """
+    stride = numpy.array([1, 1])
+    for node in graph['nodes']:
+        attrs = node.get('attrs', {})
+        if node['type'] in ['conv_bc01', 'conv_bc01_int8']:
+            stride *= attrs.get('stride', [1, 1])
+        elif node['type'] in ['conv_c01b', 'conv_c01b_int8',
+                              'max_pool_c01b']:
+            stride *= attrs.get('stride', 1)
+        elif node['type'] == 'max_pool':
+            stride *= attrs['pool_size']
+    return tuple([int(s) for s in stride])
+
+
+def _dense_to_conv(node, arrays, new_arrays, input_shape):
+    # input_shape is the bc01 (or flat) shape feeding the Dense layer for
+    # one patch. Flattening bc01 orders the weights as (channels, rows, cols)
+    if len(input_shape) == 4:
+        kernel_shape = input_shape[1:]
+    else:
+        kernel_shape = (input_shape[1], 1, 1)
+
+    params = dict(node['params'])
+    if node['type'] == 'dense_csr':
+        n_inputs, n_outputs = node['attrs']['shape']
+        W = numpy.zeros((n_outputs, n_inputs), dtype=numpy.float32)
+        data = arrays[params.pop('data')]
+        indices = arrays[params.pop('indices')]
+        indptr = arrays[params.pop('indptr')]
+        for i in xrange(n_outputs):
+            W[i, indices[indptr[i]:indptr[i + 1]]] = \
+                data[indptr[i]:indptr[i + 1]]
+        W = W.T
+        W_key = node['name'] + '_W'
+        node['type'] = 'conv_bc01'
+    else:
+        W_key = params['W']
+        W = arrays[W_key]
+        W_key = W_key + '_conv'
+        if node['type'] == 'dense_int8':
+            node['type'] = 'conv_bc01_int8'
+        else:
+            node['type'] = 'conv_bc01'
+
+    new_arrays[W_key] = numpy.ascontiguousarray(
+        W.T.reshape((W.shape[1],) + tuple(kernel_shape)))
+    params['W'] = W_key
+    node['params'] = params
+    attrs = dict(node.get('attrs', {}))
+    attrs.pop('shape', None)
+    attrs['pad'] = [0, 0, 0, 0]
+    attrs['stride'] = [1, 1]
+    node['attrs'] = attrs
+
+
+def convolutionize(graph, arrays):
+    """
+    Returns a copy of (graph, arrays) whose Dense and GlobalPooling2D
+    layers are rewritten as convolutions and pooling windows (see above),
+    together with the data order of its output.
+    """
+    inference_model = runtime.InferenceModel(graph, arrays)
+    shapes = inference_model.get_shapes(inference_model.get_input_shape(1))
+
+    graph = json.loads(json.dumps(graph))
+    new_arrays = dict(arrays)
+    if inference_model.data_order == 'c01b':
+        orders = {graph['input']['name']: 'c01b'}
+    else:
+        orders = {graph['input']['name']: 'bc01'}
+
+    for node in graph['nodes']:
+        input_name = node['inputs'][0]
+        input_shape = shapes[input_name]
+        order = orders[input_name]
+
+        if node['type'] in ['dense', 'dense_int8', 'dense_csr']:
+            if order == 'c01b':
+                raise RuntimeError('Dense layer %s takes c01b input, add a '
+                                   'shuffle layer before it.' % node['name'])
+            _dense_to_conv(node, arrays, new_arrays, input_shape)
+            order = 'bc01'
+        elif node['type'] == 'global_pool':
+            node['type'] = 'window_pool'
+            node['attrs']['window'] = [int(s) for s in input_shape[2:4]]
+        elif node['type'] in C01B_TYPES:
+            order = 'c01b'
+        elif node['type'] == 'transpose':
+            if node['attrs']['axes'] == [3, 0, 1, 2]:
+                order = 'bc01'
+            else:
+                order = 'c01b'
+        orders[node['name']] = order
+
+    used_keys = set()
+    for node in graph['nodes']:
+        used_keys.update(node.get('params', {}).values())
+    new_arrays = dict([(key, value) for key, value in new_arrays.items()
+                       if key in used_keys])
+    graph['output_data_order'] = orders[graph['output']]
+    return graph, new_arrays
+
+
+class SlidingWindowPredictor(object):
+    """
+    Computes the score map of a patch classifier over images of any size.
+
+    The image is processed in tiles of (at most) tile_size x tile_size score
+    map positions, each tile reading only the pixels its patches cover, so
+    images and score maps can be memory-mapped arrays larger than memory.
+    """
+    def __init__(self, graph, arrays, tile_size=32):
+        self.patch_size = tuple(graph['input']['shape'][1:3])
+        self.stride = get_total_stride(graph)
+        graph, arrays = convolutionize(graph, arrays)
+        self.output_data_order = graph['output_data_order']
+        self.inference_model = runtime.InferenceModel(graph, arrays)
+        self.tile_size = tile_size
+
+    def get_output_shape(self, image_shape):
+        """
+        Shape of the (channels, rows, cols) score map of a (channels, rows,
+        cols) image.
+        """
+        rows = (image_shape[1] - self.patch_size[0]) // self.stride[0] + 1
+        cols = (image_shape[2] - self.patch_size[1]) // self.stride[1] + 1
+        output_shape = self.inference_model.get_shapes(
+            self._get_input_shape((image_shape[0],) + self.patch_size))
+        num_outputs = output_shape[self.inference_model.output_name]
+        if self.output_data_order == 'c01b':
+            return (num_outputs[0], rows, cols)
+        return (num_outputs[1], rows, cols)
+
+    def get_patch_origin(self, row, col):
+        # Top left pixel of the patch scored at a position of the score map
+        return row * self.stride[0], col * self.stride[1]
+
+    def predict(self, image, out=None):
+        """
+        Returns the score map of one (channels, rows, cols) image, written
+        into out if given.
+        """
+        output_shape = self.get_output_shape(image.shape)
+        if out is None:
+            out = numpy.zeros(output_shape, dtype=numpy.float32)
+
+        for row in xrange(0, output_shape[1], self.tile_size):
+            for col in xrange(0, output_shape[2], self.tile_size):
+                num_rows = min(self.tile_size, output_shape[1] - row)
+                num_cols = min(self.tile_size, output_shape[2] - col)
+                top, left = self.get_patch_origin(row, col)
+                bottom = top + (num_rows - 1) * self.stride[0] + \
+                    self.patch_size[0]
+                right = left + (num_cols - 1) * self.stride[1] + \
+                    self.patch_size[1]
+
+                tile = numpy.asarray(image[:, top:bottom, left:right],
+                                     dtype=numpy.float32)
+                if self.inference_model.data_order == 'c01b':
+                    tile = tile[..., None]
+                else:
+                    tile = tile[None]
+                scores = self.inference_model.predict(tile)
+                if self.output_data_order == 'c01b':
+                    scores = scores[..., 0]
+                else:
+                    scores = scores[0]
+                out[:, row:row + num_rows, col:col + num_cols] = \
+                    scores[:, 0:num_rows, 0:num_cols]
+        return out
+
+    def _get_input_shape(self, image_shape):
+        if self.inference_model.data_order == 'c01b':
+            return tuple(image_shape) + (1,)
+        return (1,) + tuple(image_shape)
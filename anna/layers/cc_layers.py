@@ -67,9 +67,11 @@ class DropoutLayer(object):
         return self.input_shape
 
     def output(self, input=None, dropout_active=True, *args, **kwargs):
-        input = self.input_layer.output()
+        if input is None:
+            input = self.input_layer.output(dropout_active=dropout_active,
+                                            *args, **kwargs)
 
-        if self.dropout > 0.:
+        if dropout_active and (self.dropout > 0.):
             retain_prob = 1 - self.dropout
             mask = layers.srng.binomial(input.shape, p=retain_prob,
                                         dtype='int32').astype('float32')
@@ -638,9 +640,9 @@ class Unpooling2DLayer(object):
         return shape
 
     def output(self, *args, **kwargs):
-        input = self.input_layer.output()
-        max_out = self.pooling_layer.output()
-        orig_input = self.pooling_layer.input_layer.output()
+        input = self.input_layer.output(*args, **kwargs)
+        max_out = self.pooling_layer.output(*args, **kwargs)
+        orig_input = self.pooling_layer.input_layer.output(*args, **kwargs)
         return self.unpool_op(orig_input, max_out, input)
 
 
@@ -61,6 +61,24 @@ def all_layers(layer):
         return [layer] + all_layers(layer.input_layer)
 
 
+def batch_axis(layer):
+    """
+    Index of the minibatch dimension in the output of the given layer.
+    """
+    if getattr(layer, 'data_order', None) == data_order.type2:
+        return 3
+    return 0
+
+
+def has_static_batch(layer):
+    """
+    True if some layer below the given layer (including the given layer)
+    bakes the minibatch size into its graph, in which case the compiled
+    functions only accept minibatches of exactly mb_size samples.
+    """
+    return any([getattr(l, 'static_batch', False) for l in all_layers(layer)])
+
+
 def all_parameters(layer):
     """
     Recursive function to gather all parameters, starting from the output layer
@@ -126,15 +144,48 @@ def gather_rescaling_updates(layer, c):
         return updates + gather_rescaling_updates(layer.input_layer, c)
 
 
-def get_param_values(layer):
+def get_param_values(layer, dtype=None):
+    """
+    Host copies of all parameters. Passing dtype=numpy.float16 halves the
+    memory taken by snapshots; the shared variables themselves (the master
+    weights used for training) keep their dtype.
+    """
     params = all_parameters(layer)
-    return [p.get_value() for p in params]
+    if dtype is None:
+        return [p.get_value() for p in params]
+    return [numpy.asarray(p.get_value(), dtype=dtype) for p in params]
 
 
 def set_param_values(layer, param_values):
+    # Values stored in a lower precision are upcast to the parameter's dtype
     params = all_parameters(layer)
     for p, pv in zip(params, param_values):
-        p.set_value(pv)
+        p.set_value(numpy.asarray(pv, dtype=p.dtype))
+
+
+def get_flat_param_values(all_parameters, out=None):
+    """
+    Copies the values of the parameters into one contiguous vector (out,
+    if given), e.g. to snapshot, average or send all parameters at once.
+    """
+    sizes = [p.get_value(borrow=True).size for p in all_parameters]
+    if out is None:
+        out = numpy.empty(sum(sizes), dtype=all_parameters[0].dtype)
+    offset = 0
+    for p, size in zip(all_parameters, sizes):
+        out[offset:offset + size] = p.get_value(borrow=True).ravel()
+        offset += size
+    return out
+
+
+def set_flat_param_values(all_parameters, flat_values):
+    offset = 0
+    for p in all_parameters:
+        shape = p.get_value(borrow=True).shape
+        size = int(numpy.prod(shape))
+        p.set_value(numpy.asarray(flat_values[offset:offset + size],
+                                  dtype=p.dtype).reshape(shape))
+        offset += size
 
 
 def reset_all_params(layer):
@@ -143,8 +194,94 @@ def reset_all_params(layer):
             l.reset_params()
 
 
+def set_param_mask(param, mask):
+    """
+    Attaches a 0/1 mask to a parameter (in its tag) and applies it. Update
+    generators multiply the new values of masked parameters with their
+    mask, so masked entries stay zero during training. The mask is a shared
+    variable, so it can be changed without recompiling.
+    """
+    mask = numpy.asarray(mask, dtype=param.dtype)
+    if hasattr(param.tag, 'mask'):
+        param.tag.mask.set_value(mask)
+    else:
+        param.tag.mask = theano.shared(mask)
+    param.set_value(param.get_value() * mask)
+
+
+def get_param_mask(param):
+    return getattr(param.tag, 'mask', None)
+
+
+def apply_param_masks(updates):
+    masked_updates = []
+    for param, new_value in updates:
+        mask = get_param_mask(param)
+        if mask is not None:
+            new_value = new_value * mask
+        masked_updates.append((param, new_value))
+    return masked_updates
+
+
+def get_ema_shadow(param):
+    return getattr(param.tag, 'ema_shadow', None)
+
+
+def apply_ema(updates, all_parameters, decay):
+    """
+    Adds updates keeping an exponential moving average of every parameter
+    in all_parameters, computed from its new value, so the average is
+    maintained by the same compiled training step. The shadow variables
+    are kept in the parameters' tags and reused when the model is
+    recompiled. With decay=None the updates are returned unchanged.
+    """
+    if decay is None:
+        return updates
+    new_values = dict([(id(param), new_value)
+                       for param, new_value in updates])
+    ema_updates = []
+    for param in all_parameters:
+        if id(param) not in new_values:
+            continue
+        new_value = new_values.pop(id(param))
+        shadow = get_ema_shadow(param)
+        if shadow is None:
+            shadow = theano.shared(param.get_value())
+            param.tag.ema_shadow = shadow
+        ema_updates.append((shadow, decay * shadow +
+                            (1 - decay) * new_value))
+    return updates + ema_updates
+
+
+def gen_ema_swap_function(all_parameters):
+    # Compiled function exchanging the parameters with their EMA shadows on
+    # the device. Calling it twice restores the original parameters.
+    updates = []
+    seen = set()
+    for param in all_parameters:
+        shadow = get_ema_shadow(param)
+        if shadow is not None and id(param) not in seen:
+            seen.add(id(param))
+            updates.append((param, shadow))
+            updates.append((shadow, param))
+    return theano.function([], [], updates=updates)
+
+
+def gen_copy_function(destinations, sources):
+    # Compiled function that copies the shared variables in sources into
+    # destinations where they live (e.g. on the GPU), without going through
+    # host memory
+    updates = []
+    seen = set()
+    for destination, source in zip(destinations, sources):
+        if id(destination) not in seen:
+            seen.add(id(destination))
+            updates.append((destination, source))
+    return theano.function([], [], updates=updates)
+
+
 def gen_updates_regular_momentum(loss, all_parameters, learning_rate, momentum,
-                                 weight_decay):
+                                 weight_decay, ema_decay=None):
     all_grads = [theano.grad(loss, param) for param in all_parameters]
     updates = []
     for param_i, grad_i in zip(all_parameters, all_grads):
@@ -153,14 +290,14 @@ def gen_updates_regular_momentum(loss, all_parameters, learning_rate, momentum,
              - learning_rate * grad_i)
         updates.append((mparam_i, v))
         updates.append((param_i, param_i + v))
-    return updates
+    return apply_ema(apply_param_masks(updates), all_parameters, ema_decay)
 
 
 # using the alternative formulation of nesterov momentum described at
 # https://github.com/lisa-lab/pylearn2/pull/136
 # such that the gradient can be evaluated at the current parameters.
 def gen_updates_nesterov_momentum(loss, all_parameters, learning_rate,
-                                  momentum, weight_decay):
+                                  momentum, weight_decay, ema_decay=None):
     all_grads = [theano.grad(loss, param) for param in all_parameters]
     updates = []
     for param_i, grad_i in zip(all_parameters, all_grads):
@@ -172,18 +309,19 @@ def gen_updates_nesterov_momentum(loss, all_parameters, learning_rate,
         w = param_i + momentum * v - learning_rate * full_grad
         updates.append((mparam_i, v))
         updates.append((param_i, w))
-    return updates
+    return apply_ema(apply_param_masks(updates), all_parameters, ema_decay)
 
 
-def gen_updates_sgd(loss, all_parameters, learning_rate):
+def gen_updates_sgd(loss, all_parameters, learning_rate, ema_decay=None):
     all_grads = [theano.grad(loss, param) for param in all_parameters]
     updates = []
     for param_i, grad_i in zip(all_parameters, all_grads):
         updates.append((param_i, param_i - learning_rate * grad_i))
-    return updates
+    return apply_ema(apply_param_masks(updates), all_parameters, ema_decay)
 
 
-def gen_updates_adagrad(loss, all_parameters, learning_rate=1.0, epsilon=1e-6):
+def gen_updates_adagrad(loss, all_parameters, learning_rate=1.0, epsilon=1e-6,
+                        ema_decay=None):
     """
     epsilon is not included in the typical formula,
 
@@ -202,11 +340,11 @@ def gen_updates_adagrad(loss, all_parameters, learning_rate=1.0, epsilon=1e-6):
         updates.append((param_i, param_i - learning_rate * grad_i
                         / T.sqrt(acc_i_new + epsilon)))
 
-    return updates
+    return apply_ema(apply_param_masks(updates), all_parameters, ema_decay)
 
 
 def gen_updates_rmsprop(loss, all_parameters, learning_rate=1.0, rho=0.9,
-                        epsilon=1e-6):
+                        epsilon=1e-6, ema_decay=None):
     """
     epsilon is not included in Hinton's video, but to prevent problems with
     relus repeatedly having 0 gradients, it is included here.
@@ -229,11 +367,11 @@ def gen_updates_rmsprop(loss, all_parameters, learning_rate=1.0, rho=0.9,
         updates.append((param_i, param_i - learning_rate * grad_i
                         / T.sqrt(acc_i_new + epsilon)))
 
-    return updates
+    return apply_ema(apply_param_masks(updates), all_parameters, ema_decay)
 
 
 def gen_updates_adadelta(loss, all_parameters, learning_rate=1.0, rho=0.95,
-                         epsilon=1e-6):
+                         epsilon=1e-6, ema_decay=None):
     """
     in the paper, no learning rate is considered (so learning_rate=1.0).
     Probably best to keep it at this value. epsilon is important for the very
@@ -270,7 +408,7 @@ def gen_updates_adadelta(loss, all_parameters, learning_rate=1.0, rho=0.95,
         acc_delta_i_new = rho * acc_delta_i + (1 - rho) * update_i**2
         updates.append((acc_delta_i, acc_delta_i_new))
 
-    return updates
+    return apply_ema(apply_param_masks(updates), all_parameters, ema_decay)
 
 
 def shared_single(dim=2):
@@ -509,7 +647,8 @@ class DenseLayer(Layer):
             input = self.input_layer.output(dropout_active=dropout_active,
                                             *args, **kwargs)
         if len(self.input_layer.get_output_shape()) > 2:
-            input = input.reshape(self.flatinput_shape)
+            # keeps the minibatch dimension symbolic
+            input = input.flatten(2)
 
         if dropout_active and (self.dropout > 0.):
             retain_prob = 1 - self.dropout
@@ -558,7 +697,8 @@ class DenseNoBiasLayer(Layer):
             input = self.input_layer.output(dropout_active=dropout_active,
                                             *args, **kwargs)
         if len(self.input_layer.get_output_shape()) > 2:
-            input = input.reshape(self.flatinput_shape)
+            # keeps the minibatch dimension symbolic
+            input = input.flatten(2)
 
         if dropout_active and (self.dropout > 0.):
             retain_prob = 1 - self.dropout
@@ -584,7 +724,13 @@ class Conv2DLayer(Layer):
                  dropout=0.,
                  dropout_tied=False,
                  border_mode='valid',
-                 trainable=True):
+                 trainable=True,
+                 static_batch=False):
+        """
+        If static_batch is True, mb_size is passed to conv2d as part of the
+        image shape hint. The layer then only accepts minibatches of exactly
+        mb_size samples.
+        """
         self.n_filters = n_filters
         self.filter_width = filter_width
         self.filter_height = filter_height
@@ -597,6 +743,7 @@ class Conv2DLayer(Layer):
         # input map
         self.dropout_tied = dropout_tied
         self.border_mode = border_mode
+        self.static_batch = static_batch
         self.mb_size = self.input_layer.mb_size
 
         self.input_shape = self.input_layer.get_output_shape()
@@ -605,6 +752,9 @@ class Conv2DLayer(Layer):
         self.filter_shape = (n_filters, self.input_shape[1], filter_width,
                              filter_height)
 
+        if self.static_batch and self.mb_size is None:
+            raise RuntimeError("static_batch needs a fixed mb_size")
+
         self.trainable = trainable
         self.W = shared_single(4)
         self.b = shared_single(1)
@@ -671,14 +821,14 @@ class Conv2DLayer(Layer):
             conved = conv2d(input,
                             self.W,
                             subsample=(1, 1),
-                            image_shape=self.input_shape,
+                            image_shape=self.get_image_shape_hint(),
                             filter_shape=self.filter_shape,
                             border_mode=self.border_mode)
         elif self.border_mode == 'same':
             conved = conv2d(input,
                             self.W,
                             subsample=(1, 1),
-                            image_shape=self.input_shape,
+                            image_shape=self.get_image_shape_hint(),
                             filter_shape=self.filter_shape,
                             border_mode='full')
             shift_x = (self.filter_width - 1) // 2
@@ -689,6 +839,12 @@ class Conv2DLayer(Layer):
             raise RuntimeError("Invalid border mode: '%s'" % self.border_mode)
         return self.nonlinearity(conved + self.b.dimshuffle('x', 0, 'x', 'x'))
 
+    def get_image_shape_hint(self):
+        # None leaves the minibatch dimension symbolic
+        if self.static_batch:
+            return self.input_shape
+        return (None,) + tuple(self.input_shape[1:])
+
 
 class StridedConv2DLayer(Layer):
     def __init__(self,
@@ -703,7 +859,8 @@ class StridedConv2DLayer(Layer):
                  nonlinearity=rectify,
                  dropout=0.,
                  dropout_tied=False,
-                 implementation='convolution'):
+                 implementation='convolution',
+                 static_batch=False):
         """
         implementation can be:
             - convolution: use conv2d with the subsample parameter
@@ -711,6 +868,10 @@ class StridedConv2DLayer(Layer):
                 with strides (1, 1)
             - single_dot: use a large tensor product
             - many_dots: use a bunch of tensor products
+
+        If static_batch is True, mb_size is passed to conv2d as part of the
+        image shape hints. The layer then only accepts minibatches of exactly
+        mb_size samples.
         """
         self.n_filters = n_filters
         self.filter_width = filter_width
@@ -727,8 +888,12 @@ class StridedConv2DLayer(Layer):
         # this controls whether the convolution is computed using theano's op,
         # as a bunch of tensor products, or a single stacked tensor product.
         self.implementation = implementation
+        self.static_batch = static_batch
         self.mb_size = self.input_layer.mb_size
 
+        if self.static_batch and self.mb_size is None:
+            raise RuntimeError("static_batch needs a fixed mb_size")
+
         self.input_shape = self.input_layer.get_output_shape()
         ' mb_size, n_filters, filter_width, filter_height '
 
@@ -795,7 +960,12 @@ class StridedConv2DLayer(Layer):
                 # at test time.
             input = input / retain_prob * mask
 
-        output_shape = self.get_output_shape()
+        # minibatch size of this graph, symbolic unless static_batch is set
+        if self.static_batch:
+            batch_size = self.mb_size
+        else:
+            batch_size = input.shape[0]
+        output_shape = (batch_size,) + self.get_output_shape()[1:]
         W_flipped = self.W[:, :, ::-1, ::-1]
 
         # crazy convolution stuff!
@@ -815,7 +985,7 @@ class StridedConv2DLayer(Layer):
             truncated_height = min(self.input_shape[3], padded_height)
             input_truncated = input[:, :, :truncated_width, :truncated_height]
 
-            input_padded_shape = (self.input_shape[0], self.input_shape[1],
+            input_padded_shape = (batch_size, self.input_shape[1],
                                   padded_width, padded_height)
             input_padded = T.zeros(input_padded_shape)
             input_padded = T.set_subtensor(input_padded[
@@ -889,7 +1059,7 @@ class StridedConv2DLayer(Layer):
                     if (width == 0) or (height == 0):
                         continue
 
-                    r_input_shape = (self.input_shape[0],
+                    r_input_shape = (batch_size,
                                      self.input_shape[1],
                                      width,
                                      self.filter_width,
@@ -925,7 +1095,7 @@ class StridedConv2DLayer(Layer):
                                 * self.stride_y)
             input_truncated = input[:, :, :truncated_width, :truncated_height]
 
-            r_input_shape = (self.input_shape[0],
+            r_input_shape = (batch_size,
                              self.input_shape[1],
                              truncated_width // self.stride_x,
                              self.stride_x,
@@ -935,7 +1105,7 @@ class StridedConv2DLayer(Layer):
             r_input = input_truncated.reshape(r_input_shape)
 
             # fold strides into the feature maps dimension
-            r_input_folded_shape = (self.input_shape[0],
+            r_input_folded_shape = (batch_size,
                                     self.input_shape[1] * self.stride_x
                                     * self.stride_y,
                                     truncated_width // self.stride_x,
@@ -965,7 +1135,8 @@ class StridedConv2DLayer(Layer):
             conved = conv2d(r_input_folded,
                             r_W_folded,
                             subsample=(1, 1),
-                            image_shape=r_input_folded_shape,
+                            image_shape=self.get_image_shape_hint(
+                                r_input_folded_shape),
                             filter_shape=r_filter_folded_shape)
             # 'conved' should already have the right shape
 
@@ -973,7 +1144,7 @@ class StridedConv2DLayer(Layer):
             conved = conv2d(input,
                             self.W,
                             subsample=(self.stride_x, self.stride_y),
-                            image_shape=self.input_shape,
+                            image_shape=self.get_image_shape_hint(),
                             filter_shape=self.filter_shape)
         else:
             raise RuntimeError("Invalid implementation string: '%s'"
@@ -981,6 +1152,14 @@ class StridedConv2DLayer(Layer):
 
         return self.nonlinearity(conved + self.b.dimshuffle('x', 0, 'x', 'x'))
 
+    def get_image_shape_hint(self, image_shape=None):
+        # None leaves the minibatch dimension symbolic
+        if image_shape is None:
+            image_shape = self.input_shape
+        if self.static_batch:
+            return (self.mb_size,) + tuple(image_shape[1:])
+        return (None,) + tuple(image_shape[1:])
+
 
 class ConcatenateLayer(Layer):
     def __init__(self, input_layers):
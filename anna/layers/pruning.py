@@ -0,0 +1,82 @@
+"""
+Magnitude pruning of layer weights.
+
+Pruning attaches a mask to the weights of the chosen layers (see
+layers.set_param_mask). The update generators in layers.py apply the masks,
+so fine-tuning a pruned model keeps the pruned weights at zero.
+"""
+import numpy
+
+import layers
+
+
+def get_prunable_layers(model):
+    """
+    Returns a {name: layer} dict of the Dense layers of a model.
+    """
+    prunable_layers = {}
+    for name in dir(model):
+        layer = getattr(model, name)
+        if isinstance(layer, (layers.DenseLayer, layers.DenseNoBiasLayer)):
+            prunable_layers[name] = layer
+    return prunable_layers
+
+
+def compute_magnitude_mask(W, sparsity):
+    """
+    Returns a float32 mask zeroing the fraction (sparsity) of the entries of
+    W with the smallest magnitudes.
+    """
+    magnitudes = numpy.abs(W).ravel()
+    num_pruned = int(round(sparsity * magnitudes.size))
+    mask = numpy.ones(magnitudes.size, dtype=numpy.float32)
+    if num_pruned > 0:
+        pruned = numpy.argpartition(magnitudes, num_pruned - 1)[0:num_pruned]
+        mask[pruned] = 0.0
+    return mask.reshape(W.shape)
+
+
+def prune_layer(layer, sparsity):
+    mask = compute_magnitude_mask(layer.W.get_value(), sparsity)
+    layers.set_param_mask(layer.W, mask)
+    return mask
+
+
+def get_sparsity(layer):
+    # Fraction of the weights that are zero
+    W = layer.W.get_value()
+    return 1.0 - numpy.count_nonzero(W) / float(W.size)
+
+
+def prune_model(model, sparsity, layer_names=None):
+    """
+    Prunes the weights of the Dense layers of a model (or of the named
+    layers) by magnitude, each layer separately. sparsity is either one
+    fraction for all layers or a {layer_name: fraction} dict.
+
+    The model is recompiled the first time its layers get masks, so its
+    training function enforces them from then on. Returns the sparsity of
+    every pruned layer.
+    """
+    if layer_names is None:
+        if isinstance(sparsity, dict):
+            layer_names = sorted(sparsity.keys())
+        else:
+            layer_names = sorted(get_prunable_layers(model).keys())
+
+    needs_compile = False
+    sparsities = {}
+    for name in layer_names:
+        layer = getattr(model, name)
+        if isinstance(sparsity, dict):
+            layer_sparsity = sparsity[name]
+        else:
+            layer_sparsity = sparsity
+        if layers.get_param_mask(layer.W) is None:
+            needs_compile = True
+        prune_layer(layer, layer_sparsity)
+        sparsities[name] = get_sparsity(layer)
+
+    if needs_compile:
+        model._compile()
+    return sparsities
@@ -9,16 +9,51 @@ from anna.layers import layers, cc_layers
 
 theano.config.floatX = 'float32'
 
+# Hyperparameters (besides learning_rate) of the update rules in layers.py,
+# layers.gen_updates_<name>, with their defaults
+UPDATE_RULE_HYPERPARAMETERS = {
+    'regular_momentum': {'momentum': 0.9, 'weight_decay': 1e-5},
+    'nesterov_momentum': {'momentum': 0.9, 'weight_decay': 1e-5},
+    'sgd': {},
+    'adagrad': {'epsilon': 1e-6},
+    'rmsprop': {'rho': 0.9, 'epsilon': 1e-6},
+    'adadelta': {'rho': 0.95, 'epsilon': 1e-6},
+}
+
 
 class AbstractModel(object):
     # Abstract Model
 
+    # Update rule (see UPDATE_RULE_HYPERPARAMETERS) and the values of its
+    # hyperparameters that differ from the defaults, e.g.
+    #     update_rule = 'adadelta'
+    #     hyperparameters = {'rho': 0.9}
+    update_rule = 'regular_momentum'
+    hyperparameters = {}
+
+    # Decay of the exponential moving average of the trainable parameters
+    # kept by the training step, e.g. 0.999. None disables it.
+    ema_decay = None
+
     def __init__(self, name, path, learning_rate=0.000001):
         self.name = name
         self.path = path
         self.learning_rate_symbol = theano.shared(
             numpy.array(learning_rate, dtype=theano.config.floatX))
 
+        # Every hyperparameter is a shared variable, so it can be changed
+        # during training without recompiling
+        self.hyperparameter_symbols = {
+            'learning_rate': self.learning_rate_symbol}
+        hyperparameters = dict(UPDATE_RULE_HYPERPARAMETERS[self.update_rule])
+        hyperparameters.update(self.hyperparameters)
+        for hyperparameter_name, value in hyperparameters.items():
+            self.hyperparameter_symbols[hyperparameter_name] = theano.shared(
+                numpy.array(value, dtype=theano.config.floatX))
+
+        self.deterministic_prediction_func = None
+        self.ema_swap_func = None
+
         # Automatically compile theano functions needed for model.
         self._compile()
 
@@ -42,18 +77,63 @@ class AbstractModel(object):
         raise NotImplementedError(str(type(self)) +
                                   " does not implement prediction.")
 
+    def deterministic_prediction(self, batch):
+        # Output with dropout switched off, compiled on first use
+        if self.deterministic_prediction_func is None:
+            self.deterministic_prediction_func = theano.function(
+                [self._get_input_symbol()],
+                self._get_output_symbol(dropout_active=False))
+        return self.deterministic_prediction_func(batch)
+
+    def swap_ema_parameters(self):
+        # Exchanges the parameters with their moving averages on the device;
+        # a second call swaps the trained parameters back
+        if self.ema_swap_func is None:
+            if not [param for param in self.all_trainable_parameters_symbol
+                    if layers.get_ema_shadow(param) is not None]:
+                raise ValueError('The model has no moving averages of its '
+                                 'parameters; set ema_decay to keep them.')
+            self.ema_swap_func = layers.gen_ema_swap_function(
+                self.all_trainable_parameters_symbol)
+        self.ema_swap_func()
+
+    def set_hyperparameter(self, name, value):
+        # Takes effect at the next training step, without recompiling
+        self.hyperparameter_symbols[name].set_value(
+            numpy.array(value, dtype=theano.config.floatX))
+
+    def get_hyperparameter(self, name):
+        return float(self.hyperparameter_symbols[name].get_value())
+
+    def _get_updates_symbol(self, cost=None):
+        # Updates minimizing cost, by default the model's own cost
+        if cost is None:
+            cost = self._get_cost_symbol()
+        gen_updates = getattr(layers, 'gen_updates_' + self.update_rule)
+        return gen_updates(
+            cost,
+            self.all_trainable_parameters_symbol,
+            ema_decay=self.ema_decay,
+            **self.hyperparameter_symbols)
+
     def _get_input_symbol(self):
         # First layer of Model must be called input
         return self.input.output()
 
-    def _get_output_symbol(self):
+    def _get_output_symbol(self, dropout_active=True):
         # Last layer of Model must be called output
-        return self.output.output()
+        return self.output.output(dropout_active=dropout_active)
 
     def _get_output_layer(self):
         # Last layer of Model must be called output
         return self.output
 
+    def _get_batch_size_symbol(self):
+        # Number of samples in the minibatch actually fed to the model
+        input = self._get_input_symbol()
+        batch_size = input.shape[layers.batch_axis(self.input)]
+        return T.cast(batch_size, theano.config.floatX)
+
 
 class UnsupervisedModel(AbstractModel):
     # def __init__(self, name, path, learning_rate=0.000001):
@@ -67,13 +147,7 @@ class UnsupervisedModel(AbstractModel):
         self.all_save_parameters_symbol = layers.all_parameters(
             self._get_output_layer())
 
-        # can switch to gen_updates_regular_momentum
-        self.updates_symbol = layers.gen_updates_regular_momentum(
-            self._get_cost_symbol(),
-            self.all_trainable_parameters_symbol,
-            learning_rate=self.learning_rate_symbol,
-            momentum=0.9,
-            weight_decay=1e-5)
+        self.updates_symbol = self._get_updates_symbol()
 
         self.train_func = theano.function(
             [self._get_input_symbol()],
@@ -88,10 +162,13 @@ class UnsupervisedModel(AbstractModel):
             [self._get_input_symbol()],
             self._get_output_symbol())
 
+        # Per-sample scoring functions are compiled on first use
+        self.score_funcs = {}
+
     def _get_cost_symbol(self):
         input = self._get_input_symbol()
         output = self._get_output_symbol()
-        cost = T.sum((output - input) ** 2)/self.batch
+        cost = T.sum((output - input) ** 2)/self._get_batch_size_symbol()
         return cost
 
     def train(self, batch):
@@ -103,6 +180,31 @@ class UnsupervisedModel(AbstractModel):
     def prediction(self, batch):
         return self.prediction_func(batch)
 
+    def score(self, batch, per_channel=False):
+        '''Squared reconstruction error of every sample in the batch, with
+        dropout switched off. Shape (batch,), or (batch, channels) if
+        per_channel is True.
+        '''
+        if per_channel not in self.score_funcs:
+            self.score_funcs[per_channel] = theano.function(
+                [self._get_input_symbol()],
+                self._get_sample_cost_symbol(per_channel))
+        return self.score_funcs[per_channel](batch)
+
+    def _get_sample_cost_symbol(self, per_channel=False):
+        input = self._get_input_symbol()
+        output = self._get_output_symbol(dropout_active=False)
+        error = (output - input) ** 2
+        if layers.batch_axis(self.input) == 3:
+            # c01b -> bc01
+            error = error.dimshuffle(3, 0, 1, 2)
+
+        if per_channel:
+            assert error.ndim == 4, \
+                'Per channel scores need 4 dimensional input.'
+            return T.sum(error, axis=(2, 3))
+        return T.sum(error.flatten(2), axis=1)
+
 
 class RegressionModel(AbstractModel):
     def _compile(self):
@@ -112,13 +214,7 @@ class RegressionModel(AbstractModel):
         self.all_save_parameters_symbol = layers.all_parameters(
             self._get_output_layer())
 
-        # can switch to gen_updates_regular_momentum
-        self.updates_symbol = layers.gen_updates_regular_momentum(
-            self._get_cost_symbol(),
-            self.all_trainable_parameters_symbol,
-            learning_rate=self.learning_rate_symbol,
-            momentum=0.9,
-            weight_decay=1e-5)
+        self.updates_symbol = self._get_updates_symbol()
 
         self.train_func = theano.function(
             [self._get_input_symbol(), self._get_y_symbol()],
@@ -166,12 +262,7 @@ class SupervisedModel(AbstractModel):
         self.all_save_parameters_symbol = layers.all_parameters(
             self._get_output_layer())
 
-        self.updates_symbol = layers.gen_updates_regular_momentum(
-            self._get_cost_symbol(),
-            self.all_trainable_parameters_symbol,
-            learning_rate=self.learning_rate_symbol,
-            momentum=0.9,
-            weight_decay=1e-5)
+        self.updates_symbol = self._get_updates_symbol()
 
         self.train_func = theano.function(
             [self._get_input_symbol(), self._get_y_symbol()],
@@ -226,12 +317,7 @@ class RegressionModel(AbstractModel):
         self.all_save_parameters_symbol = layers.all_parameters(
             self._get_output_layer())
 
-        self.updates_symbol = layers.gen_updates_regular_momentum(
-            self._get_cost_symbol(),
-            self.all_trainable_parameters_symbol,
-            learning_rate=self.learning_rate_symbol,
-            momentum=0.9,
-            weight_decay=1e-5)
+        self.updates_symbol = self._get_updates_symbol()
 
         self.train_func = theano.function(
             [self._get_input_symbol(), self._get_y_symbol()],
@@ -279,12 +365,7 @@ class KRegressionModel(AbstractModel):
         self.all_save_parameters_symbol = layers.all_parameters(
             self._get_output_layer())
 
-        self.updates_symbol = layers.gen_updates_regular_momentum(
-            self._get_cost_symbol(),
-            self.all_trainable_parameters_symbol,
-            learning_rate=self.learning_rate_symbol,
-            momentum=0.9,
-            weight_decay=1e-5)
+        self.updates_symbol = self._get_updates_symbol()
 
         self.train_func = theano.function(
             [self._get_input_symbol(),
@@ -312,14 +393,14 @@ class KRegressionModel(AbstractModel):
         mask = T.tile(cluster[:, None, :], (1, self.y_n, 1))
         y = self._get_y_symbol()
         output = self._get_output_symbol()
-        Y_hat = T.reshape(output, (self.batch, self.y_n, self.k))
+        Y_hat = T.reshape(output, (output.shape[0], self.y_n, self.k))
         y_hat = T.sum(Y_hat*mask, axis=2)
         cost = T.mean((y - y_hat)**2)
         return cost
 
     def _get_cluster_symbol(self):
         output = self._get_output_symbol()
-        Y_hat = T.reshape(output, (self.batch, self.y_n, self.k))
+        Y_hat = T.reshape(output, (output.shape[0], self.y_n, self.k))
         y = self._get_y_symbol()
         Y = T.tile(y[:, :, None], (1, 1, self.k))
         diff = T.mean((Y - Y_hat)**2, axis=1)
@@ -338,7 +419,7 @@ class KRegressionModel(AbstractModel):
     def cluster(self, x_batch, y_batch):
         clusters = self.cluster_func(x_batch, y_batch)
 
-        one_hot = numpy.zeros((self.batch, self.k))
+        one_hot = numpy.zeros((len(clusters), self.k))
         for i, cluster in enumerate(clusters):
             one_hot[i, cluster] = 1
         return one_hot
@@ -364,12 +445,7 @@ class ReinforcementModel(AbstractModel):
         self.all_save_parameters_symbol = layers.all_parameters(
             self._get_output_layer())
 
-        self.updates_symbol = layers.gen_updates_regular_momentum(
-            self._get_cost_symbol(),
-            self.all_trainable_parameters_symbol,
-            learning_rate=self.learning_rate_symbol,
-            momentum=0.9,
-            weight_decay=1e-5)
+        self.updates_symbol = self._get_updates_symbol()
 
         self.train_func = theano.function(
             [self._get_input_symbol(),
@@ -453,7 +529,7 @@ class ReinforcementModel(AbstractModel):
         '''Action with max Q value
         '''
         action_index = self.action_func(batch_x)
-        actions = numpy.zeros((self.batch, self.action_dims),
+        actions = numpy.zeros((len(action_index), self.action_dims),
                               dtype=numpy.float32)
         for i, action in enumerate(action_index):
             actions[i, action] = 1
@@ -0,0 +1,229 @@
+"""
+Cross-validation of a SupervisedModel with the folds trained in parallel.
+
+The dataset folder holds X.npy, y.npy and folds.npy, like for
+SupervisedDataLoaderCrossVal. CrossValidator reads them once (X memory-
+mapped by default) and keeps only the sample indices of every fold;
+minibatches are gathered from the full arrays by index, so no fold is
+copied. The folds are trained in forked worker processes that share the
+same mapping of the data (or, without memory-mapping, the same
+shared-memory copy of it).
+
+Every fold starts from the state the model had when the CrossValidator was
+created: its parameters and all other shared variables of its train
+function, e.g. momentum, moving averages and hyperparameters. Theano
+functions are compiled before forking, so workers run on the CPU.
+"""
+import sys
+import traceback
+import multiprocessing
+import Queue
+
+import numpy
+
+import theano
+
+from anna.layers import layers
+from anna.datasets.supervised_data_loader import SupervisedDataLoaderCrossVal
+from anna.datasets.streaming import BatchPrefetcher
+from anna.parallel.data_parallel import shared_array
+
+
+def get_model_state(model):
+    # Copies of the values of every shared variable of the train function
+    variables = model.train_func.get_shared()
+    return [(variable, variable.get_value()) for variable in variables]
+
+
+def set_model_state(state):
+    for variable, value in state:
+        variable.set_value(value)
+
+
+def get_index_batch(X, y, index, input_axes=None, preprocessor=None):
+    # Samples of X and y at index (sorted, to read memory maps in order)
+    index = numpy.sort(index)
+    x_batch = numpy.asarray(X[index], dtype=numpy.float32)
+    if input_axes is not None:
+        x_batch = x_batch.transpose(input_axes)
+    if preprocessor is not None:
+        x_batch = preprocessor.run(x_batch)
+    return x_batch, numpy.asarray(y[index])
+
+
+class CrossValidator(object):
+    """
+    Trains model for num_steps minibatches of its batch size on every fold
+    of the dataset in dataset_path, with num_workers processes, and tests
+    it on the held out samples. Training minibatches are drawn without
+    replacement, reshuffled every epoch with a seed depending on the fold.
+    preprocessor (e.g. util.Preprocessor) is applied to every minibatch.
+    mmap_mode=None reads X into shared memory instead of mapping it.
+    """
+    def __init__(self, model, dataset_path, num_steps, num_workers=1,
+                 preprocessor=None, mmap_mode='r', seed=0):
+        self.model = model
+        self.num_steps = num_steps
+        self.num_workers = num_workers
+        self.preprocessor = preprocessor
+        self.seed = seed
+        self.batch_size = model.batch
+        self.pad_last_batch = layers.has_static_batch(model.output)
+        if layers.batch_axis(model.input) == 3:
+            self.input_axes = (1, 2, 3, 0)
+        else:
+            self.input_axes = None
+
+        self.loader = SupervisedDataLoaderCrossVal(dataset_path,
+                                                   mmap_mode=mmap_mode)
+        X, self.y, folds = self.loader.load_arrays()
+        if mmap_mode is None:
+            self.X = shared_array(X.shape, X.dtype)
+            self.X[...] = X
+        else:
+            self.X = X
+        self.folds = range(int(folds.max()) + 1)
+
+        # Compiled here, so that forked workers do not compile it again
+        self.prediction_func = theano.function(
+            [model._get_input_symbol()],
+            model._get_output_symbol(dropout_active=False))
+        self.initial_state = get_model_state(model)
+
+    def run(self, folds=None):
+        """
+        Trains and tests the given folds (by default all of them). Returns
+        a result dict per fold, with its accuracy (in percent), the cost of
+        its last training step and its numbers of samples. The model is
+        left in its initial state.
+        """
+        if folds is None:
+            folds = self.folds
+        num_workers = min(self.num_workers, len(folds))
+        try:
+            if num_workers == 1:
+                return [self.run_fold(fold) for fold in folds]
+            return self._run_workers(folds, num_workers)
+        finally:
+            set_model_state(self.initial_state)
+
+    def run_fold(self, fold):
+        set_model_state(self.initial_state)
+        train_indices, test_indices = self.loader.get_fold_indices(fold)
+        if len(train_indices) < self.batch_size:
+            raise ValueError('Fold %d has %d training samples, less than a '
+                             'minibatch.' % (fold, len(train_indices)))
+
+        rng = numpy.random.RandomState(self.seed + fold)
+        iterator = BatchPrefetcher(
+            self._get_train_indices(train_indices, rng),
+            func=lambda index: get_index_batch(self.X, self.y, index,
+                                               self.input_axes,
+                                               self.preprocessor))
+        cost = None
+        for x_batch, y_batch in iterator:
+            cost = self.model.train(x_batch, y_batch)
+            # Supervised models return [cost, accuracy]
+            if isinstance(cost, (list, tuple)):
+                cost = cost[0]
+
+        return {'fold': fold, 'accuracy': self.evaluate(test_indices),
+                'cost': float(cost), 'num_train': len(train_indices),
+                'num_test': len(test_indices)}
+
+    def evaluate(self, indices):
+        # Accuracy of the current parameters on the samples at indices
+        batch_starts = range(0, len(indices), self.batch_size)
+        iterator = BatchPrefetcher(
+            iter(batch_starts),
+            func=lambda start: self._get_test_batch(
+                indices[start:start + self.batch_size]))
+        num_correct = 0
+        for y_batch, x_batch in iterator:
+            batch_pred = self.prediction_func(x_batch)[0:len(y_batch)]
+            num_correct += numpy.sum(numpy.argmax(batch_pred, axis=1) ==
+                                     y_batch)
+        return (100.0*num_correct)/len(indices)
+
+    def print_results(self, results):
+        print '%6s  %10s  %10s  %8s  %8s' % ('fold', 'accuracy', 'cost',
+                                             'train', 'test')
+        for result in results:
+            print '%6d  %10.2f  %10.5f  %8d  %8d' % (
+                result['fold'], result['accuracy'], result['cost'],
+                result['num_train'], result['num_test'])
+        accuracies = [result['accuracy'] for result in results]
+        print 'Mean accuracy: %.2f +- %.2f' % (numpy.mean(accuracies),
+                                               numpy.std(accuracies))
+        # Accuracy over all held out samples, weighting folds by size
+        num_test = sum([result['num_test'] for result in results])
+        print 'Pooled accuracy: %.2f' % (
+            sum([result['accuracy'] * result['num_test']
+                 for result in results]) / num_test)
+
+    def _get_train_indices(self, train_indices, rng):
+        # Indices of num_steps minibatches, reshuffled every epoch
+        num_batches = len(train_indices) // self.batch_size
+        step = 0
+        while True:
+            permutation = rng.permutation(train_indices)
+            for i in xrange(num_batches):
+                if step == self.num_steps:
+                    return
+                yield permutation[i * self.batch_size:
+                                  (i + 1) * self.batch_size]
+                step += 1
+
+    def _get_test_batch(self, index):
+        x_batch, y_batch = get_index_batch(self.X, self.y, index)
+        if self.pad_last_batch and len(index) < self.batch_size:
+            padded = numpy.zeros((self.batch_size,) + x_batch.shape[1:],
+                                 dtype=numpy.float32)
+            padded[0:len(index)] = x_batch
+            x_batch = padded
+        if self.input_axes is not None:
+            x_batch = x_batch.transpose(self.input_axes)
+        if self.preprocessor is not None:
+            x_batch = self.preprocessor.run(x_batch)
+        # get_index_batch sorts, which keeps x_batch and y_batch aligned
+        return y_batch, x_batch
+
+    def _run_workers(self, folds, num_workers):
+        results = multiprocessing.Queue()
+        workers = []
+        for rank in xrange(num_workers):
+            worker = multiprocessing.Process(
+                target=self._run_worker,
+                args=(folds[rank::num_workers], results))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+
+        try:
+            fold_results = {}
+            while len(fold_results) < len(folds):
+                try:
+                    result = results.get(timeout=1.0)
+                except Queue.Empty:
+                    if not [worker for worker in workers
+                            if worker.is_alive()]:
+                        raise RuntimeError('A worker failed.')
+                    continue
+                if result is None:
+                    raise RuntimeError('A worker failed.')
+                fold_results[result['fold']] = result
+        finally:
+            for worker in workers:
+                if worker.is_alive():
+                    worker.terminate()
+                worker.join()
+        return [fold_results[fold] for fold in folds]
+
+    def _run_worker(self, folds, results):
+        try:
+            for fold in folds:
+                results.put(self.run_fold(fold))
+        except:
+            traceback.print_exc()
+            results.put(None)
+            sys.exit(1)
@@ -0,0 +1,289 @@
+"""
+Synchronous data-parallel training of a SupervisedModel on one host.
+
+DataParallelTrainer forks worker processes that each hold a replica of the
+compiled model and take a disjoint shard of every minibatch. In every step
+each worker computes the gradient of its shard, the gradients are averaged
+through shared memory (each worker sums its own chunk of the flat gradient
+over all workers) and every worker applies the same averaged gradient with
+the model's update rule. The replicas start from the same parameters and
+apply identical updates, so they stay bit-identical.
+
+The calling process is worker 0, so its model ends up with the trained
+parameters. Theano functions are compiled once, before forking; workers
+run on the CPU (a forked process cannot share a GPU context). Forked
+workers reseed the random streams of the model (dropout masks), which
+they would otherwise share with worker 0.
+"""
+import os
+import sys
+import traceback
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray, RawValue
+from time import time
+
+import numpy
+
+import theano
+import theano.tensor as T
+
+from anna.layers import layers
+
+
+def get_num_parameters(all_parameters):
+    return sum([p.get_value(borrow=True).size for p in all_parameters])
+
+
+def compile_gradient_function(model):
+    """
+    Function of a minibatch returning the model's cost and the gradient of
+    all its trainable parameters, concatenated into one vector.
+    """
+    all_parameters = model.all_trainable_parameters_symbol
+    cost = model._get_cost_symbol()
+    all_grads = theano.grad(cost, all_parameters)
+    flat_grad = T.concatenate([grad.flatten() for grad in all_grads])
+    return theano.function(
+        [model._get_input_symbol(), model._get_y_symbol()],
+        [cost, flat_grad])
+
+
+def compile_apply_function(model):
+    """
+    Function applying a given flat gradient to the trainable parameters
+    with the model's update rule (and its hyperparameters, masks and moving
+    average). The rule differentiates a surrogate cost whose gradient with
+    respect to every parameter is its slice of the flat gradient.
+    """
+    all_parameters = model.all_trainable_parameters_symbol
+    flat_grad = T.vector('flat_grad', dtype=all_parameters[0].dtype)
+    surrogate_cost = 0
+    offset = 0
+    for param in all_parameters:
+        size = param.get_value(borrow=True).size
+        grad = flat_grad[offset:offset + size].reshape(param.shape)
+        surrogate_cost += T.sum(param * grad)
+        offset += size
+    return theano.function([flat_grad], [],
+                           updates=model._get_updates_symbol(surrogate_cost))
+
+
+def get_batch(X, y, start, size, input_axes=None, preprocessor=None):
+    # size consecutive samples from start, wrapping around the data
+    index = numpy.arange(start, start + size) % len(y)
+    x_batch = numpy.asarray(X[index], dtype=numpy.float32)
+    if input_axes is not None:
+        x_batch = x_batch.transpose(input_axes)
+    if preprocessor is not None:
+        x_batch = preprocessor.run(x_batch)
+    return x_batch, numpy.asarray(y[index])
+
+
+def get_chunk(rank, num_workers, size):
+    # Slice of a vector of the given size reduced by one worker
+    chunk_size = (size + num_workers - 1) // num_workers
+    return slice(min(rank * chunk_size, size),
+                 min((rank + 1) * chunk_size, size))
+
+
+def seed_random_streams(seed):
+    # The random streams of all layers (layers.srng), including the state
+    # held by already compiled functions
+    layers.srng.seed(seed)
+
+
+def shared_array(shape, dtype=numpy.float32):
+    # Numpy array in shared memory, inherited by forked processes
+    size = int(numpy.prod(shape))
+    raw = RawArray('b', size * numpy.dtype(dtype).itemsize)
+    return numpy.frombuffer(raw, dtype=dtype, count=size).reshape(shape)
+
+
+class Barrier(object):
+    """
+    Reusable barrier for forked processes. abort() releases (with an error)
+    the processes waiting at it, e.g. when one of them failed. Processes
+    that die without aborting (e.g. killed by a signal) are detected while
+    waiting: the creating process checks the processes given to watch()
+    and the others check that the creating process is alive.
+    """
+    def __init__(self, num_workers):
+        self.num_workers = num_workers
+        self.count = RawValue('i', 0)
+        self.generation = RawValue('i', 0)
+        self.aborted = RawValue('i', 0)
+        self.condition = multiprocessing.Condition()
+        self.parent_pid = os.getpid()
+        self.processes = []
+
+    def watch(self, processes):
+        self.processes = processes
+
+    def wait(self):
+        with self.condition:
+            if self.aborted.value:
+                raise RuntimeError('Another worker failed.')
+            generation = self.generation.value
+            self.count.value += 1
+            if self.count.value == self.num_workers:
+                self.count.value = 0
+                self.generation.value += 1
+                self.condition.notify_all()
+                return
+            while self.generation.value == generation:
+                if self.aborted.value:
+                    raise RuntimeError('Another worker failed.')
+                if self._has_dead_process():
+                    # Cannot arrive any more (it has not arrived yet, or it
+                    # would still be waiting in this generation)
+                    self.aborted.value = 1
+                    self.condition.notify_all()
+                    raise RuntimeError('Another worker died.')
+                self.condition.wait(1.0)
+
+    def abort(self):
+        with self.condition:
+            self.aborted.value = 1
+            self.condition.notify_all()
+
+    def _has_dead_process(self):
+        if os.getpid() != self.parent_pid:
+            return os.getppid() != self.parent_pid
+        return len([process for process in self.processes
+                    if not process.is_alive()]) > 0
+
+
+class DataParallelTrainer(object):
+    """
+    Trains a SupervisedModel with num_workers processes (see above). The
+    model's minibatch is split into num_workers equal shards, so its input
+    layer has to accept batch_size / num_workers samples.
+    """
+    def __init__(self, model, num_workers, seed=0):
+        self.model = model
+        self.num_workers = num_workers
+        # Seeds of the forked workers' random streams, new in every call
+        # to train
+        self.rng = numpy.random.RandomState(seed)
+        self.gradient_func = compile_gradient_function(model)
+        self.apply_func = compile_apply_function(model)
+        all_parameters = model.all_trainable_parameters_symbol
+        self.num_parameters = get_num_parameters(all_parameters)
+        self.dtype = all_parameters[0].dtype
+        if layers.batch_axis(model.input) == 3:
+            self.input_axes = (1, 2, 3, 0)
+        else:
+            self.input_axes = None
+
+        # Largest difference between the parameters of worker 0 and the
+        # other replicas after the last call to train
+        self.replica_difference = None
+        # Seconds spent computing gradients, averaging them and applying
+        # them in the last call to train (worker 0)
+        self.timings = None
+
+    def train(self, X, y, batch_size, num_steps, start=0, preprocessor=None,
+              monitor=None):
+        """
+        Runs num_steps steps on minibatches of batch_size consecutive
+        samples of (X, y), wrapping around, from sample start. X is bc01
+        and can be memory-mapped; forked workers share it. preprocessor is
+        applied to every shard (e.g. util.Preprocessor) and monitor, if
+        given, is started and stopped around every step like in a single
+        process training loop. Returns the mean cost of every step.
+        """
+        if batch_size % self.num_workers != 0:
+            raise ValueError('batch_size (%d) is not a multiple of the '
+                             'number of workers (%d).' % (batch_size,
+                                                          self.num_workers))
+        self.barrier = Barrier(self.num_workers)
+        self.grads = shared_array((self.num_workers, self.num_parameters),
+                                  self.dtype)
+        self.average_grad = shared_array((self.num_parameters,), self.dtype)
+        self.costs = shared_array((self.num_workers,), numpy.float64)
+        seeds = self.rng.randint(0, 2 ** 30, size=self.num_workers)
+
+        workers = []
+        for rank in xrange(1, self.num_workers):
+            worker = multiprocessing.Process(
+                target=self._run_child,
+                args=(rank, seeds[rank], X, y, batch_size, num_steps, start,
+                      preprocessor))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+        self.barrier.watch(workers)
+
+        try:
+            step_costs = self._run_worker(0, X, y, batch_size, num_steps,
+                                          start, preprocessor, monitor)
+        except:
+            self.barrier.abort()
+            raise
+        finally:
+            for worker in workers:
+                worker.join()
+
+        failed = [worker.exitcode for worker in workers
+                  if worker.exitcode != 0]
+        if failed:
+            raise RuntimeError('%d worker(s) failed.' % len(failed))
+        return step_costs
+
+    def _run_child(self, rank, seed, *args):
+        try:
+            seed_random_streams(seed)
+            self._run_worker(rank, *args)
+        except:
+            traceback.print_exc()
+            self.barrier.abort()
+            sys.exit(1)
+
+    def _run_worker(self, rank, X, y, batch_size, num_steps, start,
+                    preprocessor, monitor=None):
+        chunk = get_chunk(rank, self.num_workers, self.num_parameters)
+        timings = numpy.zeros(3)
+        step_costs = []
+        for step in xrange(num_steps):
+            if monitor is not None:
+                monitor.start()
+            shard_size = batch_size // self.num_workers
+            x_shard, y_shard = get_batch(
+                X, y, start + step * batch_size + rank * shard_size,
+                shard_size, self.input_axes, preprocessor)
+            tic = time()
+            cost, flat_grad = self.gradient_func(x_shard, y_shard)
+            self.grads[rank] = flat_grad
+            self.costs[rank] = cost
+            timings[0] += time() - tic
+
+            # Reduce: every worker averages its chunk over all workers
+            tic = time()
+            self.barrier.wait()
+            if rank == 0:
+                step_cost = float(numpy.mean(self.costs))
+            numpy.sum(self.grads[:, chunk], axis=0,
+                      out=self.average_grad[chunk])
+            self.average_grad[chunk] /= self.num_workers
+            self.barrier.wait()
+            timings[1] += time() - tic
+
+            tic = time()
+            self.apply_func(self.average_grad)
+            timings[2] += time() - tic
+
+            if rank == 0:
+                step_costs.append(step_cost)
+                if monitor is not None:
+                    monitor.stop(step_cost)
+
+        # Compare the replicas, reusing the gradient buffers
+        all_parameters = self.model.all_trainable_parameters_symbol
+        layers.get_flat_param_values(all_parameters, out=self.grads[rank])
+        self.barrier.wait()
+        if rank == 0:
+            self.replica_difference = float(numpy.max(numpy.abs(
+                self.grads - self.grads[0])))
+            self.timings = {'gradient': timings[0], 'reduce': timings[1],
+                            'apply': timings[2]}
+        return step_costs
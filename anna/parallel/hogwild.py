@@ -0,0 +1,223 @@
+"""
+Asynchronous (Hogwild) training of a SupervisedModel on one host.
+
+The trainable parameters of the model are moved into one shared-memory
+block: every parameter becomes a view into it (a shared variable holding a
+borrowed array), so forked worker processes read and write the same
+memory. Each worker runs its own compiled step on its own batches; the step
+returns the change of all parameters as one flat vector, which the worker
+adds to the block in place, without locks. Optimizer state (momentum) and
+moving averages stay local to every worker, and every worker reseeds the
+random streams of the model (dropout masks) after forking.
+
+Between steps the calling process can stop the world: it waits until no
+worker is inside a step, so the block is consistent while it saves a
+checkpoint or evaluates the model, whose parameters are the block itself.
+
+Models that tolerate stale updates (sparse or shallow ones) scale almost
+linearly; workers run on the CPU.
+"""
+import sys
+import traceback
+import multiprocessing
+from time import sleep
+
+import numpy
+
+import theano
+import theano.tensor as T
+
+from anna.layers import layers
+from anna.parallel.data_parallel import get_batch, get_num_parameters, \
+    seed_random_streams, shared_array
+
+
+def share_parameters(all_parameters, block):
+    """
+    Copies the parameters into block (a flat shared-memory array) and makes
+    every parameter a view into it.
+    """
+    offset = 0
+    for param in all_parameters:
+        value = param.get_value()
+        view = block[offset:offset + value.size].reshape(value.shape)
+        view[...] = value
+        param.set_value(view, borrow=True)
+        if not numpy.may_share_memory(param.get_value(borrow=True), block):
+            raise RuntimeError('Parameter %s could not be shared; Hogwild '
+                               'training needs parameters in host memory.'
+                               % param)
+        offset += value.size
+
+
+def compile_delta_function(model):
+    """
+    Training step of the model that leaves the trainable parameters alone
+    and returns the cost and the change of all trainable parameters,
+    concatenated into one vector. Other updates (momentum, moving averages)
+    are applied as usual.
+    """
+    all_parameters = model.all_trainable_parameters_symbol
+    parameter_ids = set([id(param) for param in all_parameters])
+    new_values = {}
+    other_updates = []
+    for variable, new_value in model._get_updates_symbol():
+        if id(variable) in parameter_ids:
+            new_values[id(variable)] = new_value
+        else:
+            other_updates.append((variable, new_value))
+    flat_delta = T.concatenate([(new_values[id(param)] - param).flatten()
+                                for param in all_parameters])
+    return theano.function(
+        [model._get_input_symbol(), model._get_y_symbol()],
+        [model._get_cost_symbol(), flat_delta],
+        updates=other_updates)
+
+
+class HogwildTrainer(object):
+    """
+    Trains a SupervisedModel with num_workers asynchronous processes (see
+    above). Worker w takes the batches w, w + num_workers, ... of the data.
+    """
+    def __init__(self, model, num_workers, seed=0):
+        self.model = model
+        self.num_workers = num_workers
+        # Seeds of the workers' random streams, new in every call to train
+        self.rng = numpy.random.RandomState(seed)
+        self.delta_func = compile_delta_function(model)
+        all_parameters = model.all_trainable_parameters_symbol
+        self.block = shared_array((get_num_parameters(all_parameters),),
+                                  all_parameters[0].dtype)
+        share_parameters(all_parameters, self.block)
+        if layers.batch_axis(model.input) == 3:
+            self.input_axes = (1, 2, 3, 0)
+        else:
+            self.input_axes = None
+
+        # One lock per worker, held during its step; taking all of them
+        # stops the world
+        self.locks = [multiprocessing.Lock() for i in xrange(num_workers)]
+        self.steps = shared_array((num_workers,), numpy.int64)
+        self.costs = shared_array((num_workers,), numpy.float64)
+        # Worker processes of the running call to train
+        self.workers = []
+
+    def snapshot(self):
+        # Consistent copy of all trainable parameters
+        self.stop_world()
+        try:
+            return self.block.copy()
+        finally:
+            self.resume_world()
+
+    def stop_world(self):
+        # A worker that died inside a step never releases its lock
+        acquired = []
+        try:
+            for rank, lock in enumerate(self.locks):
+                while not lock.acquire(True, 1.0):
+                    if rank < len(self.workers) and \
+                            not self.workers[rank].is_alive():
+                        raise RuntimeError('A worker failed.')
+                acquired.append(lock)
+        except:
+            for lock in reversed(acquired):
+                lock.release()
+            raise
+
+    def get_mean_cost(self):
+        # Mean cost of the last step of the workers that took one
+        started = self.steps > 0
+        if not numpy.any(started):
+            return None
+        return float(numpy.mean(self.costs[started]))
+
+    def resume_world(self):
+        for lock in reversed(self.locks):
+            lock.release()
+
+    def train(self, X, y, batch_size, num_steps, preprocessor=None,
+              snapshot_steps=None, snapshot_func=None):
+        """
+        Every worker runs num_steps steps on its own batches of batch_size
+        consecutive samples of (X, y); X is bc01 and can be memory-mapped.
+        Every snapshot_steps steps (summed over the workers) the world is
+        stopped and snapshot_func(step, cost) is called, with the mean cost
+        of the last step of every worker that took one, e.g. to save a
+        checkpoint of the model. Returns the (step, cost) pairs of the
+        snapshots.
+        """
+        self.steps[...] = 0
+        self.costs[...] = 0.0
+        # New locks, in case a failed call left one held
+        self.locks = [multiprocessing.Lock()
+                      for i in xrange(self.num_workers)]
+        seeds = self.rng.randint(0, 2 ** 30, size=self.num_workers)
+        workers = []
+        for rank in xrange(self.num_workers):
+            worker = multiprocessing.Process(
+                target=self._run_worker,
+                args=(rank, seeds[rank], X, y, batch_size, num_steps,
+                      preprocessor))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+        self.workers = workers
+
+        history = []
+        total_steps = num_steps * self.num_workers
+        next_snapshot = snapshot_steps
+        try:
+            while True:
+                alive = [worker.is_alive() for worker in workers]
+                if any([not is_alive and worker.exitcode != 0
+                        for is_alive, worker in zip(alive, workers)]):
+                    raise RuntimeError('A worker failed.')
+
+                step = int(self.steps.sum())
+                if snapshot_steps is not None and step >= next_snapshot:
+                    self.stop_world()
+                    try:
+                        step = int(self.steps.sum())
+                        cost = self.get_mean_cost()
+                        history.append((step, cost))
+                        if snapshot_func is not None:
+                            snapshot_func(step, cost)
+                    finally:
+                        self.resume_world()
+                    while next_snapshot <= step:
+                        next_snapshot += snapshot_steps
+                elif not any(alive):
+                    break
+                else:
+                    sleep(0.001)
+        finally:
+            for worker in workers:
+                if worker.is_alive():
+                    worker.terminate()
+                worker.join()
+            self.workers = []
+
+        if step < total_steps:
+            raise RuntimeError('Workers stopped after %d of %d steps.'
+                               % (step, total_steps))
+        return history
+
+    def _run_worker(self, rank, seed, X, y, batch_size, num_steps,
+                    preprocessor):
+        try:
+            seed_random_streams(seed)
+            lock = self.locks[rank]
+            for step in xrange(num_steps):
+                start = (step * self.num_workers + rank) * batch_size
+                x_batch, y_batch = get_batch(X, y, start, batch_size,
+                                             self.input_axes, preprocessor)
+                with lock:
+                    cost, flat_delta = self.delta_func(x_batch, y_batch)
+                    # Lock-free with respect to the other workers
+                    self.block += flat_delta
+                    self.costs[rank] = cost
+                    self.steps[rank] += 1
+        except:
+            traceback.print_exc()
+            sys.exit(1)
@@ -0,0 +1,224 @@
+"""
+Training several models on one input pipeline.
+
+MultiModelTrainer reads, augments and preprocesses every batch once and
+trains a list of models on it, each with its own train call and its own
+Monitor, e.g. the variants of a hyperparameter sweep on the same data.
+
+With num_workers > 1 the models are split over forked worker processes.
+Every prepared batch is written once into a ring of shared-memory slots
+that all workers read; a slot is reused only after every worker trained
+its models on it. At the end, the values of all shared variables of every
+model's train function (parameters, momentum, moving averages, ...) and
+the state of its Monitor (step number and pending errors) are sent back
+to the calling process.
+"""
+import itertools
+import multiprocessing
+import sys
+import traceback
+import Queue
+
+import numpy
+
+from anna.datasets.streaming import BatchPrefetcher
+from anna.parallel.data_parallel import shared_array
+
+# Attributes of a util.Monitor that change while training
+MONITOR_STATE = ['step_number', 'test', 'errors', 'times', 'big_errors',
+                 'big_times']
+
+
+class MultiModelTrainer(object):
+    """
+    Trains models (all taking the same input) on the same batches.
+    monitors, if given, holds one util.Monitor per model (give them
+    separate log files to keep the logs apart). preprocessor_module_list is
+    applied to every batch once, after the optional input_axes transpose,
+    e.g. (1, 2, 3, 0) to go from bc01 batches to c01b models.
+    """
+    def __init__(self, models, monitors=None, preprocessor_module_list=(),
+                 input_axes=None, num_workers=1, num_slots=4):
+        self.models = models
+        self.monitors = monitors
+        self.preprocessor_module_list = preprocessor_module_list
+        self.input_axes = input_axes
+        self.num_workers = min(num_workers, len(models))
+        self.num_slots = num_slots
+
+    def run(self, iterator, num_steps):
+        """
+        Trains every model on the next num_steps batches of iterator, which
+        yields (x_batch, y_batch) pairs, or x_batch alone for unsupervised
+        models. Returns the last error of every model.
+        """
+        batches = BatchPrefetcher(itertools.islice(iterator, num_steps),
+                                  func=self._prepare)
+        if self.num_workers == 1:
+            errors = [None] * len(self.models)
+            for batch in batches:
+                self._train_models(range(len(self.models)), batch, errors)
+            return errors
+        return self._run_workers(batches)
+
+    def _prepare(self, batch):
+        if isinstance(batch, tuple):
+            x_batch, y_batch = batch
+        else:
+            x_batch, y_batch = batch, None
+        x_batch = numpy.asarray(x_batch, dtype=numpy.float32)
+        if self.input_axes is not None:
+            x_batch = x_batch.transpose(self.input_axes)
+        for module in self.preprocessor_module_list:
+            x_batch = module.run(x_batch)
+        return x_batch, y_batch
+
+    def _train_models(self, model_indices, batch, errors):
+        x_batch, y_batch = batch
+        for i in model_indices:
+            monitor = self.monitors[i] if self.monitors else None
+            if monitor is not None:
+                monitor.start()
+            if y_batch is None:
+                error = self.models[i].train(x_batch)
+            else:
+                error = self.models[i].train(x_batch, y_batch)
+            # Supervised models return [cost, accuracy]
+            if isinstance(error, (list, tuple)):
+                error = error[0]
+            errors[i] = float(error)
+            if monitor is not None:
+                monitor.stop(error)
+
+    def _run_workers(self, batches):
+        # The slots are sized by the first batch, before forking
+        try:
+            first_batch = batches.next()
+        except StopIteration:
+            return [None] * len(self.models)
+        x_batch, y_batch = first_batch
+        x_slots = shared_array((self.num_slots,) + x_batch.shape)
+        if y_batch is not None:
+            y_batch = numpy.asarray(y_batch)
+            y_slots = shared_array((self.num_slots,) + y_batch.shape,
+                                   y_batch.dtype)
+        else:
+            y_slots = None
+        ready = [multiprocessing.Semaphore(0)
+                 for i in xrange(self.num_workers)]
+        free = [multiprocessing.Semaphore(self.num_slots)
+                for i in xrange(self.num_workers)]
+        results = multiprocessing.Queue()
+        # Set once the iterator is exhausted
+        num_batches = shared_array((1,), numpy.int64)
+        num_batches[0] = -1
+
+        workers = []
+        for rank in xrange(self.num_workers):
+            worker = multiprocessing.Process(
+                target=self._run_worker,
+                args=(rank, x_slots, y_slots, num_batches, ready[rank],
+                      free[rank], results))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+
+        try:
+            for step, batch in enumerate(itertools.chain([first_batch],
+                                                         batches)):
+                x_batch, y_batch = batch
+                if x_batch.shape != x_slots.shape[1:]:
+                    raise ValueError('Batch %d has shape %s instead of %s.'
+                                     % (step, x_batch.shape,
+                                        x_slots.shape[1:]))
+                for rank in xrange(self.num_workers):
+                    self._acquire(free[rank], workers[rank])
+                slot = step % self.num_slots
+                x_slots[slot] = x_batch
+                if y_slots is not None:
+                    y_slots[slot] = y_batch
+                for rank in xrange(self.num_workers):
+                    ready[rank].release()
+
+            # Tell the workers to stop
+            num_batches[0] = step + 1
+            for rank in xrange(self.num_workers):
+                ready[rank].release()
+
+            errors = [None] * len(self.models)
+            pending = set(range(self.num_workers))
+            while pending:
+                worker_results = self._get_results(results, workers, pending)
+                if worker_results is None:
+                    raise RuntimeError('A worker failed.')
+                rank, model_results = worker_results
+                pending.remove(rank)
+                for i, error, state, monitor_state in model_results:
+                    errors[i] = error
+                    for variable, value in zip(
+                            self.models[i].train_func.get_shared(), state):
+                        variable.set_value(value)
+                    if monitor_state is not None:
+                        for name, value in monitor_state.items():
+                            setattr(self.monitors[i], name, value)
+        finally:
+            for worker in workers:
+                if worker.is_alive():
+                    worker.terminate()
+                worker.join()
+        return errors
+
+    def _get_results(self, results, workers, pending):
+        # Next results sent by a worker, failing if one of the pending
+        # workers died (after one more wait, for what it sent before)
+        num_checks = 0
+        while True:
+            try:
+                return results.get(timeout=1.0)
+            except Queue.Empty:
+                if [rank for rank in pending
+                        if not workers[rank].is_alive()]:
+                    num_checks += 1
+                    if num_checks > 1:
+                        raise RuntimeError('A worker failed.')
+
+    def _acquire(self, semaphore, worker):
+        # Waits for a worker, failing if it died
+        while not semaphore.acquire(timeout=1.0):
+            if not worker.is_alive():
+                raise RuntimeError('A worker failed.')
+
+    def _run_worker(self, rank, x_slots, y_slots, num_batches, ready, free,
+                    results):
+        model_indices = range(rank, len(self.models), self.num_workers)
+        errors = [None] * len(self.models)
+        try:
+            step = 0
+            while True:
+                ready.acquire()
+                if step == num_batches[0]:
+                    break
+                slot = step % self.num_slots
+                y_batch = y_slots[slot] if y_slots is not None else None
+                self._train_models(model_indices, (x_slots[slot], y_batch),
+                                   errors)
+                free.release()
+                step += 1
+        except:
+            traceback.print_exc()
+            results.put(None)
+            sys.exit(1)
+        # The train functions were compiled before forking, so their shared
+        # variables are in the same order in the calling process
+        model_results = []
+        for i in model_indices:
+            state = [variable.get_value()
+                     for variable in self.models[i].train_func.get_shared()]
+            monitor = self.monitors[i] if self.monitors else None
+            if monitor is not None:
+                monitor_state = dict([(name, getattr(monitor, name))
+                                      for name in MONITOR_STATE])
+            else:
+                monitor_state = None
+            model_results.append((i, errors[i], state, monitor_state))
+        results.put((rank, model_results))
@@ -0,0 +1,253 @@
+"""
+Synchronous data-parallel training across machines over TCP.
+
+Worker processes (ranks) form a ring: each one sends to the next rank and
+receives from the previous one. Gradients are summed with the bandwidth
+optimal ring all-reduce, a reduce-scatter followed by an all-gather, in
+which every rank sends and receives 2 (N - 1) / N times the size of the
+gradient whatever the number of ranks. Chunks are cut into segments and a
+sender thread forwards every segment as soon as it was reduced, so sending,
+receiving and adding overlap.
+
+Theano computes all gradients in one call, so the all-reduce cannot start
+while later layers are still being differentiated; RingTrainer instead
+overlaps it with loading and preprocessing the next batch.
+"""
+import socket
+import struct
+import threading
+import Queue
+from time import time, sleep
+
+import numpy
+
+from anna.layers import layers
+from anna.datasets.streaming import BatchPrefetcher
+from anna.parallel.data_parallel import compile_gradient_function, \
+    compile_apply_function, get_batch
+
+
+def parse_address(address):
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
+
+
+def _recv_into(sock, view):
+    while len(view) > 0:
+        num_bytes = sock.recv_into(view)
+        if num_bytes == 0:
+            raise RuntimeError('Connection to the previous rank closed.')
+        view = view[num_bytes:]
+
+
+class Ring(object):
+    """
+    Connections of one rank to its neighbours. addresses lists the
+    host:port every rank listens on, in rank order.
+    """
+    def __init__(self, rank, addresses, segment_size=1 << 18,
+                 timeout=60.0):
+        self.rank = rank
+        self.world_size = len(addresses)
+        # Segment size in bytes
+        self.segment_size = segment_size
+        self.bytes_sent = 0
+
+        if self.world_size == 1:
+            return
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(parse_address(addresses[rank]))
+        listener.listen(1)
+
+        next_address = parse_address(addresses[(rank + 1) % self.world_size])
+        deadline = time() + timeout
+        while True:
+            try:
+                self.send_socket = socket.create_connection(next_address)
+                break
+            except socket.error:
+                if time() > deadline:
+                    raise
+                sleep(0.05)
+        self.send_socket.sendall(struct.pack('!I', rank))
+        self.recv_socket, __ = listener.accept()
+        listener.close()
+        previous_rank, = struct.unpack('!I', self._recv_bytes(4))
+        if previous_rank != (rank - 1) % self.world_size:
+            raise RuntimeError('Rank %d got a connection from rank %d.'
+                               % (rank, previous_rank))
+        for sock in [self.send_socket, self.recv_socket]:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def close(self):
+        if self.world_size > 1:
+            self.send_socket.close()
+            self.recv_socket.close()
+
+    def allreduce(self, buffer):
+        """
+        Replaces a flat array with its sum over all ranks. Every rank ends
+        up with the same bytes.
+        """
+        n = self.world_size
+        if n == 1:
+            return buffer
+        bounds = numpy.linspace(0, buffer.size, n + 1).astype(int)
+        chunks = [buffer[bounds[i]:bounds[i + 1]] for i in xrange(n)]
+        # Step t sends chunk (rank - t) and receives chunk (rank - t - 1);
+        # the first n - 1 steps reduce, the others copy
+        steps = [((self.rank - t) % n, (self.rank - t - 1) % n, t < n - 1)
+                 for t in xrange(2 * (n - 1))]
+
+        send_queue = Queue.Queue()
+        self.send_error = None
+        sender = threading.Thread(target=self._send_loop, args=(send_queue,))
+        sender.daemon = True
+        sender.start()
+        for segment in self._get_segments(chunks[steps[0][0]]):
+            send_queue.put(segment)
+
+        try:
+            scratch = numpy.empty(self.segment_size // buffer.itemsize + 1,
+                                  dtype=buffer.dtype)
+            for t, (__, recv_index, reduce) in enumerate(steps):
+                for segment in self._get_segments(chunks[recv_index]):
+                    if reduce:
+                        received = scratch[0:segment.size]
+                        _recv_into(self.recv_socket,
+                                   received.view(numpy.uint8))
+                        segment += received
+                    else:
+                        _recv_into(self.recv_socket,
+                                   segment.view(numpy.uint8))
+                    if t < len(steps) - 1:
+                        # Received at step t is sent at step t + 1
+                        send_queue.put(segment)
+        finally:
+            send_queue.put(None)
+            sender.join()
+        if self.send_error is not None:
+            raise self.send_error
+        return buffer
+
+    def broadcast(self, buffer, root=0):
+        # Passes a flat array from root around the ring
+        n = self.world_size
+        if n == 1:
+            return buffer
+        last = (root - 1) % n
+        for segment in self._get_segments(buffer):
+            if self.rank != root:
+                _recv_into(self.recv_socket, segment.view(numpy.uint8))
+            if self.rank != last:
+                self._send(segment)
+        return buffer
+
+    def barrier(self):
+        self.allreduce(numpy.zeros(self.world_size, dtype=numpy.float32))
+
+    def _get_segments(self, chunk):
+        segment_length = max(1, self.segment_size // chunk.itemsize)
+        return [chunk[i:i + segment_length]
+                for i in xrange(0, chunk.size, segment_length)]
+
+    def _send(self, segment):
+        self.send_socket.sendall(segment.view(numpy.uint8))
+        self.bytes_sent += segment.nbytes
+
+    def _send_loop(self, send_queue):
+        while True:
+            segment = send_queue.get()
+            if segment is None:
+                return
+            if self.send_error is None:
+                try:
+                    self._send(segment)
+                except Exception as e:
+                    self.send_error = e
+
+    def _recv_bytes(self, num_bytes):
+        data = bytearray(num_bytes)
+        _recv_into(self.recv_socket, memoryview(data))
+        return bytes(data)
+
+
+class RingTrainer(object):
+    """
+    Trains one rank of a SupervisedModel replicated over a Ring. Every rank
+    takes a disjoint shard of each minibatch of batch_size samples; the
+    gradients are averaged with the ring all-reduce and applied with the
+    model's update rule. The parameters of rank 0 are broadcast first, so
+    all replicas start, and stay, identical.
+    """
+    def __init__(self, model, ring):
+        self.model = model
+        self.ring = ring
+        self.gradient_func = compile_gradient_function(model)
+        self.apply_func = compile_apply_function(model)
+        if layers.batch_axis(model.input) == 3:
+            self.input_axes = (1, 2, 3, 0)
+        else:
+            self.input_axes = None
+
+        all_parameters = model.all_trainable_parameters_symbol
+        flat_parameters = layers.get_flat_param_values(all_parameters)
+        ring.broadcast(flat_parameters)
+        layers.set_flat_param_values(all_parameters, flat_parameters)
+
+        # Seconds spent loading data (not hidden by prefetching), computing
+        # gradients, all-reducing (including waiting for slower ranks) and
+        # applying them, and the bytes sent
+        self.timings = None
+
+    def train(self, X, y, batch_size, num_steps, start=0, preprocessor=None,
+              monitor=None):
+        """
+        Same arguments as DataParallelTrainer.train, on every rank. Returns
+        the cost of every step (of this rank's shard).
+        """
+        world_size = self.ring.world_size
+        if batch_size % world_size != 0:
+            raise ValueError('batch_size (%d) is not a multiple of the '
+                             'number of ranks (%d).' % (batch_size,
+                                                        world_size))
+        shard_size = batch_size // world_size
+        shard_starts = [start + step * batch_size + self.ring.rank *
+                        shard_size for step in xrange(num_steps)]
+        iterator = BatchPrefetcher(
+            iter(shard_starts),
+            func=lambda shard_start: get_batch(X, y, shard_start, shard_size,
+                                               self.input_axes, preprocessor))
+
+        timings = dict([(key, 0.0) for key in
+                        ['data', 'gradient', 'allreduce', 'apply']])
+        bytes_sent = self.ring.bytes_sent
+        step_costs = []
+        for step in xrange(num_steps):
+            if monitor is not None:
+                monitor.start()
+            tic = time()
+            x_shard, y_shard = iterator.next()
+            timings['data'] += time() - tic
+
+            tic = time()
+            cost, flat_grad = self.gradient_func(x_shard, y_shard)
+            timings['gradient'] += time() - tic
+
+            tic = time()
+            self.ring.allreduce(flat_grad)
+            flat_grad /= world_size
+            timings['allreduce'] += time() - tic
+
+            tic = time()
+            self.apply_func(flat_grad)
+            timings['apply'] += time() - tic
+
+            step_costs.append(float(cost))
+            if monitor is not None:
+                monitor.stop(float(cost))
+
+        timings['bytes_sent'] = self.ring.bytes_sent - bytes_sent
+        self.timings = timings
+        return step_costs
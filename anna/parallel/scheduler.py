@@ -0,0 +1,208 @@
+"""
+Scheduler packing concurrent CPU experiments onto one host.
+
+Jobs are queued with the number of cores and the memory (in GB) they need;
+jobs without a memory estimate are given the host's memory per core for
+each of their cores. The scheduler starts queued jobs, in order but
+skipping ones that do not fit yet, while free cores and memory last. Every
+job is pinned to its own cores with taskset, limited to as many OpenMP/BLAS
+threads and given its own Theano compiledir (with device=cpu), so
+concurrent jobs neither oversubscribe the cores nor contend for the
+compilation lock. When a job exits its slot goes to the next job that fits.
+
+This module does not import theano, so the scheduler process stays small.
+"""
+import multiprocessing
+import os
+import subprocess
+import sys
+from distutils.spawn import find_executable
+from time import time, sleep
+
+
+def get_memory_gb():
+    # Total memory of the host, from /proc/meminfo
+    with open('/proc/meminfo') as f:
+        for line in f:
+            if line.startswith('MemTotal:'):
+                return int(line.split()[1]) / float(1 << 20)
+    raise RuntimeError('Could not read the memory size.')
+
+
+def get_job_env(num_threads, compiledir, base_env=None):
+    """
+    Environment of a job limited to num_threads threads, with device=cpu
+    and its own compiledir added to the THEANO_FLAGS of base_env.
+    """
+    env = dict(os.environ if base_env is None else base_env)
+    for name in ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS',
+                 'MKL_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS',
+                 'NUMEXPR_NUM_THREADS']:
+        env[name] = str(num_threads)
+    flags = [flag for flag in env.get('THEANO_FLAGS', '').split(',')
+             if flag and not flag.startswith('device=')
+             and not flag.startswith('compiledir=')]
+    if not [flag for flag in flags if flag.startswith('floatX=')]:
+        flags.append('floatX=float32')
+    flags += ['device=cpu', 'compiledir=%s' % compiledir]
+    env['THEANO_FLAGS'] = ','.join(flags)
+    return env
+
+
+class Job(object):
+    """
+    A command to run with num_cores cores and memory_gb GB, writing its
+    output to log_path (stdout if None). memory_gb=None reserves the
+    scheduler's memory per core for each of the job's cores. on_finish, if
+    given, is called with the job when it has exited.
+    """
+    def __init__(self, name, command, num_cores=1, memory_gb=None,
+                 log_path=None, cwd=None, pid_path=None, on_finish=None):
+        self.name = name
+        self.command = command
+        self.num_cores = num_cores
+        self.memory_gb = memory_gb
+        self.log_path = log_path
+        self.cwd = cwd
+        self.pid_path = pid_path
+        self.on_finish = on_finish
+
+        self.process = None
+        self.cores = None
+        self.pid = None
+        self.returncode = None
+        self.start_time = None
+        self.end_time = None
+
+
+class Scheduler(object):
+    """
+    Runs Jobs on num_cores cores and memory_gb GB (by default all of the
+    host's, and at most all of it). Compile directories are created under
+    compiledir_root.
+    """
+    def __init__(self, num_cores=None, memory_gb=None,
+                 compiledir_root=None, poll_interval=0.5, verbose=True):
+        host_cores = multiprocessing.cpu_count()
+        if num_cores is None:
+            num_cores = host_cores
+        elif num_cores > host_cores:
+            raise ValueError('Cannot schedule %d cores, the host has %d.'
+                             % (num_cores, host_cores))
+        self.num_cores = num_cores
+        host_memory_gb = get_memory_gb()
+        if memory_gb is None:
+            memory_gb = host_memory_gb
+        elif memory_gb > host_memory_gb:
+            raise ValueError('Cannot schedule %.1f GB, the host has %.1f.'
+                             % (memory_gb, host_memory_gb))
+        self.memory_gb = memory_gb
+        if compiledir_root is None:
+            compiledir_root = os.path.join(os.path.expanduser('~'),
+                                           '.anna_scheduler')
+        self.compiledir_root = compiledir_root
+        self.poll_interval = poll_interval
+        self.verbose = verbose
+        self.taskset = find_executable('taskset')
+
+        self.free_cores = range(self.num_cores)
+        self.free_memory_gb = self.memory_gb
+        self.queue = []
+        self.running = []
+        self.finished = []
+
+    def submit(self, job):
+        if job.memory_gb is None:
+            job.memory_gb = self.memory_gb * job.num_cores / self.num_cores
+        elif job.memory_gb <= 0:
+            raise ValueError('Job %s needs a positive memory estimate, not '
+                             '%.1f GB.' % (job.name, job.memory_gb))
+        if job.num_cores > self.num_cores or job.memory_gb > self.memory_gb:
+            raise ValueError('Job %s needs %d cores and %.1f GB, the host has '
+                             '%d and %.1f.' % (job.name, job.num_cores,
+                                               job.memory_gb, self.num_cores,
+                                               self.memory_gb))
+        self.queue.append(job)
+
+    def run(self):
+        """
+        Runs until every job has finished. Returns the finished jobs, whose
+        returncode tells whether they succeeded.
+        """
+        try:
+            while self.queue or self.running:
+                self._start_jobs()
+                sleep(self.poll_interval)
+                self._collect_jobs()
+        except:
+            self.terminate()
+            raise
+        return self.finished
+
+    def terminate(self):
+        for job in self.running:
+            job.process.terminate()
+        for job in self.running:
+            job.process.wait()
+        self._collect_jobs()
+
+    def _start_jobs(self):
+        for job in list(self.queue):
+            if job.num_cores <= len(self.free_cores) and \
+                    job.memory_gb <= self.free_memory_gb:
+                self.queue.remove(job)
+                self._start(job)
+
+    def _start(self, job):
+        job.cores = self.free_cores[0:job.num_cores]
+        self.free_cores = self.free_cores[job.num_cores:]
+        self.free_memory_gb -= job.memory_gb
+
+        compiledir = os.path.join(self.compiledir_root, job.name)
+        env = get_job_env(job.num_cores, compiledir)
+        command = list(job.command)
+        if self.taskset is not None:
+            command = [self.taskset, '-c',
+                       ','.join([str(core) for core in job.cores])] + command
+
+        if job.log_path is not None:
+            log_file = open(job.log_path, 'wb')
+        else:
+            log_file = None
+        job.process = subprocess.Popen(command, stdout=log_file,
+                                       stderr=subprocess.STDOUT,
+                                       cwd=job.cwd, env=env)
+        if log_file is not None:
+            log_file.close()
+        job.pid = job.process.pid
+        job.start_time = time()
+        self.running.append(job)
+
+        if job.pid_path is not None:
+            f_pid = open(job.pid_path, 'wb')
+            f_pid.write('PID: {}\n'.format(job.pid))
+            f_pid.close()
+        self._log('Started {} (PID {}) on cores {}'.format(
+            job.name, job.pid, ','.join([str(core) for core in job.cores])))
+
+    def _collect_jobs(self):
+        for job in list(self.running):
+            returncode = job.process.poll()
+            if returncode is None:
+                continue
+            job.returncode = returncode
+            job.end_time = time()
+            self.running.remove(job)
+            self.finished.append(job)
+            self.free_cores = sorted(self.free_cores + job.cores)
+            self.free_memory_gb += job.memory_gb
+            self._log('Finished {} (PID {}) with exit code {} after '
+                      '{:.1f} s'.format(job.name, job.pid, returncode,
+                                        job.end_time - job.start_time))
+            if job.on_finish is not None:
+                job.on_finish(job)
+
+    def _log(self, message):
+        if self.verbose:
+            print(message)
+            sys.stdout.flush()
@@ -0,0 +1,414 @@
+"""
+Hyperparameter sweeps over an experiment's train.py.
+
+A sweep expands a grid, or samples a random search space, into
+configurations. Every configuration gets its own run folder under the
+sweep's out_path, named after a hash of the configuration, holding copies
+of the experiment's scripts and a config.json that train.py reads with
+
+    config = sweep.get_config(out_path)
+
+Runs are started as `train.py <run_name> <run_folder>` through the
+scheduler, at most max_concurrent at a time. When a run exits its Monitor
+log is parsed and a result.json is written next to it, so re-running the
+sweep skips finished configurations and a large sweep can be resumed.
+
+SuccessiveHalving instead gives every configuration a short budget, stops
+the worse ones and resumes the others from their last checkpoint with a
+larger budget. Its runs find the budget in the configuration:
+
+    config = sweep.get_config(out_path)
+    if 'resume_checkpoint' in config:
+        util.load_checkpoint(model, config['resume_checkpoint'])
+    monitor = util.Monitor(model, step_number=config.get('start_step', 0))
+    ... train until monitor.step_number == config['num_steps'] ...
+    util.save_checkpoint(model, 'checkpoints')
+
+This module does not import theano.
+"""
+import glob
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import re
+import shutil
+import sys
+
+import numpy
+
+from anna.parallel.scheduler import Job, Scheduler
+
+CONFIG_NAME = 'config.json'
+RESULT_NAME = 'result.json'
+LOG_NAME = 'log.txt'
+
+# Monitor log lines: '*step, train error: ...' every long_steps,
+# 'step, train error: ...' every short_steps and '&step, test error: ...'
+LOG_LINE = re.compile(r'^([*&]?)(\d+), (train|test) error: ([-+0-9.eE]+|nan)')
+
+
+def get_config(out_path):
+    """
+    Configuration of the run writing to out_path (for train.py), or an
+    empty dict outside of a sweep.
+    """
+    config_path = os.path.join(out_path, CONFIG_NAME)
+    if not os.path.exists(config_path):
+        return {}
+    return json.load(open(config_path))
+
+
+def expand_grid(grid):
+    # Every combination of the values of a {name: [values]} dict
+    names = sorted(grid.keys())
+    return [dict(zip(names, values))
+            for values in itertools.product(*[grid[name] for name in names])]
+
+
+def sample_value(rng, spec):
+    """
+    One value of a search space entry: {'uniform': [low, high]},
+    {'log_uniform': [low, high]}, {'int': [low, high]} (inclusive),
+    {'choice': [values]} or a constant.
+    """
+    if not isinstance(spec, dict):
+        return spec
+    kind, args = spec.items()[0]
+    if kind == 'uniform':
+        return float(rng.uniform(args[0], args[1]))
+    elif kind == 'log_uniform':
+        return float(numpy.exp(rng.uniform(numpy.log(args[0]),
+                                           numpy.log(args[1]))))
+    elif kind == 'int':
+        return int(rng.randint(args[0], args[1] + 1))
+    elif kind == 'choice':
+        return args[rng.randint(len(args))]
+    raise ValueError('Unknown search space entry: %s' % kind)
+
+
+def sample_random(space, num_samples, seed=0):
+    rng = numpy.random.RandomState(seed)
+    names = sorted(space.keys())
+    return [dict([(name, sample_value(rng, space[name])) for name in names])
+            for i in xrange(num_samples)]
+
+
+def get_configs(spec):
+    """
+    Configurations of a sweep spec: a 'grid' and/or a 'random' space
+    (sampled 'num_samples' times with 'seed'), each combined with the
+    constant 'fixed' values.
+    """
+    configs = []
+    if 'grid' in spec:
+        configs += expand_grid(spec['grid'])
+    if 'random' in spec:
+        configs += sample_random(spec['random'], spec.get('num_samples', 10),
+                                 spec.get('seed', 0))
+    if not configs:
+        configs = [{}]
+    for config in configs:
+        config.update(spec.get('fixed', {}))
+    return configs
+
+
+def get_run_name(config):
+    # Stable name of a configuration, the same on every re-run
+    config_string = json.dumps(config, sort_keys=True)
+    return 'run-' + hashlib.md5(config_string).hexdigest()[0:10]
+
+
+def parse_log(log_path):
+    """
+    Metrics of a Monitor log: the last and best test errors and long-term
+    (or, without those, short-term) train errors, and the last step.
+    """
+    train = []
+    short_train = []
+    test = []
+    last_step = None
+    if os.path.exists(log_path):
+        for line in open(log_path):
+            match = LOG_LINE.match(line.strip())
+            if match is None:
+                continue
+            marker, step, kind, error = match.groups()
+            step, error = int(step), float(error)
+            last_step = step
+            if kind == 'test':
+                test.append(error)
+            elif marker == '*':
+                train.append(error)
+            else:
+                short_train.append(error)
+    train = train or short_train
+    return {'steps': last_step,
+            'final_train_error': train[-1] if train else None,
+            'best_train_error': min(train) if train else None,
+            'final_test_error': test[-1] if test else None,
+            'best_test_error': min(test) if test else None}
+
+
+def read_result(run_path, result_name=RESULT_NAME):
+    result_path = os.path.join(run_path, result_name)
+    if not os.path.exists(result_path):
+        return None
+    return json.load(open(result_path))
+
+
+def write_result(run_path, config, returncode, extra=None,
+                 log_name=LOG_NAME, result_name=RESULT_NAME):
+    result = {'config': config, 'returncode': returncode}
+    result.update(parse_log(os.path.join(run_path, log_name)))
+    if extra is not None:
+        result.update(extra)
+    f = open(os.path.join(run_path, result_name), 'wb')
+    json.dump(result, f, sort_keys=True, indent=2)
+    f.close()
+    return result
+
+
+def prepare_run(train_path, run_path, config):
+    # Copies the experiment's scripts and writes the configuration
+    if not os.path.exists(run_path):
+        os.makedirs(run_path)
+    for file_path in glob.glob(os.path.join(train_path, '*.py')):
+        shutil.copy(file_path, run_path)
+    f = open(os.path.join(run_path, CONFIG_NAME), 'wb')
+    json.dump(config, f, sort_keys=True, indent=2)
+    f.close()
+
+
+def get_latest_checkpoint(run_path, checkpoint_directory='checkpoints'):
+    # Most recently written checkpoint of a run, or None. Moving averages
+    # are saved next to a checkpoint, in *_ema.pkl.
+    checkpoint_paths = [
+        path for path in glob.glob(os.path.join(run_path, checkpoint_directory,
+                                                '*.pkl'))
+        if not path.endswith('_ema.pkl')]
+    if not checkpoint_paths:
+        return None
+    return max(checkpoint_paths, key=os.path.getmtime)
+
+
+def get_sort_key(result, keys=('best_test_error', 'best_train_error')):
+    # First of keys that the run has (best test error, else best train
+    # error); failed and metric-less runs last
+    for key in keys:
+        if result.get(key) is not None and result['returncode'] == 0:
+            return (0, result[key])
+    return (1, 0)
+
+
+class Sweep(object):
+    """
+    Runs the configurations of a sweep spec (see get_configs) of the
+    experiment in train_path (with model.py and train.py), in folders
+    under out_path. Every run gets num_cores cores and memory_gb GB (by
+    default the host's memory per core for each of its cores), and at most
+    max_concurrent run at the same time, as long as their memory fits in
+    the host's.
+    """
+    def __init__(self, spec, train_path, out_path, max_concurrent=1,
+                 num_cores=1, memory_gb=None, compiledir_root=None):
+        self.configs = get_configs(spec)
+        self.train_path = train_path
+        self.out_path = out_path
+        self.max_concurrent = max_concurrent
+        self.num_cores = num_cores
+        host_cores = multiprocessing.cpu_count()
+        if max_concurrent * num_cores > host_cores:
+            raise ValueError('Cannot run %d runs of %d cores, the host has '
+                             '%d cores.' % (max_concurrent, num_cores,
+                                            host_cores))
+        self.memory_gb = memory_gb
+        if compiledir_root is None:
+            compiledir_root = os.path.join(out_path, 'compiledirs')
+        self.compiledir_root = compiledir_root
+
+    def get_run_path(self, config):
+        return os.path.join(self.out_path, get_run_name(config))
+
+    def run(self):
+        """
+        Runs every configuration without a successful result. Returns the
+        results of all configurations, best first.
+        """
+        scheduler = Scheduler(num_cores=self.max_concurrent * self.num_cores,
+                              compiledir_root=self.compiledir_root)
+        num_skipped = 0
+        for config in self.configs:
+            result = read_result(self.get_run_path(config))
+            if result is not None and result['returncode'] == 0:
+                num_skipped += 1
+                continue
+            scheduler.submit(self._get_job(config))
+        print('{} configurations, {} finished before, {} to run'.format(
+            len(self.configs), num_skipped,
+            len(self.configs) - num_skipped))
+        sys.stdout.flush()
+        scheduler.run()
+        return self.get_results()
+
+    def get_results(self):
+        results = []
+        for config in self.configs:
+            result = read_result(self.get_run_path(config))
+            if result is None:
+                result = {'config': config, 'returncode': None}
+            result['run'] = get_run_name(config)
+            results.append(result)
+        results.sort(key=get_sort_key)
+        return results
+
+    def _get_job(self, config, run_config=None, log_name=LOG_NAME,
+                 result_name=RESULT_NAME, extra=None):
+        # run_config, if given, is written for train.py instead of config
+        # (e.g. with a budget added); the run is still named after config
+        run_name = get_run_name(config)
+        run_path = self.get_run_path(config)
+        prepare_run(self.train_path, run_path,
+                    config if run_config is None else run_config)
+        command = [sys.executable, '-u', os.path.join(run_path, 'train.py'),
+                   run_name, run_path]
+        return Job(run_name, command, num_cores=self.num_cores,
+                   memory_gb=self.memory_gb,
+                   log_path=os.path.join(run_path, log_name),
+                   cwd=run_path, pid_path=os.path.join(run_path, 'pid'),
+                   on_finish=lambda job: write_result(
+                       run_path, config, job.returncode, extra=extra,
+                       log_name=log_name, result_name=result_name))
+
+
+class SuccessiveHalving(Sweep):
+    """
+    Sweep that trains every configuration for min_steps steps, keeps the
+    best 1 / eta of them by their last Monitor test error (train error if
+    they do not test) and resumes those from their last checkpoint for eta
+    times as many steps, until one is left or max_steps is reached. Every
+    round (rung) runs at most max_concurrent configurations at a time and
+    logs to log.rung<rung>.txt in the run folders; re-running skips the
+    rungs that finished. Runs without a checkpoint to resume from, or that
+    end without a result, fail and are not kept.
+
+    Momentum and other update state are not in the checkpoints, so they
+    restart at every rung.
+    """
+    def __init__(self, spec, train_path, out_path, min_steps, max_steps,
+                 eta=2, **kwargs):
+        super(SuccessiveHalving, self).__init__(spec, train_path, out_path,
+                                                **kwargs)
+        if eta < 2:
+            raise ValueError('eta must be at least 2.')
+        self.min_steps = min_steps
+        self.max_steps = max_steps
+        self.eta = eta
+
+    def run(self):
+        """
+        Runs the rungs. Returns the results of every rung, a list of
+        result lists with the best configuration first.
+        """
+        configs = list(self.configs)
+        num_steps = min(self.min_steps, self.max_steps)
+        start_step = 0
+        history = []
+        rung = 0
+        while True:
+            self._log('Rung {}: {} configurations to step {}'.format(
+                rung, len(configs), num_steps))
+            results = self._run_rung(rung, configs, start_step, num_steps)
+            history.append(results)
+            self._log(format_results(results))
+            if len(configs) == 1 or num_steps == self.max_steps:
+                return history
+            num_kept = max(1, len(configs) // self.eta)
+            configs = [result['config'] for result in results[0:num_kept]
+                       if result['returncode'] == 0]
+            if not configs:
+                return history
+            start_step = num_steps
+            num_steps = min(num_steps * self.eta, self.max_steps)
+            rung += 1
+
+    def _run_rung(self, rung, configs, start_step, num_steps):
+        log_name = 'log.rung%d.txt' % rung
+        result_name = 'result.rung%d.json' % rung
+        scheduler = Scheduler(num_cores=self.max_concurrent * self.num_cores,
+                              compiledir_root=self.compiledir_root)
+        for config in configs:
+            run_path = self.get_run_path(config)
+            result = read_result(run_path, result_name)
+            if result is not None and result['returncode'] == 0 and \
+                    result['num_steps'] == num_steps:
+                continue
+            run_config = dict(config)
+            run_config['num_steps'] = num_steps
+            if start_step > 0:
+                checkpoint_path = get_latest_checkpoint(run_path)
+                if checkpoint_path is None:
+                    # Training from scratch would not be comparable with
+                    # the resumed runs, the run fails instead
+                    self._log('{}: no checkpoint to resume from'.format(
+                        get_run_name(config)))
+                    write_result(run_path, config, None,
+                                 extra={'num_steps': num_steps,
+                                        'error': 'no checkpoint'},
+                                 log_name=log_name,
+                                 result_name=result_name)
+                    continue
+                run_config['start_step'] = start_step
+                run_config['resume_checkpoint'] = checkpoint_path
+            scheduler.submit(self._get_job(config, run_config, log_name,
+                                           result_name,
+                                           {'num_steps': num_steps}))
+        scheduler.run()
+
+        results = []
+        for config in configs:
+            result = read_result(self.get_run_path(config), result_name)
+            if result is None:
+                # The job ended without a result, it ranks with the failed
+                # runs
+                result = {'config': config, 'returncode': None,
+                          'num_steps': num_steps}
+            result['run'] = get_run_name(config)
+            results.append(result)
+        results.sort(key=lambda result: get_sort_key(
+            result, ('final_test_error', 'final_train_error')))
+        return results
+
+    def _log(self, message):
+        print(message)
+        sys.stdout.flush()
+
+
+def format_results(results):
+    """
+    Table of sweep results, one row per run: the swept values followed by
+    the metrics.
+    """
+    names = sorted(set(itertools.chain(*[result['config'].keys()
+                                         for result in results])))
+    metrics = ['steps', 'final_train_error', 'best_train_error',
+               'final_test_error', 'best_test_error', 'returncode']
+    rows = [['run'] + names + metrics]
+    for result in results:
+        row = [result['run']]
+        row += [_format_value(result['config'].get(name)) for name in names]
+        row += [_format_value(result.get(metric)) for metric in metrics]
+        rows.append(row)
+    widths = [max([len(row[i]) for row in rows]) for i in xrange(len(rows[0]))]
+    return '\n'.join(['  '.join([value.rjust(width)
+                                 for value, width in zip(row, widths)])
+                      for row in rows])
+
+
+def _format_value(value):
+    if value is None:
+        return '-'
+    if isinstance(value, float):
+        return '%.5g' % value
+    return str(value)
@@ -0,0 +1,116 @@
+"""Script to benchmark the scaling of data-parallel training on one host,
+synchronous or asynchronous (Hogwild).
+"""
+import argparse
+import os
+
+# One BLAS / OpenMP thread per worker, set before numpy and theano load
+os.environ.setdefault('OMP_NUM_THREADS', '1')
+os.environ.setdefault('OPENBLAS_NUM_THREADS', '1')
+os.environ.setdefault('MKL_NUM_THREADS', '1')
+
+from time import time
+
+import numpy
+
+from anna.layers import layers
+from anna.models import SupervisedModel
+from anna.parallel.data_parallel import DataParallelTrainer
+from anna.parallel.hogwild import HogwildTrainer
+
+
+def make_model(shard_size, image_size, num_filters, num_classes):
+    class BenchmarkModel(SupervisedModel):
+        batch = shard_size
+        input = layers.Input2DLayer(shard_size, 3, image_size, image_size)
+        conv1 = layers.Conv2DLayer(input, num_filters, 5, 5, 0.01, 0.0)
+        pool1 = layers.Pooling2DLayer(conv1, (2, 2))
+        conv2 = layers.Conv2DLayer(pool1, num_filters, 5, 5, 0.01, 0.0)
+        pool2 = layers.Pooling2DLayer(conv2, (2, 2))
+        output = layers.DenseLayer(pool2, num_classes, 0.01, 0.0,
+                                   nonlinearity=layers.softmax)
+    return BenchmarkModel('benchmark', None, learning_rate=0.01)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(prog='data_parallel_benchmark',
+                                     description='Script to benchmark the '
+                                     'scaling of synchronous data-parallel '
+                                     'training with forked CPU workers')
+    parser.add_argument('--mode', choices=['sync', 'hogwild'], default='sync',
+                        help='Synchronous all-reduce or asynchronous Hogwild')
+    parser.add_argument('--num_workers', default='1,2,4,8,16',
+                        help='Comma separated numbers of workers')
+    parser.add_argument('--batch_size', type=int, default=128,
+                        help='Minibatch size (split across the workers in '
+                        'sync mode, per worker in hogwild mode)')
+    parser.add_argument('--weak', action='store_true',
+                        help='Give every sync worker batch_size samples '
+                        'instead')
+    parser.add_argument('--image_size', type=int, default=32)
+    parser.add_argument('--num_filters', type=int, default=32)
+    parser.add_argument('--num_classes', type=int, default=10)
+    parser.add_argument('--num_steps', type=int, default=20,
+                        help='Timed steps per setting')
+    args = parser.parse_args()
+
+    rng = numpy.random.RandomState(0)
+    X = rng.randn(4096, 3, args.image_size, args.image_size)
+    X = X.astype(numpy.float32)
+    y = rng.randint(0, args.num_classes, len(X))
+
+    header = '{:>8} {:>8} {:>12} {:>8} {:>10}'.format(
+        'workers', 'batch', 'samples/s', 'speedup', 'efficiency')
+    if args.mode == 'sync':
+        header += ' {:>10} {:>10} {:>10}'.format('grad (%)', 'reduce (%)',
+                                                 'apply (%)')
+    print(header)
+    base_throughput = None
+    for num_workers in [int(n) for n in args.num_workers.split(',')]:
+        if args.mode == 'hogwild':
+            model = make_model(args.batch_size, args.image_size,
+                               args.num_filters, args.num_classes)
+            trainer = HogwildTrainer(model, num_workers)
+            trainer.train(X, y, args.batch_size, 2)
+            tic = time()
+            trainer.train(X, y, args.batch_size, args.num_steps)
+            toc = time()
+
+            throughput = (num_workers * args.batch_size * args.num_steps /
+                          (toc - tic))
+            if base_throughput is None:
+                base_throughput = throughput / num_workers
+            speedup = throughput / base_throughput
+            print('{:>8} {:>8} {:>12.1f} {:>8.2f} {:>10.2f}'.format(
+                num_workers, args.batch_size, throughput, speedup,
+                speedup / num_workers))
+            continue
+
+        if args.weak:
+            batch_size = args.batch_size * num_workers
+        else:
+            batch_size = args.batch_size
+        model = make_model(batch_size // num_workers, args.image_size,
+                           args.num_filters, args.num_classes)
+        trainer = DataParallelTrainer(model, num_workers)
+        # Warm up
+        trainer.train(X, y, batch_size, 2)
+        tic = time()
+        trainer.train(X, y, batch_size, args.num_steps)
+        toc = time()
+
+        throughput = batch_size * args.num_steps / (toc - tic)
+        if base_throughput is None:
+            base_throughput = throughput / num_workers
+        speedup = throughput / base_throughput
+        total = sum(trainer.timings.values())
+        print('{:>8} {:>8} {:>12.1f} {:>8.2f} {:>10.2f} {:>10.1f} {:>10.1f} '
+              '{:>10.1f}'.format(
+                  num_workers, batch_size, throughput, speedup,
+                  speedup / num_workers,
+                  100 * trainer.timings['gradient'] / total,
+                  100 * trainer.timings['reduce'] / total,
+                  100 * trainer.timings['apply'] / total))
+        assert trainer.replica_difference == 0.0, \
+            'Replicas diverged by %g' % trainer.replica_difference
@@ -1,4 +1,16 @@
 """Script to launch experiments.
+
+Launches one experiment on a GPU:
+
+    python launcher.py <gpu> <exp_name> <train_path> <out_path>
+
+or, with --schedule, a queue of experiments packed onto the CPUs of this
+host, one per line of the queue file:
+
+    <exp_name> <train_path> <out_path> [<num_cores> [<memory_gb>]]
+
+Experiments without <memory_gb> get the memory per core of the budget for
+each of their cores.
 """
 import argparse
 import os
@@ -6,40 +18,17 @@ import shutil
 import subprocess
 import sys
 
+from anna.parallel.scheduler import Job, Scheduler
 
-if __name__ == "__main__":
 
-    parser = argparse.ArgumentParser(prog='launcher', description='Script to '
-                                     'launch experiments')
-    parser.add_argument('gpu', help='Integer for gpu')
-    parser.add_argument('exp_name', help='Name of experiment')
-    parser.add_argument('train_path',
-                        help='Path to model.py and train.py files')
-    parser.add_argument('out_path', help='Path to to folder to save results')
-    # parser.add_argument('-v', action='store_true', help='Verbose')
-    args = parser.parse_args()
-
-    print('\n========================================================')
-    print('              Anna Experiment Launcher                ')
-    print('========================================================\n')
-
-    exp_name = args.exp_name
-    train_path = args.train_path
-    out_path = args.out_path
-    gpu = args.gpu
+def prepare_experiment(exp_name, train_path, out_path):
+    """
+    Copies model.py and the train scripts of an experiment to its output
+    folder. Returns the output folder, or None if a file is missing.
+    """
     train_path = os.path.join(train_path, exp_name)
     out_path = os.path.join(out_path, exp_name)
 
-    my_env = os.environ
-    my_env['THEANO_FLAGS'] =
-    'floatX=float32,device=gpu{0},nvcc.fastmath=True'.format(gpu)
-
-    print('===================== Inputs ===========================')
-    print('Experiment Name: {}'.format(exp_name))
-    print('Path to train.py and model.py: {}'.format(train_path))
-    print('Out Folder Path: {}'.format(out_path))
-    print('========================================================\n')
-
     # Modify output directory to include experiment name in path
     # Check if output directory exists, if not create it
     if not os.path.exists(out_path):
@@ -53,35 +42,135 @@ if __name__ == "__main__":
 
     if not os.path.exists(model_file_path):
         print('Model File Does Not Exist!')
-        sys.exit(0)
+        return None
     elif not os.path.exists(train_file_path):
         print('Train File Does Not Exist!')
-        sys.exit(0)
+        return None
     elif not os.path.exists(scratch_file_path):
         print('Scratch File Does Not Exist!')
-        sys.exit(0)
+        return None
     elif not os.path.exists(finetune_file_path):
         print('Finetuning File Does Not Exist!')
-        sys.exit(0)
+        return None
 
     shutil.copy(model_file_path, os.path.join(out_path, 'model.py'))
     shutil.copy(train_file_path, os.path.join(out_path, 'train.py'))
     shutil.copy(scratch_file_path, os.path.join(out_path, 'train_scratch.py'))
     shutil.copy(finetune_file_path, os.path.join(out_path,
                                                  'train_finetune.py'))
+    return out_path
+
+
+def get_run_list(exp_name, out_path):
+    return ['python', '-u', os.path.join(out_path, 'train.py'), exp_name,
+            out_path]
+
+
+def read_queue(queue_path):
+    # (exp_name, train_path, out_path, num_cores, memory_gb) of every
+    # non-empty line that is not a # comment
+    experiments = []
+    for line in open(queue_path):
+        fields = line.split('#', 1)[0].split()
+        if not fields:
+            continue
+        if len(fields) < 3 or len(fields) > 5:
+            raise ValueError('Bad queue line: %s' % line.strip())
+        num_cores = int(fields[3]) if len(fields) > 3 else 1
+        memory_gb = float(fields[4]) if len(fields) > 4 else None
+        experiments.append((fields[0], fields[1], fields[2], num_cores,
+                            memory_gb))
+    return experiments
+
+
+def schedule(args):
+    scheduler = Scheduler(num_cores=args.cores, memory_gb=args.memory_gb,
+                          compiledir_root=args.compiledir_root)
+    for exp_name, train_path, out_path, num_cores, memory_gb in \
+            read_queue(args.schedule):
+        exp_out_path = prepare_experiment(exp_name, train_path, out_path)
+        if exp_out_path is None:
+            print('Skipping {}'.format(exp_name))
+            continue
+        scheduler.submit(Job(exp_name, get_run_list(exp_name, exp_out_path),
+                             num_cores=num_cores, memory_gb=memory_gb,
+                             log_path=os.path.join(exp_out_path, 'log.txt'),
+                             pid_path=os.path.join(exp_out_path, 'pid')))
+
+    print('=================== Launch Processes =====================')
+    finished = scheduler.run()
+
+    print('======================= Done ===========================')
+    print('{:<30} {:>8} {:>10} {:>10}'.format('experiment', 'PID',
+                                              'exit code', 'time (s)'))
+    for job in finished:
+        print('{:<30} {:>8} {:>10} {:>10.1f}'.format(
+            job.name, job.pid, job.returncode, job.end_time - job.start_time))
+    if [job for job in finished if job.returncode != 0]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(prog='launcher', description='Script to '
+                                     'launch experiments')
+    parser.add_argument('gpu', nargs='?', help='Integer for gpu')
+    parser.add_argument('exp_name', nargs='?', help='Name of experiment')
+    parser.add_argument('train_path', nargs='?',
+                        help='Path to model.py and train.py files')
+    parser.add_argument('out_path', nargs='?',
+                        help='Path to to folder to save results')
+    parser.add_argument('--schedule', default=None,
+                        help='Queue file of experiments to run on the CPUs')
+    parser.add_argument('--cores', type=int, default=None,
+                        help='Cores to schedule on (default: all)')
+    parser.add_argument('--memory_gb', type=float, default=None,
+                        help='Memory budget (default: all)')
+    parser.add_argument('--compiledir_root', default=None,
+                        help='Folder for the per-experiment Theano '
+                        'compiledirs')
+    # parser.add_argument('-v', action='store_true', help='Verbose')
+    args = parser.parse_args()
+
+    print('\n========================================================')
+    print('              Anna Experiment Launcher                ')
+    print('========================================================\n')
+
+    if args.schedule is not None:
+        schedule(args)
+        sys.exit(0)
+    if args.out_path is None:
+        parser.error('gpu, exp_name, train_path and out_path are required '
+                     'without --schedule')
+
+    exp_name = args.exp_name
+    train_path = args.train_path
+    out_path = args.out_path
+    gpu = args.gpu
+
+    my_env = os.environ
+    my_env['THEANO_FLAGS'] = \
+        'floatX=float32,device=gpu{0},nvcc.fastmath=True'.format(gpu)
+
+    print('===================== Inputs ===========================')
+    print('Experiment Name: {}'.format(exp_name))
+    print('Path to train.py and model.py: {}'.format(
+        os.path.join(train_path, exp_name)))
+    print('Out Folder Path: {}'.format(os.path.join(out_path, exp_name)))
+    print('========================================================\n')
+
+    out_path = prepare_experiment(exp_name, train_path, out_path)
+    if out_path is None:
+        sys.exit(0)
 
     print('=================== Launch Process =======================')
 
     # Launch Process
     log_file = os.path.join(out_path, 'log.txt')
     f_log = open(log_file, 'wb')
-    run_str = "python -u {0} {1} {2}".format(os.path.join(out_path,
-                                             'train.py'),
-                                             exp_name,
-                                             out_path)
-    run_list = run_str.split()
+    run_list = get_run_list(exp_name, out_path)
     print run_list
-    print('Running: {}'.format(run_str))
+    print('Running: {}'.format(' '.join(run_list)))
     child_proc = subprocess.Popen(run_list,
                                   stdout=f_log,
                                   stderr=f_log,
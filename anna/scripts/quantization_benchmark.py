@@ -0,0 +1,58 @@
+"""Script to quantize an exported model to int8 and compare it to float32.
+"""
+import argparse
+
+import numpy
+
+from anna.inference import runtime, quantize
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(prog='quantization_benchmark',
+                                     description='Script to quantize an '
+                                     'exported model to int8 and report its '
+                                     'accuracy and throughput')
+    parser.add_argument('model_path', help='Path to exported model .npz file')
+    parser.add_argument('X_path', help='Path to test samples .npy file (bc01)')
+    parser.add_argument('y_path', help='Path to test labels .npy file')
+    parser.add_argument('output_path', help='Path to write int8 model to')
+    parser.add_argument('--calibration_path', default=None,
+                        help='Samples to calibrate on (default: X_path)')
+    parser.add_argument('--num_calibration_samples', type=int, default=1024,
+                        help='Number of samples to calibrate on')
+    parser.add_argument('--percentile', type=float, default=None,
+                        help='Calibrate ranges to this percentile instead '
+                        'of the maximum')
+    parser.add_argument('--batch_sizes', default='1,16,128',
+                        help='Comma separated batch sizes to benchmark')
+    args = parser.parse_args()
+
+    X = numpy.load(args.X_path, mmap_mode='r')
+    y = numpy.load(args.y_path)
+    if args.calibration_path is not None:
+        X_calibration = numpy.load(args.calibration_path, mmap_mode='r')
+    else:
+        X_calibration = X
+
+    float_model = runtime.load(args.model_path)
+    int8_model = quantize.quantize_model(
+        args.model_path, args.output_path, X_calibration,
+        num_samples=args.num_calibration_samples,
+        percentile=args.percentile)
+
+    report = quantize.quantization_report(float_model, int8_model, X, y)
+    print('float32 accuracy: {:.2f}'.format(report['float32']))
+    print('int8 accuracy: {:.2f}'.format(report['int8']))
+    print('accuracy drop: {:.2f}'.format(report['drop']))
+
+    print('{:>8} {:>16} {:>16} {:>8}'.format(
+        'batch', 'float32 (img/s)', 'int8 (img/s)', 'speedup'))
+    for batch_size in [int(b) for b in args.batch_sizes.split(',')]:
+        float_throughput = quantize.measure_throughput(float_model, X,
+                                                       batch_size)
+        int8_throughput = quantize.measure_throughput(int8_model, X,
+                                                      batch_size)
+        print('{:>8} {:>16.1f} {:>16.1f} {:>8.2f}'.format(
+            batch_size, float_throughput, int8_throughput,
+            int8_throughput / float_throughput))
@@ -0,0 +1,61 @@
+"""Script to benchmark recall versus latency of the retrieval indexes.
+"""
+import argparse
+
+import numpy
+
+from anna.features import retrieval
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(prog='retrieval_benchmark',
+                                     description='Script to benchmark '
+                                     'recall versus latency of retrieval '
+                                     'indexes')
+    parser.add_argument('features_path', help='Path to features .npy file')
+    parser.add_argument('--num_queries', type=int, default=1000,
+                        help='Number of queries held out from the corpus')
+    parser.add_argument('--k', type=int, default=10, help='Neighbours')
+    parser.add_argument('--metric', default='l2', help='l2 or cosine')
+    parser.add_argument('--num_threads', type=int, default=4,
+                        help='Threads used to search blocks of queries')
+    args = parser.parse_args()
+
+    features = numpy.load(args.features_path, mmap_mode='r')
+    queries = numpy.asarray(features[0:args.num_queries], dtype=numpy.float32)
+    corpus = features[args.num_queries:]
+    print('Corpus: {}, Queries: {}'.format(corpus.shape, queries.shape))
+
+    exact_index = retrieval.ExactIndex(corpus, metric=args.metric,
+                                       num_threads=args.num_threads)
+    __, ground_truth_ids = exact_index.search(queries, args.k)
+    recall, milliseconds = retrieval.benchmark(exact_index, queries,
+                                               ground_truth_ids, args.k)
+
+    print('{:>12} {:>12} {:>8} {:>10} {:>12}'.format(
+        'index', 'components', 'bytes', 'recall', 'ms/query'))
+    print('{:>12} {:>12} {:>8} {:>10.4f} {:>12.3f}'.format(
+        'exact', corpus.shape[1], 4 * corpus.shape[1], recall, milliseconds))
+
+    num_components = min(128, corpus.shape[1])
+    for num_subspaces in [8, 16, 32]:
+        if num_components % num_subspaces != 0:
+            continue
+        pq_index = retrieval.PQIndex(num_components=num_components,
+                                     num_subspaces=num_subspaces,
+                                     metric=args.metric,
+                                     num_threads=args.num_threads)
+        pq_index.fit(corpus)
+        for rerank in [None, 10 * args.k]:
+            if rerank:
+                recall, milliseconds = retrieval.benchmark(
+                    pq_index, queries, ground_truth_ids, args.k,
+                    features=corpus, rerank=rerank)
+                name = 'pq+rerank'
+            else:
+                recall, milliseconds = retrieval.benchmark(
+                    pq_index, queries, ground_truth_ids, args.k)
+                name = 'pq'
+            print('{:>12} {:>12} {:>8} {:>10.4f} {:>12.3f}'.format(
+                name, num_components, num_subspaces, recall, milliseconds))
@@ -0,0 +1,136 @@
+"""Script to benchmark the TCP ring all-reduce and data-parallel training
+over it. Without --rank it starts --world_size ranks on localhost; on
+several machines, run it once per rank with the same --addresses.
+"""
+import argparse
+import os
+
+# One BLAS / OpenMP thread per rank, set before numpy and theano load
+os.environ.setdefault('OMP_NUM_THREADS', '1')
+os.environ.setdefault('OPENBLAS_NUM_THREADS', '1')
+os.environ.setdefault('MKL_NUM_THREADS', '1')
+
+import multiprocessing
+from time import time
+
+import numpy
+
+from anna.layers import layers
+from anna.models import SupervisedModel
+from anna.parallel.ring import Ring, RingTrainer
+
+
+def make_model(shard_size, image_size, num_filters, num_classes):
+    class BenchmarkModel(SupervisedModel):
+        batch = shard_size
+        input = layers.Input2DLayer(shard_size, 3, image_size, image_size)
+        conv1 = layers.Conv2DLayer(input, num_filters, 5, 5, 0.01, 0.0)
+        pool1 = layers.Pooling2DLayer(conv1, (2, 2))
+        conv2 = layers.Conv2DLayer(pool1, num_filters, 5, 5, 0.01, 0.0)
+        pool2 = layers.Pooling2DLayer(conv2, (2, 2))
+        output = layers.DenseLayer(pool2, num_classes, 0.01, 0.0,
+                                   nonlinearity=layers.softmax)
+    return BenchmarkModel('benchmark', None, learning_rate=0.01)
+
+
+def benchmark_allreduce(ring, sizes_mb, num_runs):
+    # Algorithm bandwidth (buffer size / time) and bus bandwidth (bytes
+    # each rank actually sent / time)
+    n = ring.world_size
+    results = []
+    for size_mb in sizes_mb:
+        buffer = numpy.ones(int(size_mb * (1 << 20)) // 4,
+                            dtype=numpy.float32)
+        ring.allreduce(buffer)
+        ring.barrier()
+        tic = time()
+        for i in xrange(num_runs):
+            ring.allreduce(buffer)
+        seconds = (time() - tic) / num_runs
+        algorithm_bandwidth = buffer.nbytes / seconds / (1 << 20)
+        results.append((size_mb, 1000 * seconds, algorithm_bandwidth,
+                        algorithm_bandwidth * 2 * (n - 1) / n))
+    return results
+
+
+def run_rank(rank, args):
+    addresses = args.addresses.split(',')
+    ring = Ring(rank, addresses, segment_size=args.segment_kb * 1024)
+
+    results = benchmark_allreduce(
+        ring, [float(s) for s in args.sizes_mb.split(',')], args.num_runs)
+    if rank == 0:
+        print('all-reduce over {} ranks'.format(ring.world_size))
+        print('{:>10} {:>10} {:>14} {:>14}'.format(
+            'size (MB)', 'time (ms)', 'algbw (MB/s)', 'busbw (MB/s)'))
+        for result in results:
+            print('{:>10.2f} {:>10.2f} {:>14.1f} {:>14.1f}'.format(*result))
+
+    rng = numpy.random.RandomState(0)
+    X = rng.randn(1024, 3, args.image_size, args.image_size)
+    X = X.astype(numpy.float32)
+    y = rng.randint(0, args.num_classes, len(X))
+    model = make_model(args.batch_size // ring.world_size, args.image_size,
+                       args.num_filters, args.num_classes)
+    trainer = RingTrainer(model, ring)
+    trainer.train(X, y, args.batch_size, 2)
+    ring.barrier()
+    tic = time()
+    trainer.train(X, y, args.batch_size, args.num_steps)
+    step_time = (time() - tic) / args.num_steps
+
+    if rank == 0:
+        timings = trainer.timings
+        print('training, batch {} over {} ranks: {:.1f} ms/step, '
+              '{:.1f} samples/s'.format(args.batch_size, ring.world_size,
+                                        1000 * step_time,
+                                        args.batch_size / step_time))
+        for key in ['data', 'gradient', 'allreduce', 'apply']:
+            print('{:>10}: {:8.2f} ms/step'.format(
+                key, 1000 * timings[key] / args.num_steps))
+        allreduce_seconds = max(timings['allreduce'], 1e-9)
+        print('{:>10}: {:8.1f} MB/s sent during all-reduce'.format(
+            'bandwidth', timings['bytes_sent'] / allreduce_seconds /
+            (1 << 20)))
+    ring.close()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(prog='ring_allreduce_benchmark',
+                                     description='Script to benchmark the '
+                                     'TCP ring all-reduce and data-parallel '
+                                     'training over it')
+    parser.add_argument('--rank', type=int, default=None,
+                        help='Rank of this process (default: start all '
+                        'ranks on localhost)')
+    parser.add_argument('--world_size', type=int, default=4,
+                        help='Number of local ranks when --rank is not set')
+    parser.add_argument('--addresses', default=None,
+                        help='Comma separated host:port of every rank')
+    parser.add_argument('--segment_kb', type=int, default=256,
+                        help='Pipelining segment size')
+    parser.add_argument('--sizes_mb', default='1,4,16,64',
+                        help='Comma separated all-reduce buffer sizes')
+    parser.add_argument('--num_runs', type=int, default=5,
+                        help='Timed all-reduce runs per size')
+    parser.add_argument('--batch_size', type=int, default=128)
+    parser.add_argument('--image_size', type=int, default=32)
+    parser.add_argument('--num_filters', type=int, default=32)
+    parser.add_argument('--num_classes', type=int, default=10)
+    parser.add_argument('--num_steps', type=int, default=20,
+                        help='Timed training steps')
+    args = parser.parse_args()
+
+    if args.rank is not None:
+        run_rank(args.rank, args)
+    else:
+        if args.addresses is None:
+            args.addresses = ','.join(['127.0.0.1:%d' % (29500 + rank)
+                                       for rank in xrange(args.world_size)])
+        ranks = [multiprocessing.Process(target=run_rank, args=(rank, args))
+                 for rank in xrange(len(args.addresses.split(',')))]
+        for process in ranks:
+            process.start()
+        for process in ranks:
+            process.join()
@@ -0,0 +1,91 @@
+"""Script to benchmark throughput versus tail latency of the inference server.
+"""
+import argparse
+import os
+import tempfile
+import threading
+from time import time
+
+import numpy
+
+from anna.inference import runtime, server
+
+
+def run_clients(socket_path, samples, concurrency, num_requests):
+    """
+    Closed-loop load: every client sends its next request as soon as it got
+    the previous answer. Returns requests per second and the client side
+    latency histogram.
+    """
+    latencies = server.LatencyHistogram()
+
+    def client_loop(client_index):
+        client = server.InferenceClient(socket_path)
+        for i in xrange(client_index, num_requests, concurrency):
+            tic = time()
+            client.predict(samples[i % len(samples)])
+            latencies.record(time() - tic)
+        client.close()
+
+    threads = [threading.Thread(target=client_loop, args=(i,))
+               for i in xrange(concurrency)]
+    tic = time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    toc = time()
+    return num_requests / (toc - tic), latencies
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(prog='serving_benchmark',
+                                     description='Script to benchmark '
+                                     'throughput versus tail latency of the '
+                                     'micro-batching inference server')
+    parser.add_argument('model_path', help='Path to exported model .npz file')
+    parser.add_argument('--max_batch_size', type=int, default=128,
+                        help='Largest batch formed by the server')
+    parser.add_argument('--max_delays_ms', default='0,1,5,20',
+                        help='Comma separated batching deadlines')
+    parser.add_argument('--concurrency', default='1,8,32,128',
+                        help='Comma separated numbers of concurrent clients')
+    parser.add_argument('--num_requests', type=int, default=2000,
+                        help='Requests sent per setting')
+    parser.add_argument('--pad_batches', action='store_true',
+                        help='Zero-pad every batch to max_batch_size')
+    args = parser.parse_args()
+
+    inference_model = runtime.load(args.model_path)
+    rng = numpy.random.RandomState(0)
+    samples = rng.randn(256, *inference_model.graph['input']['shape'])
+    samples = samples.astype(numpy.float32)
+    if inference_model.data_order == 'c01b':
+        batch_axis = 3
+    else:
+        batch_axis = 0
+
+    socket_path = os.path.join(tempfile.mkdtemp(), 'inference.sock')
+    print('{:>10} {:>8} {:>10} {:>10} {:>10} {:>10}'.format(
+        'delay (ms)', 'clients', 'req/s', 'p50 (ms)', 'p99 (ms)',
+        'batch'))
+    for max_delay_ms in [float(d) for d in args.max_delays_ms.split(',')]:
+        for concurrency in [int(c) for c in args.concurrency.split(',')]:
+            batcher = server.MicroBatcher(inference_model.predict,
+                                          args.max_batch_size,
+                                          max_delay=max_delay_ms / 1000.0,
+                                          batch_axis=batch_axis,
+                                          pad_batches=args.pad_batches)
+            inference_server = server.InferenceServer(socket_path, batcher)
+            inference_server.start()
+            throughput, latencies = run_clients(
+                socket_path, samples, concurrency, args.num_requests)
+            stats = batcher.stats()
+            inference_server.stop()
+            print('{:>10.1f} {:>8} {:>10.1f} {:>10.2f} {:>10.2f} '
+                  '{:>10.1f}'.format(
+                      max_delay_ms, concurrency, throughput,
+                      1000 * latencies.percentile(50),
+                      1000 * latencies.percentile(99),
+                      stats['mean_batch_size']))
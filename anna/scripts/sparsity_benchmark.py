@@ -0,0 +1,78 @@
+"""Script to benchmark latency versus sparsity of pruned Dense layers.
+"""
+import argparse
+from time import time
+
+import numpy
+
+from anna.inference import runtime
+from anna.layers.pruning import compute_magnitude_mask
+
+
+def make_graph(W, b, sparsity, sparse):
+    """
+    Graph of a single ReLU Dense layer, with W pruned to the given sparsity.
+    """
+    W = W * compute_magnitude_mask(W, sparsity)
+    node = {'name': 'dense', 'inputs': ['input'], 'nonlinearity': 'relu'}
+    arrays = {'b': b}
+    if sparse:
+        data, indices, indptr = runtime.to_csr(W)
+        arrays.update({'data': data, 'indices': indices, 'indptr': indptr})
+        node.update({'type': 'dense_csr', 'attrs': {'shape': list(W.shape)},
+                     'params': {'data': 'data', 'indices': 'indices',
+                                'indptr': 'indptr', 'b': 'b'}})
+    else:
+        arrays['W'] = W
+        node.update({'type': 'dense', 'params': {'W': 'W', 'b': 'b'}})
+    graph = {'format': runtime.FORMAT, 'version': runtime.VERSION,
+             'input': {'name': 'input', 'shape': [W.shape[0]],
+                       'data_order': 'flat'},
+             'output': 'dense', 'nodes': [node]}
+    return runtime.InferenceModel(graph, arrays)
+
+
+def measure_latency(inference_model, x, num_runs):
+    inference_model.predict(x)
+    tic = time()
+    for i in xrange(num_runs):
+        inference_model.predict(x)
+    toc = time()
+    return 1000.0 * (toc - tic) / num_runs
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(prog='sparsity_benchmark',
+                                     description='Script to benchmark '
+                                     'latency versus sparsity of pruned '
+                                     'Dense layers')
+    parser.add_argument('--n_inputs', type=int, default=4096,
+                        help='Number of inputs of the Dense layer')
+    parser.add_argument('--n_outputs', type=int, default=4096,
+                        help='Number of outputs of the Dense layer')
+    parser.add_argument('--batch_sizes', default='1,16,128',
+                        help='Comma separated batch sizes')
+    parser.add_argument('--sparsities', default='0.5,0.8,0.9,0.95,0.99',
+                        help='Comma separated fractions of pruned weights')
+    parser.add_argument('--num_runs', type=int, default=20,
+                        help='Number of timed runs per setting')
+    args = parser.parse_args()
+
+    rng = numpy.random.RandomState(0)
+    W = rng.randn(args.n_inputs, args.n_outputs).astype(numpy.float32)
+    b = numpy.zeros(args.n_outputs, dtype=numpy.float32)
+    batch_sizes = [int(s) for s in args.batch_sizes.split(',')]
+    sparsities = [float(s) for s in args.sparsities.split(',')]
+
+    print('{:>8} {:>8} {:>12} {:>12} {:>8}'.format(
+        'batch', 'sparsity', 'dense (ms)', 'csr (ms)', 'speedup'))
+    for batch_size in batch_sizes:
+        x = rng.randn(batch_size, args.n_inputs).astype(numpy.float32)
+        dense_ms = measure_latency(make_graph(W, b, 0.0, False), x,
+                                   args.num_runs)
+        for sparsity in sparsities:
+            csr_ms = measure_latency(make_graph(W, b, sparsity, True), x,
+                                     args.num_runs)
+            print('{:>8} {:>8.2f} {:>12.3f} {:>12.3f} {:>8.2f}'.format(
+                batch_size, sparsity, dense_ms, csr_ms, dense_ms / csr_ms))
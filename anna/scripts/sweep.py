@@ -0,0 +1,70 @@
+"""Script to run a hyperparameter sweep of an experiment.
+
+    python sweep.py <spec.json> <train_path> <out_path>
+
+The spec file holds a 'grid' of {name: [values]}, and/or a 'random' search
+space of {name: {'log_uniform': [low, high]}, ...} sampled 'num_samples'
+times with 'seed', plus 'fixed' values given to every run (see
+anna.parallel.sweep). train.py reads its values with
+sweep.get_config(out_path). Re-running the same command skips the runs that
+finished and prints the results table again.
+
+With --min_steps and --max_steps the sweep does successive halving: all
+configurations train for min_steps steps and the best 1 / eta are resumed
+from their checkpoints for eta times as many, up to max_steps.
+"""
+import argparse
+import json
+import os
+import sys
+
+from anna.parallel import sweep
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(prog='sweep', description='Script to '
+                                     'run a hyperparameter sweep')
+    parser.add_argument('spec', help='JSON file with the search space')
+    parser.add_argument('train_path',
+                        help='Path to the model.py and train.py files')
+    parser.add_argument('out_path', help='Path to the folder to save runs in')
+    parser.add_argument('--max_concurrent', type=int, default=1,
+                        help='Number of runs at the same time')
+    parser.add_argument('--cores', type=int, default=1,
+                        help='Cores of every run')
+    parser.add_argument('--memory_gb', type=float, default=None,
+                        help='Memory of every run (default: the memory per '
+                        'core of the host for each of its cores)')
+    parser.add_argument('--compiledir_root', default=None,
+                        help='Folder for the per-run Theano compiledirs')
+    parser.add_argument('--min_steps', type=int, default=None,
+                        help='Budget of the first successive halving rung')
+    parser.add_argument('--max_steps', type=int, default=None,
+                        help='Budget of the last successive halving rung')
+    parser.add_argument('--eta', type=int, default=2,
+                        help='Keep the best 1 / eta runs of every rung')
+    args = parser.parse_args()
+
+    spec = json.load(open(args.spec))
+    kwargs = {'max_concurrent': args.max_concurrent, 'num_cores': args.cores,
+              'memory_gb': args.memory_gb,
+              'compiledir_root': args.compiledir_root}
+    if args.min_steps is None:
+        runner = sweep.Sweep(spec, args.train_path, args.out_path, **kwargs)
+        results = runner.run()
+    else:
+        if args.max_steps is None:
+            parser.error('--max_steps is required with --min_steps')
+        runner = sweep.SuccessiveHalving(spec, args.train_path,
+                                         args.out_path, args.min_steps,
+                                         args.max_steps, eta=args.eta,
+                                         **kwargs)
+        results = runner.run()[-1]
+
+    table = sweep.format_results(results)
+    print(table)
+    with open(os.path.join(args.out_path, 'results.txt'), 'wb') as f:
+        f.write(table + '\n')
+    if [result for result in results if result['returncode'] != 0]:
+        sys.exit(1)
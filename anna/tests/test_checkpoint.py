@@ -0,0 +1,108 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+import theano
+
+try:
+    from anna import util
+except ImportError:
+    # anna.util needs PIL, scikit-image and pylearn2
+    util = None
+from anna.parallel import sweep
+
+
+class FakeModel(object):
+    def __init__(self, path, with_ema=True):
+        self.name = 'model'
+        self.path = path
+        rng = numpy.random.RandomState(0)
+        self.all_save_parameters_symbol = [
+            theano.shared(numpy.float32(rng.randn(4, 3))),
+            theano.shared(numpy.float32(rng.randn(3)))]
+        if with_ema:
+            for param in self.all_save_parameters_symbol:
+                param.tag.ema_shadow = theano.shared(
+                    numpy.float32(param.get_value() + 1.0))
+
+
+@unittest.skipIf(util is None, 'anna.util dependencies are not installed')
+class TestCheckpoint(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.path, 'checkpoints'))
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_checkpoint_holds_only_parameters(self):
+        model = FakeModel(self.path)
+        checkpoint_path = util.save_checkpoint(model, 'checkpoints')
+
+        checkpoint = util.read_checkpoint(checkpoint_path)
+        self.assertEqual(len(checkpoint), 2)
+        for param, value in zip(model.all_save_parameters_symbol,
+                                checkpoint):
+            numpy.testing.assert_array_equal(param.get_value(), value)
+        ema_checkpoint = util.read_ema_checkpoint(checkpoint_path)
+        self.assertEqual(len(ema_checkpoint), 2)
+
+    def test_round_trip_restores_shadows(self):
+        model = FakeModel(self.path)
+        checkpoint_path = util.save_checkpoint(model, 'checkpoints')
+        params = [p.get_value() for p in model.all_save_parameters_symbol]
+        shadows = [s.get_value() for s in util.get_ema_shadows(model)]
+
+        for variable in (model.all_save_parameters_symbol +
+                         util.get_ema_shadows(model)):
+            variable.set_value(numpy.zeros_like(variable.get_value()))
+        util.load_checkpoint(model, checkpoint_path)
+
+        for param, value in zip(model.all_save_parameters_symbol, params):
+            numpy.testing.assert_array_equal(param.get_value(), value)
+        for shadow, value in zip(util.get_ema_shadows(model), shadows):
+            numpy.testing.assert_array_equal(shadow.get_value(), value)
+
+    def test_without_ema_file_shadows_restart_from_parameters(self):
+        saved = FakeModel(self.path, with_ema=False)
+        checkpoint_path = util.save_checkpoint(saved, 'checkpoints')
+        self.assertFalse(os.path.exists(
+            util.get_ema_checkpoint_path(checkpoint_path)))
+
+        model = FakeModel(self.path)
+        util.load_checkpoint(model, checkpoint_path)
+        for param in model.all_save_parameters_symbol:
+            numpy.testing.assert_array_equal(
+                param.tag.ema_shadow.get_value(), param.get_value())
+
+    def test_unsupervised_checkpoint_loads_into_deeper_model(self):
+        model = FakeModel(self.path)
+        checkpoint_path = util.save_checkpoint(model, 'checkpoints')
+
+        deeper = FakeModel(self.path)
+        first = numpy.float32(numpy.ones((5, 4)))
+        deeper.all_save_parameters_symbol.insert(0, theano.shared(first))
+        util.set_parameters_from_unsupervised_model(deeper, checkpoint_path)
+
+        numpy.testing.assert_array_equal(
+            deeper.all_save_parameters_symbol[0].get_value(), first)
+        for param, value in zip(deeper.all_save_parameters_symbol[1:],
+                                model.all_save_parameters_symbol):
+            numpy.testing.assert_array_equal(param.get_value(),
+                                             value.get_value())
+
+    def test_latest_checkpoint_skips_ema_file(self):
+        model = FakeModel(self.path)
+        checkpoint_path = util.save_checkpoint(model, 'checkpoints')
+        ema_path = util.get_ema_checkpoint_path(checkpoint_path)
+        # The moving averages are written last, so they are the newest file
+        os.utime(ema_path, (os.path.getmtime(checkpoint_path) + 10,) * 2)
+        self.assertEqual(sweep.get_latest_checkpoint(self.path),
+                         checkpoint_path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+import theano
+import theano.tensor as T
+
+from anna.layers import layers
+from anna.datasets.supervised_data_loader import SupervisedDataLoaderCrossVal
+from anna.parallel.cross_validation import CrossValidator
+
+
+class SoftmaxModel(object):
+    # The parts of a SupervisedModel that CrossValidator uses
+    def __init__(self, batch=8):
+        self.batch = batch
+        self.input = layers.Input2DLayer(batch, 1, 2, 2)
+        self.input.input_var = T.ftensor4('input')
+        numpy.random.seed(0)
+        self.output = layers.DenseLayer(self.input, 2, 0.01, 0.0,
+                                        nonlinearity=layers.softmax)
+        self.y = T.ivector('y')
+        prediction = self._get_output_symbol()
+        cost = T.nnet.categorical_crossentropy(prediction, self.y).mean()
+        updates = [(param, param - numpy.float32(0.5) * T.grad(cost, param))
+                   for param in self.output.params]
+        self.train_func = theano.function([self.input.input_var, self.y],
+                                          cost, updates=updates)
+
+    def _get_input_symbol(self):
+        return self.input.input_var
+
+    def _get_output_symbol(self, dropout_active=True):
+        return self.output.output(dropout_active=dropout_active)
+
+    def train(self, x_batch, y_batch):
+        return self.train_func(x_batch, y_batch)
+
+
+def make_dataset(path, num_samples=60, num_folds=3):
+    rng = numpy.random.RandomState(0)
+    y = numpy.int32(rng.randint(0, 2, num_samples))
+    centers = numpy.float32([[-2.0], [2.0]])[y].reshape(-1, 1, 1, 1)
+    X = numpy.float32(rng.randn(num_samples, 1, 2, 2)) + centers
+    folds = numpy.arange(num_samples) % num_folds
+    numpy.save(os.path.join(path, 'X.npy'), X)
+    numpy.save(os.path.join(path, 'y.npy'), y)
+    numpy.save(os.path.join(path, 'folds.npy'), folds)
+    return X, y, folds
+
+
+class TestCrossValLoader(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.X, self.y, self.folds = make_dataset(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_fold_indices_partition_samples(self):
+        loader = SupervisedDataLoaderCrossVal(self.path)
+        all_test = []
+        for fold in xrange(3):
+            train, test = loader.get_fold_indices(fold)
+            self.assertEqual(len(numpy.intersect1d(train, test)), 0)
+            numpy.testing.assert_array_equal(
+                numpy.sort(numpy.concatenate([train, test])),
+                numpy.arange(60))
+            self.assertTrue(numpy.all(self.folds[test] == fold))
+            all_test.append(test)
+        numpy.testing.assert_array_equal(
+            numpy.sort(numpy.concatenate(all_test)), numpy.arange(60))
+
+    def test_load_train_and_test(self):
+        loader = SupervisedDataLoaderCrossVal(self.path)
+        train = loader.load('train', 1)
+        test = loader.load('test', 1)
+        numpy.testing.assert_array_equal(train.X, self.X[self.folds != 1])
+        numpy.testing.assert_array_equal(train.y, self.y[self.folds != 1])
+        numpy.testing.assert_array_equal(test.X, self.X[self.folds == 1])
+        numpy.testing.assert_array_equal(test.y, self.y[self.folds == 1])
+
+    def test_memory_mapped_arrays_are_read_once(self):
+        loader = SupervisedDataLoaderCrossVal(self.path, mmap_mode='r')
+        X, y, folds = loader.load_arrays()
+        self.assertTrue(isinstance(X, numpy.memmap))
+        self.assertTrue(loader.load_arrays()[0] is X)
+        numpy.testing.assert_array_equal(loader.load('test', 2).X,
+                                         self.X[self.folds == 2])
+
+    def test_missing_fold(self):
+        loader = SupervisedDataLoaderCrossVal(self.path)
+        self.assertRaises(AssertionError, loader.get_fold_indices, 3)
+
+
+class TestCrossValidator(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        make_dataset(self.path)
+        self.model = SoftmaxModel()
+        self.initial_W = self.model.output.W.get_value()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_trains_every_fold(self):
+        validator = CrossValidator(self.model, self.path, num_steps=10)
+        results = validator.run()
+        self.assertEqual([result['fold'] for result in results], [0, 1, 2])
+        for result in results:
+            self.assertEqual(result['num_train'], 40)
+            self.assertEqual(result['num_test'], 20)
+            self.assertGreater(result['accuracy'], 90.0)
+        # The model is left in its initial state
+        numpy.testing.assert_array_equal(self.model.output.W.get_value(),
+                                         self.initial_W)
+
+    def test_workers_match_single_process(self):
+        serial = CrossValidator(self.model, self.path, num_steps=7).run()
+        parallel = CrossValidator(self.model, self.path, num_steps=7,
+                                  num_workers=2, mmap_mode=None).run()
+        self.assertEqual(parallel, serial)
+        numpy.testing.assert_array_equal(self.model.output.W.get_value(),
+                                         self.initial_W)
+
+    def test_selected_folds(self):
+        validator = CrossValidator(self.model, self.path, num_steps=3)
+        results = validator.run(folds=[2])
+        self.assertEqual([result['fold'] for result in results], [2])
+
+    def test_fold_smaller_than_a_minibatch(self):
+        validator = CrossValidator(SoftmaxModel(batch=64), self.path,
+                                   num_steps=1)
+        self.assertRaises(ValueError, validator.run)
+
+
+if __name__ == '__main__':
+    unittest.main()
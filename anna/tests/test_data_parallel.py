@@ -0,0 +1,71 @@
+import os
+import signal
+import time
+import unittest
+import multiprocessing
+
+import numpy
+
+import theano
+
+from anna.layers import layers
+from anna.parallel.data_parallel import Barrier, get_chunk, \
+    seed_random_streams
+
+
+def wait_twice(barrier):
+    barrier.wait()
+    barrier.wait()
+
+
+class TestBarrier(unittest.TestCase):
+    def test_releases_all_workers(self):
+        barrier = Barrier(3)
+        workers = [multiprocessing.Process(target=wait_twice,
+                                           args=(barrier,))
+                   for i in xrange(2)]
+        for worker in workers:
+            worker.start()
+        barrier.watch(workers)
+        wait_twice(barrier)
+        for worker in workers:
+            worker.join()
+            self.assertEqual(worker.exitcode, 0)
+
+    def test_killed_worker_aborts_barrier(self):
+        barrier = Barrier(2)
+        worker = multiprocessing.Process(target=time.sleep, args=(60,))
+        worker.daemon = True
+        worker.start()
+        barrier.watch([worker])
+        os.kill(worker.pid, signal.SIGKILL)
+
+        tic = time.time()
+        self.assertRaises(RuntimeError, barrier.wait)
+        self.assertLess(time.time() - tic, 10.0)
+        worker.join()
+        # Later waits fail at once
+        self.assertRaises(RuntimeError, barrier.wait)
+
+
+class TestDataParallelHelpers(unittest.TestCase):
+    def test_chunks_cover_vector(self):
+        for size in (1, 10, 11):
+            covered = numpy.zeros(size, dtype=int)
+            for rank in xrange(4):
+                covered[get_chunk(rank, 4, size)] += 1
+            self.assertTrue(numpy.all(covered == 1))
+
+    def test_seed_random_streams_reseeds_compiled_functions(self):
+        sample = theano.function([], layers.srng.uniform((16,)))
+        seed_random_streams(1)
+        first = sample()
+        seed_random_streams(2)
+        second = sample()
+        seed_random_streams(1)
+        numpy.testing.assert_array_equal(sample(), first)
+        self.assertFalse(numpy.allclose(first, second))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+from anna.layers import layers
+try:
+    from anna.features.extractor import FeatureExtractor
+except ImportError:
+    # anna.util needs PIL, scikit-image and pylearn2
+    FeatureExtractor = None
+
+
+class DenseModel(object):
+    def __init__(self):
+        self.batch = 4
+        self.input = layers.FlatInputLayer(self.batch, 5)
+        self.hidden = layers.DenseLayer(self.input, n_outputs=3,
+                                        weights_std=1.0, init_bias_value=0.0)
+        self.output = self.hidden
+        self.all_save_parameters_symbol = layers.all_parameters(self.output)
+
+    def _get_input_symbol(self):
+        return self.input.output()
+
+    def get_features(self, X):
+        return numpy.maximum(numpy.dot(X, self.hidden.W.get_value()) +
+                             self.hidden.b.get_value(), 0)
+
+
+class DataContainer(object):
+    def __init__(self, X):
+        self.X = X
+
+
+@unittest.skipIf(FeatureExtractor is None,
+                 'anna.util dependencies are not installed')
+class TestFeatureExtractor(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.rng = numpy.random.RandomState(0)
+        self.model = DenseModel()
+        self.X = numpy.float32(self.rng.randn(10, 5))
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def extract(self, X):
+        extractor = FeatureExtractor(self.model, ['hidden'], self.path)
+        return numpy.array(extractor.run(DataContainer(X))[0])
+
+    def test_extracts_features(self):
+        numpy.testing.assert_allclose(self.extract(self.X),
+                                      self.model.get_features(self.X),
+                                      rtol=1e-5)
+
+    def test_resumes_at_flushed_sample(self):
+        extractor = FeatureExtractor(self.model, ['hidden'], self.path)
+        identity = extractor._get_identity(self.X)
+        features = extractor._open_features(10, resume=False)
+        features[0][:] = -1.0
+        extractor._flush(features, 4, identity)
+        del features
+
+        result = self.extract(self.X)
+        numpy.testing.assert_array_equal(result[0:4], -1.0)
+        numpy.testing.assert_allclose(result[4:],
+                                      self.model.get_features(self.X[4:]),
+                                      rtol=1e-5)
+
+    def test_new_parameters_are_extracted_again(self):
+        self.extract(self.X)
+        self.model.hidden.W.set_value(
+            numpy.float32(self.rng.randn(5, 3)))
+        numpy.testing.assert_allclose(self.extract(self.X),
+                                      self.model.get_features(self.X),
+                                      rtol=1e-5)
+
+    def test_new_data_is_extracted_again(self):
+        self.extract(self.X)
+        X = numpy.float32(self.rng.randn(10, 5))
+        numpy.testing.assert_allclose(self.extract(X),
+                                      self.model.get_features(X),
+                                      rtol=1e-5)
+
+    def test_progress_without_identity_is_ignored(self):
+        self.extract(self.X)
+        f = open(os.path.join(self.path, 'progress.txt'), 'wb')
+        f.write('10\n')
+        f.close()
+        features = numpy.load(os.path.join(self.path, 'hidden.npy'),
+                              mmap_mode='r+')
+        features[:] = -1.0
+        del features
+        numpy.testing.assert_allclose(self.extract(self.X),
+                                      self.model.get_features(self.X),
+                                      rtol=1e-5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+import os
+import signal
+import time
+import unittest
+import multiprocessing
+
+import numpy
+
+import theano
+import theano.tensor as T
+
+from anna.layers import layers
+from anna.parallel.hogwild import HogwildTrainer
+
+
+class SoftmaxModel(object):
+    # The parts of a SupervisedModel that HogwildTrainer uses
+    def __init__(self, batch=8):
+        self.input = layers.Input2DLayer(batch, 1, 2, 2)
+        self.input.input_var = T.ftensor4('input')
+        numpy.random.seed(0)
+        self.output = layers.DenseLayer(self.input, 2, 0.01, 0.0,
+                                        nonlinearity=layers.softmax)
+        self.all_trainable_parameters_symbol = self.output.params
+        self.y = T.ivector('y')
+
+    def _get_input_symbol(self):
+        return self.input.input_var
+
+    def _get_y_symbol(self):
+        return self.y
+
+    def _get_cost_symbol(self):
+        prediction = self.output.output()
+        return T.nnet.categorical_crossentropy(prediction, self.y).mean()
+
+    def _get_updates_symbol(self):
+        cost = self._get_cost_symbol()
+        return [(param, param - numpy.float32(0.5) * T.grad(cost, param))
+                for param in self.all_trainable_parameters_symbol]
+
+
+def make_data(num_samples=64):
+    rng = numpy.random.RandomState(0)
+    y = numpy.int32(rng.randint(0, 2, num_samples))
+    centers = numpy.float32([[-2.0], [2.0]])[y].reshape(-1, 1, 1, 1)
+    X = numpy.float32(rng.randn(num_samples, 1, 2, 2)) + centers
+    return X, y
+
+
+class FailingPreprocessor(object):
+    def run(self, x_batch):
+        raise ValueError('bad batch')
+
+
+def hold_lock(lock):
+    lock.acquire()
+    time.sleep(60)
+
+
+class TestHogwildTrainer(unittest.TestCase):
+    def test_trains_shared_parameters(self):
+        model = SoftmaxModel()
+        trainer = HogwildTrainer(model, num_workers=2)
+        initial = trainer.block.copy()
+        X, y = make_data()
+        history = trainer.train(X, y, 8, 10, snapshot_steps=5)
+
+        self.assertEqual(int(trainer.steps.sum()), 2 * 10)
+        # The workers' updates landed in the block, which the parameters
+        # still view
+        self.assertFalse(numpy.allclose(trainer.block, initial))
+        for param in model.all_trainable_parameters_symbol:
+            self.assertTrue(numpy.may_share_memory(
+                param.get_value(borrow=True), trainer.block))
+        self.assertTrue(len(history) > 0)
+        self.assertTrue(all([cost > 0 for step, cost in history]))
+        numpy.testing.assert_array_equal(trainer.snapshot(), trainer.block)
+
+    def test_failing_worker_raises(self):
+        trainer = HogwildTrainer(SoftmaxModel(), num_workers=2)
+        X, y = make_data()
+        self.assertRaises(RuntimeError, trainer.train, X, y, 8, 5,
+                          FailingPreprocessor())
+
+    def test_mean_cost_of_started_workers(self):
+        trainer = HogwildTrainer(SoftmaxModel(), num_workers=3)
+        self.assertEqual(trainer.get_mean_cost(), None)
+        trainer.steps[...] = [2, 0, 1]
+        trainer.costs[...] = [1.0, 0.0, 1.5]
+        self.assertEqual(trainer.get_mean_cost(), 1.25)
+
+    def test_stop_world_with_dead_worker(self):
+        trainer = HogwildTrainer(SoftmaxModel(), num_workers=2)
+        worker = multiprocessing.Process(target=hold_lock,
+                                         args=(trainer.locks[1],))
+        worker.daemon = True
+        worker.start()
+        # Wait until the worker holds its lock
+        while trainer.locks[1].acquire(False):
+            trainer.locks[1].release()
+            time.sleep(0.01)
+        trainer.workers = [multiprocessing.current_process(), worker]
+        os.kill(worker.pid, signal.SIGKILL)
+        worker.join()
+
+        self.assertRaises(RuntimeError, trainer.stop_world)
+        # The locks taken before the failure were released
+        self.assertTrue(trainer.locks[0].acquire(False))
+
+
+if __name__ == '__main__':
+    unittest.main()
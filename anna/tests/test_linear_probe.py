@@ -0,0 +1,71 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+from anna.features.linear_probe import LinearProbe, evaluate_probe
+
+
+def make_blobs(num_samples, num_features=8, num_classes=3, seed=0):
+    rng = numpy.random.RandomState(seed)
+    centers = 4.0 * rng.randn(num_classes, num_features)
+    y = rng.randint(0, num_classes, num_samples)
+    X = centers[y] + rng.randn(num_samples, num_features)
+    return numpy.float32(X), y
+
+
+class TestLinearProbe(unittest.TestCase):
+    def test_ridge_matches_dense_solution(self):
+        X, y = make_blobs(500)
+        probe = LinearProbe(method='ridge', l2=1e-2, block_size=64)
+        probe.fit(X, y)
+
+        # Reference: ridge on standardized features onto one-hot targets
+        X64 = numpy.float64(X)
+        mean = X64.mean(axis=0)
+        std = X64.std(axis=0) + 1e-6
+        Z = (X64 - mean) / std
+        Y = numpy.eye(3)[y]
+        Y_mean = Y.mean(axis=0)
+        A = numpy.dot(Z.T, Z) / len(y) + 1e-2 * numpy.eye(X.shape[1])
+        W = numpy.linalg.solve(A, numpy.dot(Z.T, Y - Y_mean) / len(y))
+        scores = numpy.dot(Z, W) + Y_mean
+
+        numpy.testing.assert_allclose(probe.predict_scores(X), scores,
+                                      rtol=1e-3, atol=1e-3)
+
+    def test_ridge_with_missing_classes_in_blocks(self):
+        # Blocks that hold a single class must not break the class sums
+        X, y = make_blobs(300)
+        order = numpy.argsort(y, kind='mergesort')
+        X, y = X[order], y[order]
+        probe = LinearProbe(method='ridge', block_size=32).fit(X, y)
+        self.assertGreater(probe.evaluate(X, y), 95.0)
+
+    def test_logistic_accuracy(self):
+        X, y = make_blobs(600, seed=1)
+        X_test, y_test = make_blobs(200, seed=1)
+        accuracy = evaluate_probe(X, y, X_test, y_test, method='logistic',
+                                  block_size=128, num_epochs=5)
+        self.assertGreater(accuracy, 95.0)
+
+    def test_memory_mapped_features(self):
+        X, y = make_blobs(256)
+        path = tempfile.mkdtemp()
+        try:
+            numpy.save(os.path.join(path, 'X.npy'), X)
+            X_mmap = numpy.load(os.path.join(path, 'X.npy'), mmap_mode='r')
+            probe = LinearProbe(method='ridge', block_size=50).fit(X_mmap, y)
+            in_memory = LinearProbe(method='ridge', block_size=50).fit(X, y)
+            numpy.testing.assert_allclose(probe.W, in_memory.W, rtol=1e-5)
+        finally:
+            shutil.rmtree(path)
+
+    def test_invalid_method(self):
+        self.assertRaises(RuntimeError, LinearProbe, method='svm')
+
+
+if __name__ == '__main__':
+    unittest.main()
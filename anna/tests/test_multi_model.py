@@ -0,0 +1,121 @@
+import os
+import signal
+import unittest
+import multiprocessing
+
+import numpy
+
+import theano
+import theano.tensor as T
+
+from anna.parallel.multi_model import MultiModelTrainer
+
+
+class MomentumModel(object):
+    # Linear regression trained with momentum, like the models' train_func
+    def __init__(self, seed):
+        rng = numpy.random.RandomState(seed)
+        self.W = theano.shared(numpy.float32(rng.randn(4, 2)))
+        self.velocity = theano.shared(numpy.zeros((4, 2), numpy.float32))
+        self.all_save_parameters_symbol = [self.W]
+        x = T.fmatrix('x')
+        y = T.fmatrix('y')
+        cost = T.sqr(T.dot(x, self.W) - y).mean()
+        v = (numpy.float32(0.9) * self.velocity -
+             numpy.float32(0.1) * T.grad(cost, self.W))
+        self.train_func = theano.function(
+            [x, y], cost, updates=[(self.velocity, v), (self.W, self.W + v)])
+
+    def train(self, x_batch, y_batch):
+        return self.train_func(x_batch, y_batch)
+
+
+class StepMonitor(object):
+    # The state of a util.Monitor that training changes
+    def __init__(self):
+        self.step_number = 0
+        self.test = False
+        self.errors = []
+        self.times = []
+        self.big_errors = []
+        self.big_times = []
+
+    def start(self):
+        pass
+
+    def stop(self, error):
+        self.errors.append(error)
+        self.times.append(0.0)
+        self.step_number += 1
+
+
+class KilledModel(MomentumModel):
+    def train(self, x_batch, y_batch):
+        os.kill(os.getpid(), signal.SIGKILL)
+
+
+def make_batches(num_batches):
+    rng = numpy.random.RandomState(1)
+    return [(numpy.float32(rng.randn(8, 4)), numpy.float32(rng.randn(8, 2)))
+            for i in xrange(num_batches)]
+
+
+class TestMultiModelTrainer(unittest.TestCase):
+    def train(self, num_workers, monitors=None):
+        models = [MomentumModel(seed) for seed in xrange(3)]
+        trainer = MultiModelTrainer(models, monitors=monitors,
+                                    num_workers=num_workers, num_slots=2)
+        errors = trainer.run(iter(make_batches(5)), 5)
+        return models, errors
+
+    def test_workers_match_single_process(self):
+        serial_models, serial_errors = self.train(1)
+        parallel_models, parallel_errors = self.train(2)
+
+        numpy.testing.assert_allclose(parallel_errors, serial_errors,
+                                      rtol=1e-6)
+        for serial, parallel in zip(serial_models, parallel_models):
+            numpy.testing.assert_allclose(parallel.W.get_value(),
+                                          serial.W.get_value(), rtol=1e-6)
+            # Optimizer state comes back too
+            numpy.testing.assert_allclose(parallel.velocity.get_value(),
+                                          serial.velocity.get_value(),
+                                          rtol=1e-6)
+            self.assertTrue(numpy.any(parallel.velocity.get_value() != 0))
+
+    def test_monitor_state_comes_back(self):
+        serial_monitors = [StepMonitor() for i in xrange(3)]
+        self.train(1, serial_monitors)
+        parallel_monitors = [StepMonitor() for i in xrange(3)]
+        self.train(2, parallel_monitors)
+        for serial, parallel in zip(serial_monitors, parallel_monitors):
+            self.assertEqual(parallel.step_number, 5)
+            numpy.testing.assert_allclose(parallel.errors, serial.errors,
+                                          rtol=1e-6)
+
+    def test_killed_worker_raises(self):
+        models = [MomentumModel(0), KilledModel(1)]
+        trainer = MultiModelTrainer(models, num_workers=2, num_slots=2)
+        self.assertRaises(RuntimeError, trainer.run,
+                          iter(make_batches(5)), 5)
+
+    def test_get_results_fails_for_dead_worker(self):
+        trainer = MultiModelTrainer([MomentumModel(0)])
+        worker = multiprocessing.Process(target=os._exit, args=(0,))
+        worker.start()
+        worker.join()
+        self.assertRaises(RuntimeError, trainer._get_results,
+                          multiprocessing.Queue(), [worker], set([0]))
+
+    def test_unsupervised_batches(self):
+        model = MomentumModel(0)
+        model.train = lambda x_batch: model.train_func(
+            x_batch, numpy.zeros((8, 2), numpy.float32))
+        trainer = MultiModelTrainer([model, model], num_workers=1)
+        batches = [x_batch for x_batch, y_batch in make_batches(3)]
+        errors = trainer.run(iter(batches), 3)
+        self.assertEqual(len(errors), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,157 @@
+import unittest
+
+import numpy
+
+from anna.inference import runtime
+from anna.inference import quantize
+from anna.tests.test_runtime import make_op, run_op, reference_conv_bc01, \
+    reference_conv_c01b
+
+
+def make_dense_graph(W, b):
+    graph = {'format': runtime.FORMAT, 'version': runtime.VERSION,
+             'input': {'name': 'input', 'data_order': 'bc01',
+                       'shape': [W.shape[0]]},
+             'output': 'dense',
+             'nodes': [{'name': 'dense', 'type': 'dense',
+                        'inputs': ['input'], 'attrs': {},
+                        'params': {'W': 'W', 'b': 'b'}}]}
+    return graph, {'W': W, 'b': b}
+
+
+class TestQuantize(unittest.TestCase):
+    def setUp(self):
+        self.rng = numpy.random.RandomState(0)
+
+    def test_weight_round_trip_error(self):
+        W = numpy.float32(self.rng.randn(3, 4, 5, 6))
+        for axis in xrange(W.ndim):
+            W_int8, scale = quantize.quantize_weights(W, axis)
+            self.assertEqual(W_int8.dtype, numpy.int8)
+            shape = [1] * W.ndim
+            shape[axis] = -1
+            error = numpy.abs(W_int8 * scale.reshape(shape) - W)
+            # At most half a step of every output channel
+            self.assertTrue(numpy.all(error <= scale.reshape(shape) / 2 +
+                                      1e-7))
+            self.assertEqual(numpy.abs(W_int8).max(), 127)
+
+    def test_zero_channel(self):
+        W = numpy.float32(self.rng.randn(4, 3))
+        W[:, 1] = 0.0
+        W_int8, scale = quantize.quantize_weights(W, 1)
+        self.assertEqual(scale[1], 1.0)
+        self.assertTrue(numpy.all(W_int8[:, 1] == 0))
+
+    def test_input_quantization(self):
+        x = numpy.float32(self.rng.randn(100) * 3)
+        scale = 2.0 / 127.0
+        q = runtime.quantize(x, scale, numpy.zeros_like(x))
+        self.assertTrue(numpy.all(q == numpy.rint(q)))
+        self.assertTrue(numpy.all(numpy.abs(q) <= 127))
+        inside = numpy.abs(x) <= 2.0
+        self.assertTrue(numpy.all(numpy.abs(q[inside] * scale - x[inside])
+                                  <= scale / 2 + 1e-6))
+        # Values outside the calibrated range saturate
+        numpy.testing.assert_array_equal(q[~inside],
+                                         127 * numpy.sign(x[~inside]))
+
+    def test_int8_dot_is_exact(self):
+        # Long enough for the blocked path; a single float32 product of
+        # extreme values would round
+        a = numpy.float32(self.rng.randint(-127, 128, (5, 3000)))
+        b = numpy.float32(self.rng.randint(-127, 128, (3000, 4)))
+        out = numpy.zeros((5, 4), dtype=numpy.float32)
+        accumulator = numpy.zeros((5, 4), dtype=numpy.int32)
+        runtime.int8_dot(a, b, out, accumulator)
+        expected = numpy.dot(a.astype(numpy.int64), b.astype(numpy.int64))
+        numpy.testing.assert_array_equal(out, numpy.float32(expected))
+
+    def test_int8_dot_with_int8_operands(self):
+        for num_inner in (100, 1000):
+            a = self.rng.randint(-127, 128, (6, num_inner))
+            b = self.rng.randint(-127, 128, (num_inner, 5))
+            expected = numpy.float32(numpy.dot(a, b))
+            buffer = numpy.empty(runtime.INT8_BLOCK_SIZE * 6,
+                                 dtype=numpy.float32)
+            out = numpy.zeros((6, 5), dtype=numpy.float32)
+            # int8 weights on either side, converted into the buffer
+            runtime.int8_dot(numpy.float32(a), b.astype(numpy.int8), out,
+                             buffer=buffer)
+            numpy.testing.assert_array_equal(out, expected)
+            runtime.int8_dot(a.astype(numpy.int8), numpy.float32(b), out,
+                             buffer=buffer)
+            numpy.testing.assert_array_equal(out, expected)
+
+    def test_weights_stay_int8(self):
+        W = numpy.float32(self.rng.randn(1000, 8))
+        b = numpy.float32(self.rng.randn(8))
+        graph, arrays = make_dense_graph(W, b)
+        graph, arrays = quantize.quantize_graph(graph, arrays,
+                                                {'dense': 3.0})
+        self.assertEqual(arrays['W_int8'].dtype, numpy.int8)
+        self.assertTrue('W' not in arrays)
+        model = runtime.InferenceModel(graph, arrays)
+        op = model.nodes[0][1]
+        self.assertEqual(op.W.dtype, numpy.int8)
+        numpy.testing.assert_array_equal(op.W, arrays['W_int8'])
+        # float32 copies of at most INT8_BLOCK_SIZE rows at a time
+        self.assertEqual(op.weight_buffer.size, runtime.INT8_BLOCK_SIZE * 8)
+        self.assertEqual(model.predict(numpy.zeros((2, 1000))).shape, (2, 8))
+
+    def check_int8_conv(self, op_class, x_int, W_int8, axis, attrs,
+                        reference, channel_shape):
+        # Inputs on the quantization grid, so the op is exact
+        input_scale = 0.05
+        scale = numpy.float32(self.rng.uniform(0.5, 1.5, W_int8.shape[axis]))
+        attrs = dict(attrs, input_scale=input_scale)
+        op = make_op(op_class, {'W': W_int8, 'scale': scale}, attrs)
+        x = numpy.float32(x_int * input_scale)
+        expected = reference(x_int, W_int8.astype(numpy.int64)) * \
+            (input_scale * scale).reshape(channel_shape)
+        numpy.testing.assert_allclose(run_op(op, x), expected, rtol=1e-5)
+
+    def test_int8_convolutions_are_exact(self):
+        # 30 channels of 3x3 filters, more than one block of weights
+        x_int = self.rng.randint(-127, 128, (2, 30, 6, 5))
+        W_int8 = self.rng.randint(-127, 128, (4, 30, 3, 3)).astype(
+            numpy.int8)
+        self.check_int8_conv(
+            runtime.ConvBC01Int8, x_int, W_int8, 0, {'pad': [1, 0, 0, 1]},
+            lambda x, W: reference_conv_bc01(x, W, [1, 0, 0, 1], [1, 1]),
+            (1, -1, 1, 1))
+
+        x_int = self.rng.randint(-127, 128, (30, 6, 6, 2))
+        W_int8 = self.rng.randint(-127, 128, (30, 3, 3, 4)).astype(
+            numpy.int8)
+        self.check_int8_conv(
+            runtime.ConvC01BInt8, x_int, W_int8, 3, {'pad': 1},
+            lambda x, W: reference_conv_c01b(x, W, 1, 1), (-1, 1, 1, 1))
+
+    def test_quantized_dense_close_to_float(self):
+        W = numpy.float32(self.rng.randn(50, 10) * 0.1)
+        b = numpy.float32(self.rng.randn(10))
+        x = numpy.float32(self.rng.randn(16, 50))
+        graph, arrays = make_dense_graph(W, b)
+        float_model = runtime.InferenceModel(graph, arrays)
+        ranges = quantize.Calibrator(float_model).run(x, 8)
+        self.assertAlmostEqual(ranges['dense'], numpy.abs(x).max(), 5)
+        int8_graph, int8_arrays = quantize.quantize_graph(graph, arrays,
+                                                          ranges)
+        int8_model = runtime.InferenceModel(int8_graph, int8_arrays)
+
+        reference = float_model.predict(x)
+        error = numpy.abs(int8_model.predict(x) - reference).max()
+        self.assertLess(error, 0.02 * numpy.abs(reference).max())
+
+    def test_skip_nodes(self):
+        W = numpy.float32(self.rng.randn(5, 3))
+        graph, arrays = make_dense_graph(W, numpy.zeros(3, numpy.float32))
+        graph, arrays = quantize.quantize_graph(graph, arrays,
+                                                {'dense': 1.0},
+                                                skip_nodes=['dense'])
+        self.assertEqual(graph['nodes'][0]['type'], 'dense')
+
+
+if __name__ == '__main__':
+    unittest.main()
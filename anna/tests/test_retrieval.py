@@ -0,0 +1,114 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+from anna.features.retrieval import ExactIndex, PQIndex, kmeans, \
+    load_index, benchmark
+
+
+def make_corpus(num_samples, num_features=32, seed=0):
+    # Clustered data, so that product quantization has structure to find
+    rng = numpy.random.RandomState(seed)
+    centers = 3.0 * rng.randn(20, num_features)
+    X = centers[rng.randint(0, 20, num_samples)] + \
+        rng.randn(num_samples, num_features)
+    return numpy.float32(X)
+
+
+def brute_force(corpus, queries, k, metric):
+    if metric == 'l2':
+        scores = -((queries[:, None, :] - corpus[None, :, :]) ** 2).sum(
+            axis=2)
+    else:
+        corpus = corpus / numpy.sqrt((corpus ** 2).sum(axis=1))[:, None]
+        queries = queries / numpy.sqrt((queries ** 2).sum(axis=1))[:, None]
+        scores = numpy.dot(queries, corpus.T)
+    return numpy.argsort(-scores, axis=1)[:, 0:k]
+
+
+class TestExactIndex(unittest.TestCase):
+    def test_matches_brute_force(self):
+        corpus = make_corpus(500)
+        queries = make_corpus(20, seed=1)
+        for metric in ['l2', 'cosine']:
+            index = ExactIndex(corpus, metric=metric, block_size=64,
+                               query_block_size=7, num_threads=2)
+            distances, ids = index.search(queries, k=5)
+            expected = brute_force(corpus, queries, 5, metric)
+            numpy.testing.assert_array_equal(ids, expected)
+
+    def test_l2_distances(self):
+        corpus = make_corpus(100)
+        queries = make_corpus(3, seed=1)
+        distances, ids = ExactIndex(corpus).search(queries, k=4)
+        expected = ((queries[:, None, :] - corpus[ids]) ** 2).sum(axis=2)
+        numpy.testing.assert_allclose(distances, expected, rtol=1e-3)
+
+
+class TestPQIndex(unittest.TestCase):
+    def test_recall(self):
+        corpus = make_corpus(2000)
+        queries = make_corpus(50, seed=1)
+        __, exact_ids = ExactIndex(corpus).search(queries, k=10)
+        index = PQIndex(num_components=32, num_subspaces=16,
+                        num_iterations=10).fit(corpus)
+        recall, __ = benchmark(index, queries, exact_ids, k=10, num_runs=1)
+        self.assertGreater(recall, 0.5)
+        recall, __ = benchmark(index, queries, exact_ids, k=10, num_runs=1,
+                               features=corpus, rerank=100)
+        self.assertGreater(recall, 0.95)
+
+    def test_cosine_returns_similarities_like_exact(self):
+        corpus = make_corpus(1000)
+        queries = make_corpus(10, seed=1)
+        exact_scores, exact_ids = ExactIndex(corpus, metric='cosine').search(
+            queries, k=5)
+        index = PQIndex(num_components=32, num_subspaces=8, metric='cosine',
+                        num_iterations=10).fit(corpus)
+        scores, ids = index.search(queries, k=5, features=corpus,
+                                   rerank=50)
+        # Sorted by decreasing similarity, equal to the exact ones when
+        # re-ranked
+        self.assertTrue(numpy.all(numpy.diff(scores, axis=1) <= 1e-6))
+        numpy.testing.assert_array_equal(ids, exact_ids)
+        numpy.testing.assert_allclose(scores, exact_scores, atol=1e-4)
+
+        approximate_scores, __ = index.search(queries, k=5)
+        self.assertTrue(numpy.all(numpy.diff(approximate_scores, axis=1)
+                                  <= 1e-6))
+        self.assertTrue(numpy.all(approximate_scores <= 1.0 + 1e-3))
+
+    def test_fit_on_fewer_samples_than_centroids(self):
+        corpus = make_corpus(100)
+        index = PQIndex(num_components=8, num_subspaces=4).fit(corpus)
+        self.assertEqual(index.codebooks.shape, (4, 256, 2))
+        self.assertTrue(index.codes.max() < 100)
+        distances, ids = index.search(corpus[0:5], k=1)
+        numpy.testing.assert_array_equal(ids[:, 0], numpy.arange(5))
+
+    def test_save_and_load(self):
+        corpus = make_corpus(300)
+        queries = make_corpus(5, seed=1)
+        index = PQIndex(num_components=8, num_subspaces=4).fit(corpus)
+        path = tempfile.mkdtemp()
+        try:
+            index.save(os.path.join(path, 'pq'))
+            loaded = load_index(os.path.join(path, 'pq'))
+            numpy.testing.assert_array_equal(loaded.search(queries)[1],
+                                             index.search(queries)[1])
+        finally:
+            shutil.rmtree(path)
+
+
+class TestKMeans(unittest.TestCase):
+    def test_clamps_clusters_to_samples(self):
+        X = numpy.float32(numpy.random.RandomState(0).randn(10, 2))
+        centroids = kmeans(X, 256)
+        self.assertEqual(centroids.shape, (10, 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
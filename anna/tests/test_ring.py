@@ -0,0 +1,123 @@
+import socket
+import threading
+import unittest
+
+import numpy
+
+from anna.parallel.ring import Ring
+
+
+def get_free_addresses(num_ranks):
+    sockets = []
+    for i in xrange(num_ranks):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(('127.0.0.1', 0))
+        sockets.append(sock)
+    addresses = ['127.0.0.1:%d' % sock.getsockname()[1] for sock in sockets]
+    for sock in sockets:
+        sock.close()
+    return addresses
+
+
+def run_ranks(num_ranks, func, segment_size=1 << 18):
+    # Calls func(ring) on every rank, in threads; returns their results
+    addresses = get_free_addresses(num_ranks)
+    results = [None] * num_ranks
+    errors = []
+
+    def run(rank):
+        try:
+            ring = Ring(rank, addresses, segment_size=segment_size,
+                        timeout=10.0)
+            try:
+                results[rank] = func(ring)
+            finally:
+                ring.close()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(rank,))
+               for rank in xrange(num_ranks)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join(30.0)
+    if errors:
+        raise errors[0]
+    return results
+
+
+class TestRing(unittest.TestCase):
+    def check_allreduce(self, num_ranks, size, segment_size):
+        rng = numpy.random.RandomState(num_ranks)
+        buffers = [numpy.float32(rng.randn(size)) for i in xrange(num_ranks)]
+        expected = numpy.sum(numpy.float64(buffers), axis=0)
+        results = run_ranks(
+            num_ranks, lambda ring: ring.allreduce(buffers[ring.rank].copy()),
+            segment_size=segment_size)
+
+        for result in results:
+            numpy.testing.assert_allclose(result, expected, rtol=1e-5,
+                                          atol=1e-5)
+            # Every rank ends up with the same bytes
+            numpy.testing.assert_array_equal(result, results[0])
+
+    def test_allreduce_matches_sum(self):
+        self.check_allreduce(3, 1000, 1 << 18)
+
+    def test_allreduce_with_many_segments(self):
+        # Chunks of uneven length, each cut into several segments
+        self.check_allreduce(4, 1001, 64)
+
+    def test_allreduce_smaller_than_ring(self):
+        self.check_allreduce(4, 3, 64)
+
+    def test_allreduce_two_ranks_integers(self):
+        buffers = [numpy.arange(10, dtype=numpy.int64) * (rank + 1)
+                   for rank in xrange(2)]
+        results = run_ranks(
+            2, lambda ring: ring.allreduce(buffers[ring.rank].copy()))
+        for result in results:
+            numpy.testing.assert_array_equal(result,
+                                             numpy.arange(10) * 3)
+
+    def test_broadcast(self):
+        rng = numpy.random.RandomState(0)
+        value = numpy.float32(rng.randn(500))
+
+        def broadcast(ring):
+            if ring.rank == 2:
+                buffer = value.copy()
+            else:
+                buffer = numpy.zeros_like(value)
+            return ring.broadcast(buffer, root=2)
+
+        for result in run_ranks(4, broadcast, segment_size=128):
+            numpy.testing.assert_array_equal(result, value)
+
+    def test_barrier_and_bytes_sent(self):
+        size = 1200
+
+        def allreduce(ring):
+            ring.barrier()
+            bytes_sent = ring.bytes_sent
+            ring.allreduce(numpy.ones(size, dtype=numpy.float32))
+            return ring.bytes_sent - bytes_sent
+
+        # 2 (N - 1) / N times the size of the buffer
+        for bytes_sent in run_ranks(3, allreduce):
+            self.assertEqual(bytes_sent, 2 * 2 * size * 4 / 3)
+
+    def test_single_rank_is_noop(self):
+        ring = Ring(0, ['127.0.0.1:0'])
+        buffer = numpy.arange(5, dtype=numpy.float32)
+        numpy.testing.assert_array_equal(ring.allreduce(buffer.copy()),
+                                         buffer)
+        numpy.testing.assert_array_equal(ring.broadcast(buffer.copy()),
+                                         buffer)
+        ring.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,278 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+from anna.inference import runtime
+
+
+def make_op(op_class, params=None, attrs=None, nonlinearity='identity'):
+    params = params or {}
+    node = {'name': 'op', 'type': 'test', 'inputs': ['input'],
+            'params': dict([(name, name) for name in params]),
+            'attrs': attrs or {}, 'nonlinearity': nonlinearity}
+    return op_class(node, params)
+
+
+def run_op(op, *inputs):
+    input_shapes = [x.shape for x in inputs]
+    out = numpy.zeros(op.get_output_shape(input_shapes), dtype=numpy.float32)
+    op.run(list(inputs), out, op.allocate(input_shapes))
+    return out
+
+
+def reference_conv_bc01(x, W, pad, stride):
+    # Naive cross-correlation, pad is (top, bottom, left, right)
+    top, bottom, left, right = pad
+    x = numpy.pad(x, ((0, 0), (0, 0), (top, bottom), (left, right)),
+                  'constant')
+    n_filters, __, kh, kw = W.shape
+    rows = (x.shape[2] - kh) // stride[0] + 1
+    cols = (x.shape[3] - kw) // stride[1] + 1
+    out = numpy.zeros((x.shape[0], n_filters, rows, cols))
+    for i in xrange(rows):
+        for j in xrange(cols):
+            window = x[:, :, i * stride[0]:i * stride[0] + kh,
+                       j * stride[1]:j * stride[1] + kw]
+            out[:, :, i, j] = numpy.tensordot(window, W,
+                                              axes=([1, 2, 3], [1, 2, 3]))
+    return out
+
+
+def reference_conv_c01b(x, W, pad, stride):
+    # cuda-convnet: zero padding on every side, the last windows may run
+    # past the padded image (zeros)
+    channels, rows, cols, batch = x.shape
+    k = W.shape[1]
+    out_rows = runtime._cc_output_size(rows, k, stride, pad)
+    out_cols = runtime._cc_output_size(cols, k, stride, pad)
+    padded = numpy.zeros((channels, (out_rows - 1) * stride + k,
+                          (out_cols - 1) * stride + k, batch))
+    copy_rows = min(rows, padded.shape[1] - pad)
+    copy_cols = min(cols, padded.shape[2] - pad)
+    padded[:, pad:pad + copy_rows, pad:pad + copy_cols] = \
+        x[:, 0:copy_rows, 0:copy_cols]
+    out = numpy.zeros((W.shape[3], out_rows, out_cols, batch))
+    for i in xrange(out_rows):
+        for j in xrange(out_cols):
+            window = padded[:, i * stride:i * stride + k,
+                            j * stride:j * stride + k, :]
+            out[:, i, j, :] = numpy.tensordot(W, window,
+                                              axes=([0, 1, 2], [0, 1, 2]))
+    return out
+
+
+def reference_max_pool_c01b(x, pool_size, stride):
+    channels, rows, cols, batch = x.shape
+    out_rows = runtime._cc_output_size(rows, pool_size, stride, 0)
+    out_cols = runtime._cc_output_size(cols, pool_size, stride, 0)
+    out = numpy.zeros((channels, out_rows, out_cols, batch))
+    for i in xrange(out_rows):
+        for j in xrange(out_cols):
+            out[:, i, j] = x[:, i * stride:i * stride + pool_size,
+                             j * stride:j * stride + pool_size].max(
+                                 axis=(1, 2))
+    return out
+
+
+class TestOps(unittest.TestCase):
+    def setUp(self):
+        self.rng = numpy.random.RandomState(0)
+
+    def randn(self, *shape):
+        return numpy.float32(self.rng.randn(*shape))
+
+    def test_dense(self):
+        x, W, b = self.randn(4, 6), self.randn(6, 3), self.randn(3)
+        op = make_op(runtime.Dense, {'W': W, 'b': b}, nonlinearity='relu')
+        numpy.testing.assert_allclose(
+            run_op(op, x), numpy.maximum(numpy.dot(x, W) + b, 0.0),
+            rtol=1e-5, atol=1e-5)
+
+    def test_conv_bc01(self):
+        x, W, b = self.randn(2, 3, 9, 8), self.randn(4, 3, 3, 2), \
+            self.randn(4)
+        for pad, stride in [([0, 0, 0, 0], [1, 1]), ([1, 2, 0, 1], [2, 1])]:
+            op = make_op(runtime.ConvBC01, {'W': W, 'b': b},
+                         {'pad': pad, 'stride': stride})
+            expected = reference_conv_bc01(x, W, pad, stride) + \
+                b[None, :, None, None]
+            numpy.testing.assert_allclose(run_op(op, x), expected,
+                                          rtol=1e-4, atol=1e-4)
+
+    def test_conv_c01b(self):
+        x, W = self.randn(3, 10, 10, 2), self.randn(3, 3, 3, 4)
+        for pad, stride in [(0, 1), (1, 1), (2, 3)]:
+            op = make_op(runtime.ConvC01B, {'W': W},
+                         {'pad': pad, 'stride': stride})
+            numpy.testing.assert_allclose(
+                run_op(op, x), reference_conv_c01b(x, W, pad, stride),
+                rtol=1e-4, atol=1e-4)
+
+    def test_conv_c01b_untied_biases(self):
+        x, W = self.randn(3, 6, 6, 2), self.randn(3, 3, 3, 4)
+        b = self.randn(4, 4, 4)
+        op = make_op(runtime.ConvC01B, {'W': W, 'b': b})
+        expected = reference_conv_c01b(x, W, 0, 1) + b[:, :, :, None]
+        numpy.testing.assert_allclose(run_op(op, x), expected, rtol=1e-4,
+                                      atol=1e-4)
+
+    def test_deconv_is_transpose_of_conv(self):
+        # <conv(x), h> == <x, deconv(h)> for the same filters
+        W = self.randn(3, 3, 3, 4)
+        for pad, stride in [(0, 1), (1, 2)]:
+            x = self.randn(3, 9, 9, 2)
+            conv = make_op(runtime.ConvC01B, {'W': W},
+                           {'pad': pad, 'stride': stride})
+            deconv = make_op(runtime.DeconvC01B, {'W': W},
+                             {'pad': pad, 'stride': stride,
+                              'image_size': [9, 9]})
+            y = run_op(conv, x)
+            h = self.randn(*y.shape)
+            x_back = run_op(deconv, h)
+            self.assertEqual(x_back.shape, x.shape)
+            numpy.testing.assert_allclose(numpy.sum(y * h),
+                                          numpy.sum(x * x_back), rtol=1e-4)
+
+    def test_deconv_subtracts_bias(self):
+        W, b = self.randn(3, 3, 3, 4), self.randn(4)
+        h = self.randn(4, 4, 4, 2)
+        attrs = {'pad': 0, 'stride': 1, 'image_size': [6, 6]}
+        with_bias = run_op(make_op(runtime.DeconvC01B, {'W': W, 'b': b},
+                                   attrs), h)
+        without_bias = run_op(make_op(runtime.DeconvC01B, {'W': W}, attrs),
+                              h - b[:, None, None, None])
+        numpy.testing.assert_allclose(with_bias, without_bias, rtol=1e-5,
+                                      atol=1e-5)
+
+    def test_max_pool(self):
+        x = self.randn(2, 3, 7, 6)
+        op = make_op(runtime.MaxPool, attrs={'pool_size': [2, 2]})
+        out = run_op(op, x)
+        self.assertEqual(out.shape, (2, 3, 4, 3))
+        padded = numpy.pad(x, ((0, 0), (0, 0), (0, 1), (0, 0)), 'constant',
+                           constant_values=-numpy.inf)
+        expected = padded.reshape(2, 3, 4, 2, 3, 2).max(axis=(3, 5))
+        numpy.testing.assert_array_equal(out, expected)
+
+        op = make_op(runtime.MaxPool, attrs={'pool_size': [2, 2],
+                                             'ignore_border': True})
+        numpy.testing.assert_array_equal(run_op(op, x), expected[:, :, 0:3])
+
+    def test_max_pool_c01b(self):
+        x = self.randn(3, 9, 9, 2)
+        for pool_size, stride in [(2, 2), (3, 2)]:
+            op = make_op(runtime.MaxPoolC01B,
+                         attrs={'pool_size': pool_size, 'stride': stride})
+            numpy.testing.assert_array_equal(
+                run_op(op, x), reference_max_pool_c01b(x, pool_size, stride))
+
+    def test_unpool_routes_to_maxima(self):
+        x = self.randn(2, 4, 4, 1)
+        attrs = {'pool_size': 2, 'stride': 2}
+        pooled = run_op(make_op(runtime.MaxPoolC01B, attrs=attrs), x)
+        values = self.randn(*pooled.shape)
+        op = make_op(runtime.UnpoolC01B, attrs=attrs)
+        input_shapes = [values.shape, pooled.shape, x.shape]
+        out = numpy.zeros(op.get_output_shape(input_shapes),
+                          dtype=numpy.float32)
+        op.run([values, pooled, x], out, op.allocate(input_shapes))
+
+        expected = numpy.zeros_like(x)
+        for c in xrange(2):
+            for i in xrange(2):
+                for j in xrange(2):
+                    window = x[c, 2 * i:2 * i + 2, 2 * j:2 * j + 2, 0]
+                    r, s = numpy.unravel_index(numpy.argmax(window), (2, 2))
+                    expected[c, 2 * i + r, 2 * j + s, 0] = values[c, i, j, 0]
+        numpy.testing.assert_array_equal(out, expected)
+
+    def test_global_and_window_pool(self):
+        x = self.randn(2, 3, 5, 4)
+        for function, reference in [('mean', numpy.mean),
+                                    ('max', numpy.max)]:
+            op = make_op(runtime.GlobalPool,
+                         attrs={'pooling_function': function})
+            numpy.testing.assert_allclose(run_op(op, x),
+                                          reference(x, axis=(2, 3)),
+                                          rtol=1e-5)
+        op = make_op(runtime.GlobalPool, attrs={'pooling_function': 'l2'})
+        numpy.testing.assert_allclose(
+            run_op(op, x), numpy.sqrt((x ** 2).mean(axis=(2, 3))), rtol=1e-5)
+
+        # Sliding a 3x3 global pool over the map
+        op = make_op(runtime.WindowPool, attrs={'pooling_function': 'max',
+                                                'window': [3, 3]})
+        out = run_op(op, x)
+        self.assertEqual(out.shape, (2, 3, 3, 2))
+        numpy.testing.assert_array_equal(out[:, :, 1, 1],
+                                         x[:, :, 1:4, 1:4].max(axis=(2, 3)))
+
+
+class TestInferenceModel(unittest.TestCase):
+    def make_graph(self):
+        rng = numpy.random.RandomState(0)
+        arrays = {'conv_W': numpy.float32(rng.randn(4, 3, 3, 3)),
+                  'conv_b': numpy.float32(rng.randn(4)),
+                  'dense_W': numpy.float32(rng.randn(4 * 3 * 3, 5)),
+                  'dense_b': numpy.float32(rng.randn(5))}
+        graph = {'format': runtime.FORMAT, 'version': runtime.VERSION,
+                 'input': {'name': 'input', 'data_order': 'bc01',
+                           'shape': [3, 8, 8]},
+                 'output': 'dense',
+                 'nodes': [
+                     {'name': 'conv', 'type': 'conv_bc01',
+                      'inputs': ['input'], 'nonlinearity': 'relu',
+                      'params': {'W': 'conv_W', 'b': 'conv_b'}},
+                     {'name': 'pool', 'type': 'max_pool',
+                      'inputs': ['conv'], 'attrs': {'pool_size': [2, 2]}},
+                     {'name': 'dense', 'type': 'dense', 'inputs': ['pool'],
+                      'nonlinearity': 'softmax',
+                      'params': {'W': 'dense_W', 'b': 'dense_b'}}]}
+        return graph, arrays
+
+    def reference(self, x, arrays):
+        h = reference_conv_bc01(x, arrays['conv_W'], [0, 0, 0, 0], [1, 1])
+        h = numpy.maximum(h + arrays['conv_b'][None, :, None, None], 0.0)
+        h = h.reshape(h.shape[0], 4, 3, 2, 3, 2).max(axis=(3, 5))
+        scores = numpy.dot(h.reshape(h.shape[0], -1), arrays['dense_W']) + \
+            arrays['dense_b']
+        scores = numpy.exp(scores - scores.max(axis=1)[:, None])
+        return scores / scores.sum(axis=1)[:, None]
+
+    def test_predict_matches_reference(self):
+        graph, arrays = self.make_graph()
+        model = runtime.InferenceModel(graph, arrays, max_plans=1)
+        rng = numpy.random.RandomState(1)
+        for batch_size in [2, 5, 2]:
+            x = numpy.float32(rng.randn(batch_size, 3, 8, 8))
+            numpy.testing.assert_allclose(model.predict(x),
+                                          self.reference(x, arrays),
+                                          rtol=1e-4, atol=1e-6)
+        self.assertEqual(len(model.plans), 1)
+
+    def test_save_and_load(self):
+        graph, arrays = self.make_graph()
+        path = tempfile.mkdtemp()
+        try:
+            model_path = os.path.join(path, 'model.npz')
+            runtime.save_graph(model_path, graph, arrays)
+            model = runtime.load(model_path)
+            x = numpy.float32(numpy.random.RandomState(2).randn(3, 3, 8, 8))
+            numpy.testing.assert_allclose(
+                model.predict(x),
+                runtime.InferenceModel(graph, arrays).predict(x))
+        finally:
+            shutil.rmtree(path)
+
+    def test_invalid_node_type(self):
+        graph, arrays = self.make_graph()
+        graph['nodes'][1]['type'] = 'lrn'
+        self.assertRaises(RuntimeError, runtime.InferenceModel, graph,
+                          arrays)
+
+
+if __name__ == '__main__':
+    unittest.main()
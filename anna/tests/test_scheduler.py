@@ -0,0 +1,136 @@
+import multiprocessing
+import shutil
+import sys
+import tempfile
+import unittest
+
+from anna.parallel.scheduler import Job, Scheduler, get_job_env, \
+    get_memory_gb
+
+
+def sleep_job(name, seconds=0.3, **kwargs):
+    return Job(name, [sys.executable, '-c',
+                      'import time; time.sleep(%f)' % seconds], **kwargs)
+
+
+def overlap(job_a, job_b):
+    return job_a.start_time < job_b.end_time and \
+        job_b.start_time < job_a.end_time
+
+
+class TestScheduler(unittest.TestCase):
+    def setUp(self):
+        self.compiledir_root = tempfile.mkdtemp()
+        # Pretend to have more cores than this host may have
+        self.cpu_count = multiprocessing.cpu_count
+        multiprocessing.cpu_count = lambda: 4
+
+    def tearDown(self):
+        multiprocessing.cpu_count = self.cpu_count
+        shutil.rmtree(self.compiledir_root)
+
+    def make_scheduler(self, num_cores, memory_gb):
+        scheduler = Scheduler(num_cores=num_cores, memory_gb=memory_gb,
+                              compiledir_root=self.compiledir_root,
+                              poll_interval=0.02, verbose=False)
+        # Cores beyond the ones of this host cannot be pinned to
+        scheduler.taskset = None
+        return scheduler
+
+    def run_jobs(self, scheduler, jobs):
+        for job in jobs:
+            scheduler.submit(job)
+        finished = scheduler.run()
+        self.assertEqual(sorted([job.name for job in finished]),
+                         sorted([job.name for job in jobs]))
+        self.assertTrue(all([job.returncode == 0 for job in finished]))
+        return dict([(job.name, job) for job in finished])
+
+    def test_packs_jobs_onto_free_cores(self):
+        scheduler = self.make_scheduler(2, 1.0)
+        jobs = self.run_jobs(scheduler, [
+            sleep_job('a', memory_gb=0.1), sleep_job('b', memory_gb=0.1),
+            sleep_job('c', memory_gb=0.1)])
+        self.assertTrue(overlap(jobs['a'], jobs['b']))
+        self.assertGreaterEqual(jobs['c'].start_time,
+                                min(jobs['a'].end_time, jobs['b'].end_time))
+        self.assertEqual(sorted(jobs['a'].cores + jobs['b'].cores), [0, 1])
+        self.assertEqual(scheduler.free_cores, [0, 1])
+        self.assertAlmostEqual(scheduler.free_memory_gb, 1.0)
+
+    def test_skips_jobs_that_do_not_fit_yet(self):
+        scheduler = self.make_scheduler(3, 1.0)
+        jobs = self.run_jobs(scheduler, [
+            sleep_job('a', 0.5, num_cores=2, memory_gb=0.1),
+            sleep_job('b', 0.1, num_cores=2, memory_gb=0.1),
+            sleep_job('c', 0.1, num_cores=1, memory_gb=0.1)])
+        # c starts next to a; b waits for a
+        self.assertTrue(overlap(jobs['a'], jobs['c']))
+        self.assertGreaterEqual(jobs['b'].start_time, jobs['a'].end_time)
+
+    def test_memory_limits_concurrency(self):
+        scheduler = self.make_scheduler(2, 1.0)
+        jobs = self.run_jobs(scheduler, [sleep_job('a', memory_gb=0.6),
+                                         sleep_job('b', memory_gb=0.6)])
+        self.assertFalse(overlap(jobs['a'], jobs['b']))
+
+    def test_default_memory_is_share_per_core(self):
+        scheduler = self.make_scheduler(4, 2.0)
+        job = sleep_job('a', num_cores=2)
+        scheduler.submit(job)
+        self.assertAlmostEqual(job.memory_gb, 1.0)
+
+        # Jobs without an estimate cannot oversubscribe the memory
+        scheduler = self.make_scheduler(2, 1.0)
+        jobs = self.run_jobs(scheduler, [sleep_job('a'), sleep_job('b'),
+                                         sleep_job('c', memory_gb=0.6)])
+        self.assertTrue(overlap(jobs['a'], jobs['b']))
+        self.assertGreaterEqual(jobs['c'].start_time,
+                                max(jobs['a'].end_time, jobs['b'].end_time))
+
+    def test_rejects_jobs_that_do_not_fit(self):
+        scheduler = self.make_scheduler(2, 1.0)
+        self.assertRaises(ValueError, scheduler.submit,
+                          sleep_job('cores', num_cores=3, memory_gb=0.1))
+        self.assertRaises(ValueError, scheduler.submit,
+                          sleep_job('memory', memory_gb=1.5))
+        self.assertRaises(ValueError, scheduler.submit,
+                          sleep_job('zero', memory_gb=0.0))
+        self.assertEqual(scheduler.queue, [])
+
+    def test_rejects_more_memory_than_the_host(self):
+        self.assertRaises(ValueError, Scheduler, num_cores=1,
+                          memory_gb=2 * get_memory_gb(),
+                          compiledir_root=self.compiledir_root)
+
+    def test_rejects_more_cores_than_the_host(self):
+        self.assertRaises(ValueError, Scheduler, num_cores=5, memory_gb=1.0,
+                          compiledir_root=self.compiledir_root)
+
+    def test_failed_job_frees_its_slot(self):
+        scheduler = self.make_scheduler(1, 1.0)
+        scheduler.submit(Job('fail', [sys.executable, '-c', 'exit(3)']))
+        scheduler.submit(sleep_job('next', 0.1))
+        finished = scheduler.run()
+        self.assertEqual([(job.name, job.returncode) for job in finished],
+                         [('fail', 3), ('next', 0)])
+
+
+class TestJobEnv(unittest.TestCase):
+    def test_limits_threads_and_sets_theano_flags(self):
+        env = get_job_env(2, '/tmp/compiledir', base_env={
+            'THEANO_FLAGS': 'device=gpu0,floatX=float64,compiledir=/x'})
+        self.assertEqual(env['OMP_NUM_THREADS'], '2')
+        self.assertEqual(env['OPENBLAS_NUM_THREADS'], '2')
+        self.assertEqual(env['THEANO_FLAGS'].split(','),
+                         ['floatX=float64', 'device=cpu',
+                          'compiledir=/tmp/compiledir'])
+
+    def test_adds_float32_by_default(self):
+        env = get_job_env(1, 'dir', base_env={})
+        self.assertEqual(env['THEANO_FLAGS'],
+                         'floatX=float32,device=cpu,compiledir=dir')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,148 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import numpy
+
+from anna.inference.server import MicroBatcher, InferenceServer, \
+    InferenceClient, LatencyHistogram
+
+
+class RecordingModel(object):
+    # Doubles its input and records the shape of every batch
+    def __init__(self, fail_on=None):
+        self.batch_shapes = []
+        self.fail_on = fail_on
+        self.lock = threading.Lock()
+
+    def predict(self, batch):
+        with self.lock:
+            self.batch_shapes.append(batch.shape)
+        if self.fail_on is not None and numpy.any(batch == self.fail_on):
+            raise ValueError('bad sample')
+        return batch * 2.0
+
+
+class TestMicroBatcher(unittest.TestCase):
+    def submit_all(self, batcher, samples):
+        requests = [batcher.submit(sample) for sample in samples]
+        return [request.get() for request in requests]
+
+    def test_batches_queued_samples(self):
+        model = RecordingModel()
+        # A long delay, so that all samples queued at once share batches
+        batcher = MicroBatcher(model.predict, 4, max_delay=0.5)
+        try:
+            samples = [numpy.float32([i, -i]) for i in xrange(10)]
+            outputs = self.submit_all(batcher, samples)
+        finally:
+            batcher.stop()
+        for sample, output in zip(samples, outputs):
+            numpy.testing.assert_array_equal(output, sample * 2.0)
+        self.assertEqual(sorted([shape[0] for shape in model.batch_shapes]),
+                         [2, 4, 4])
+        stats = batcher.stats()
+        self.assertEqual(stats['batches'], 3)
+        self.assertAlmostEqual(stats['mean_batch_size'], 10 / 3.0)
+
+    def test_max_delay(self):
+        model = RecordingModel()
+        batcher = MicroBatcher(model.predict, 64, max_delay=0.001)
+        try:
+            output = batcher.predict(numpy.float32([1.0]))
+        finally:
+            batcher.stop()
+        numpy.testing.assert_array_equal(output, [2.0])
+        self.assertEqual(model.batch_shapes, [(1, 1)])
+
+    def test_padding_and_batch_axis(self):
+        model = RecordingModel()
+        # c01b: samples stacked along the last axis
+        batcher = MicroBatcher(model.predict, 4, max_delay=0.5,
+                               batch_axis=3, output_batch_axis=3,
+                               pad_batches=True)
+        try:
+            samples = [numpy.float32(numpy.full((2, 3, 3), i))
+                       for i in xrange(3)]
+            outputs = self.submit_all(batcher, samples)
+        finally:
+            batcher.stop()
+        self.assertEqual(model.batch_shapes, [(2, 3, 3, 4)])
+        for sample, output in zip(samples, outputs):
+            numpy.testing.assert_array_equal(output, sample * 2.0)
+
+    def test_padded_batch_is_zeroed(self):
+        batches = []
+
+        def predict(batch):
+            batches.append(batch.copy())
+            return batch.sum(axis=1)
+
+        batcher = MicroBatcher(predict, 4, max_delay=0.5, pad_batches=True)
+        try:
+            self.submit_all(batcher, [numpy.ones(2)] * 4)
+            output = batcher.predict(numpy.float32([3.0, 4.0]))
+        finally:
+            batcher.stop()
+        self.assertEqual(output, 7.0)
+        numpy.testing.assert_array_equal(batches[-1],
+                                         [[3, 4], [0, 0], [0, 0], [0, 0]])
+
+    def test_errors_reach_every_caller(self):
+        model = RecordingModel(fail_on=13.0)
+        batcher = MicroBatcher(model.predict, 8, max_delay=0.5)
+        try:
+            requests = [batcher.submit(numpy.float32([value]))
+                        for value in [1.0, 13.0, 2.0]]
+            for request in requests:
+                self.assertRaises(RuntimeError, request.get)
+            # The batcher keeps serving after a failed batch
+            numpy.testing.assert_array_equal(
+                batcher.predict(numpy.float32([5.0])), [10.0])
+        finally:
+            batcher.stop()
+
+    def test_stop_serves_queued_requests(self):
+        model = RecordingModel()
+        batcher = MicroBatcher(model.predict, 2, max_delay=0.5)
+        requests = [batcher.submit(numpy.float32([i])) for i in xrange(5)]
+        batcher.stop()
+        self.assertEqual([float(request.get()[0]) for request in requests],
+                         [0.0, 2.0, 4.0, 6.0, 8.0])
+
+
+class TestLatencyHistogram(unittest.TestCase):
+    def test_percentiles(self):
+        histogram = LatencyHistogram()
+        for latency in numpy.linspace(0.001, 0.1, 1000):
+            histogram.record(latency)
+        self.assertEqual(histogram.count(), 1000)
+        median = histogram.percentile(50)
+        self.assertTrue(0.04 < median < 0.06)
+        self.assertTrue(histogram.percentile(99) > 0.09)
+
+
+class TestInferenceServer(unittest.TestCase):
+    def test_round_trip(self):
+        path = tempfile.mkdtemp()
+        socket_path = os.path.join(path, 'server.sock')
+        server = InferenceServer(socket_path, MicroBatcher(
+            RecordingModel(fail_on=13.0).predict, 4, max_delay=0.001))
+        server.start()
+        try:
+            client = InferenceClient(socket_path)
+            numpy.testing.assert_array_equal(
+                client.predict(numpy.float32([1.0, 2.0])), [2.0, 4.0])
+            self.assertRaises(RuntimeError, client.predict,
+                              numpy.float32([13.0]))
+            self.assertEqual(client.stats()['batches'], 2)
+            client.close()
+        finally:
+            server.stop()
+            shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    unittest.main()
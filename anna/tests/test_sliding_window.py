@@ -0,0 +1,159 @@
+import unittest
+
+import numpy
+
+from anna.inference import runtime
+from anna.inference import quantize
+from anna.inference.sliding_window import SlidingWindowPredictor, \
+    convolutionize, get_total_stride
+
+
+def make_graph(input_order, nodes, output, **arrays):
+    for node in nodes:
+        node.setdefault('attrs', {})
+    graph = {'format': runtime.FORMAT, 'version': runtime.VERSION,
+             'input': {'name': 'input', 'data_order': input_order,
+                       'shape': [3, 8, 8]},
+             'output': output, 'nodes': nodes}
+    return graph, arrays
+
+
+def make_bc01_graph(rng):
+    # 8x8 patches: valid 3x3 convolution, 2x2 pooling and two Dense layers
+    return make_graph(
+        'bc01',
+        [{'name': 'conv', 'type': 'conv_bc01', 'inputs': ['input'],
+          'nonlinearity': 'relu', 'params': {'W': 'conv_W', 'b': 'conv_b'}},
+         {'name': 'pool', 'type': 'max_pool', 'inputs': ['conv'],
+          'attrs': {'pool_size': [2, 2]}},
+         {'name': 'hidden', 'type': 'dense', 'inputs': ['pool'],
+          'nonlinearity': 'relu',
+          'params': {'W': 'hidden_W', 'b': 'hidden_b'}},
+         {'name': 'dense', 'type': 'dense', 'inputs': ['hidden'],
+          'nonlinearity': 'softmax',
+          'params': {'W': 'dense_W', 'b': 'dense_b'}}],
+        'dense',
+        conv_W=numpy.float32(rng.randn(4, 3, 3, 3)),
+        conv_b=numpy.float32(rng.randn(4)),
+        hidden_W=numpy.float32(rng.randn(4 * 3 * 3, 6)),
+        hidden_b=numpy.float32(rng.randn(6)),
+        dense_W=numpy.float32(rng.randn(6, 5)),
+        dense_b=numpy.float32(rng.randn(5)))
+
+
+class TestSlidingWindow(unittest.TestCase):
+    def setUp(self):
+        self.rng = numpy.random.RandomState(0)
+
+    def check_score_map(self, graph, arrays, image, tile_size):
+        predictor = SlidingWindowPredictor(graph, arrays,
+                                           tile_size=tile_size)
+        model = runtime.InferenceModel(graph, arrays)
+        score_map = predictor.predict(image)
+        stride = get_total_stride(graph)
+        self.assertEqual(score_map.shape,
+                         predictor.get_output_shape(image.shape))
+        # Every position of the map, tiles of tile_size x tile_size
+        # positions, so that tile boundaries are crossed
+        patches = []
+        for row in xrange(score_map.shape[1]):
+            for col in xrange(score_map.shape[2]):
+                top, left = predictor.get_patch_origin(row, col)
+                self.assertEqual((top, left),
+                                 (row * stride[0], col * stride[1]))
+                patches.append(image[:, top:top + 8, left:left + 8])
+        num_patches = len(patches)
+        patches = numpy.float32(patches)
+        if model.data_order == 'c01b':
+            patches = patches.transpose(1, 2, 3, 0)
+        expected = model.predict(patches)
+        if expected.shape[0] != num_patches:
+            expected = expected.T
+        numpy.testing.assert_allclose(
+            score_map.reshape(score_map.shape[0], -1).T, expected,
+            rtol=1e-4, atol=1e-5)
+        return score_map
+
+    def test_bc01_matches_patches(self):
+        graph, arrays = make_bc01_graph(self.rng)
+        self.assertEqual(get_total_stride(graph), (2, 2))
+        image = numpy.float32(self.rng.randn(3, 21, 18))
+        score_map = self.check_score_map(graph, arrays, image, tile_size=3)
+        # (21 - 8) // 2 + 1 rows and (18 - 8) // 2 + 1 columns
+        self.assertEqual(score_map.shape, (5, 7, 6))
+
+    def test_global_pool_matches_patches(self):
+        graph, arrays = make_graph(
+            'bc01',
+            [{'name': 'conv', 'type': 'conv_bc01', 'inputs': ['input'],
+              'nonlinearity': 'relu', 'params': {'W': 'conv_W'}},
+             {'name': 'pool', 'type': 'global_pool', 'inputs': ['conv'],
+              'attrs': {'pooling_function': 'mean'}},
+             {'name': 'dense', 'type': 'dense', 'inputs': ['pool'],
+              'params': {'W': 'dense_W'}}],
+            'dense',
+            conv_W=numpy.float32(self.rng.randn(4, 3, 3, 3)),
+            dense_W=numpy.float32(self.rng.randn(4, 2)))
+        self.assertEqual(get_total_stride(graph), (1, 1))
+        image = numpy.float32(self.rng.randn(3, 13, 11))
+        self.check_score_map(graph, arrays, image, tile_size=4)
+
+    def test_c01b_matches_patches(self):
+        graph, arrays = make_graph(
+            'c01b',
+            [{'name': 'conv', 'type': 'conv_c01b', 'inputs': ['input'],
+              'nonlinearity': 'relu', 'params': {'W': 'conv_W'}},
+             {'name': 'pool', 'type': 'max_pool_c01b', 'inputs': ['conv'],
+              'attrs': {'pool_size': 2, 'stride': 2}},
+             {'name': 'shuffle', 'type': 'transpose', 'inputs': ['pool'],
+              'attrs': {'axes': [3, 0, 1, 2]}},
+             {'name': 'dense', 'type': 'dense', 'inputs': ['shuffle'],
+              'params': {'W': 'dense_W'}}],
+            'dense',
+            conv_W=numpy.float32(self.rng.randn(3, 3, 3, 4)),
+            dense_W=numpy.float32(self.rng.randn(4 * 3 * 3, 3)))
+        self.assertEqual(get_total_stride(graph), (2, 2))
+        image = numpy.float32(self.rng.randn(3, 16, 19))
+        self.check_score_map(graph, arrays, image, tile_size=2)
+
+    def test_int8_and_sparse_dense_layers(self):
+        graph, arrays = make_bc01_graph(self.rng)
+        image = numpy.float32(self.rng.randn(3, 14, 16))
+        int8_graph, int8_arrays = quantize.quantize_graph(
+            graph, arrays, {'conv': 3.0, 'hidden': 2.0, 'dense': 2.0})
+        self.check_score_map(int8_graph, int8_arrays, image, tile_size=2)
+
+        W = arrays['hidden_W'].copy()
+        W[numpy.abs(W) < 0.5] = 0.0
+        data, indices, indptr = runtime.to_csr(W)
+        sparse_graph, sparse_arrays = make_bc01_graph(
+            numpy.random.RandomState(0))
+        sparse_graph['nodes'][2].update(
+            {'type': 'dense_csr', 'attrs': {'shape': list(W.shape)},
+             'params': {'data': 'data', 'indices': 'indices',
+                        'indptr': 'indptr', 'b': 'hidden_b'}})
+        sparse_arrays.update({'data': data, 'indices': indices,
+                              'indptr': indptr})
+        self.check_score_map(sparse_graph, sparse_arrays, image, tile_size=2)
+
+    def test_convolutionize_drops_dense_weights(self):
+        graph, arrays = make_bc01_graph(self.rng)
+        conv_graph, conv_arrays = convolutionize(graph, arrays)
+        self.assertEqual([node['type'] for node in conv_graph['nodes']],
+                         ['conv_bc01', 'max_pool', 'conv_bc01', 'conv_bc01'])
+        self.assertEqual(conv_arrays['hidden_W_conv'].shape, (6, 4, 3, 3))
+        self.assertEqual(conv_arrays['dense_W_conv'].shape, (5, 6, 1, 1))
+        self.assertTrue('hidden_W' not in conv_arrays)
+        self.assertEqual(conv_graph['output_data_order'], 'bc01')
+
+    def test_dense_on_c01b_input(self):
+        graph, arrays = make_graph(
+            'c01b',
+            [{'name': 'dense', 'type': 'dense', 'inputs': ['input'],
+              'params': {'W': 'dense_W'}}],
+            'dense', dense_W=numpy.float32(self.rng.randn(3 * 8 * 8, 2)))
+        self.assertRaises(RuntimeError, convolutionize, graph, arrays)
+
+
+if __name__ == '__main__':
+    unittest.main()
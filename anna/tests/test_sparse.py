@@ -0,0 +1,119 @@
+import sys
+import unittest
+
+import numpy
+
+from anna.inference import runtime
+
+
+def make_sparse_weights(rng, shape, sparsity):
+    W = numpy.float32(rng.randn(*shape))
+    W[rng.rand(*shape) < sparsity] = 0.0
+    return W
+
+
+def make_csr_op(W, b=None):
+    data, indices, indptr = runtime.to_csr(W)
+    arrays = {'data': data, 'indices': indices, 'indptr': indptr}
+    params = {'data': 'data', 'indices': 'indices', 'indptr': 'indptr'}
+    if b is not None:
+        arrays['b'] = b
+        params['b'] = 'b'
+    node = {'name': 'dense', 'type': 'dense_csr', 'inputs': ['input'],
+            'params': params, 'attrs': {'shape': list(W.shape)},
+            'nonlinearity': 'relu'}
+    return runtime.DenseCSR(node, arrays)
+
+
+def run_op(op, x):
+    out = numpy.zeros(op.get_output_shape([x.shape]), dtype=numpy.float32)
+    op.run([x], out, op.allocate([x.shape]))
+    return out
+
+
+class WithoutScipy(object):
+    # Makes "import scipy.sparse" fail, to test the NumPy fallback
+    def __enter__(self):
+        self.modules = dict([(name, sys.modules[name])
+                             for name in list(sys.modules)
+                             if name == 'scipy' or name.startswith('scipy.')])
+        for name in self.modules:
+            del sys.modules[name]
+        sys.modules['scipy'] = None
+        return self
+
+    def __exit__(self, *args):
+        del sys.modules['scipy']
+        sys.modules.update(self.modules)
+
+
+class TestDenseCSR(unittest.TestCase):
+    def setUp(self):
+        self.rng = numpy.random.RandomState(0)
+
+    def test_to_csr_round_trip(self):
+        W = make_sparse_weights(self.rng, (30, 20), 0.8)
+        data, indices, indptr = runtime.to_csr(W)
+        self.assertEqual(len(data), numpy.count_nonzero(W))
+        dense = numpy.zeros(W.T.shape, dtype=numpy.float32)
+        for row in xrange(W.shape[1]):
+            start, stop = indptr[row], indptr[row + 1]
+            dense[row, indices[start:stop]] = data[start:stop]
+        numpy.testing.assert_array_equal(dense, W.T)
+
+    def check_against_dense(self, op, W, b, x):
+        expected = numpy.maximum(numpy.dot(x, W) + b, 0.0)
+        numpy.testing.assert_allclose(run_op(op, x), expected, rtol=1e-5,
+                                      atol=1e-5)
+
+    def test_matches_dense(self):
+        for sparsity in [0.0, 0.5, 0.95]:
+            W = make_sparse_weights(self.rng, (40, 25), sparsity)
+            b = numpy.float32(self.rng.randn(25))
+            x = numpy.float32(self.rng.randn(7, 40))
+            self.check_against_dense(make_csr_op(W, b), W, b, x)
+
+    def test_numpy_fallback_matches_dense(self):
+        W = make_sparse_weights(self.rng, (40, 25), 0.9)
+        # Output units without any weight
+        W[:, [3, 24]] = 0.0
+        b = numpy.float32(self.rng.randn(25))
+        x = numpy.float32(self.rng.randn(6, 40))
+        with WithoutScipy():
+            op = make_csr_op(W, b)
+        self.assertTrue(op.W_T is None)
+        self.check_against_dense(op, W, b, x)
+
+    def test_all_pruned(self):
+        W = numpy.zeros((10, 4), dtype=numpy.float32)
+        b = numpy.float32(self.rng.randn(4))
+        x = numpy.float32(self.rng.randn(3, 10))
+        with WithoutScipy():
+            op = make_csr_op(W, b)
+        self.check_against_dense(op, W, b, x)
+        self.check_against_dense(make_csr_op(W, b), W, b, x)
+
+    def test_flattens_input(self):
+        W = make_sparse_weights(self.rng, (2 * 3 * 4, 5), 0.7)
+        x = numpy.float32(self.rng.randn(3, 2, 3, 4))
+        op = make_csr_op(W)
+        numpy.testing.assert_allclose(
+            run_op(op, x), numpy.maximum(numpy.dot(x.reshape(3, -1), W), 0),
+            rtol=1e-5, atol=1e-5)
+
+
+class TestMagnitudeMask(unittest.TestCase):
+    def test_prunes_smallest_weights(self):
+        from anna.layers.pruning import compute_magnitude_mask
+        W = numpy.float32(numpy.random.RandomState(0).randn(20, 10))
+        mask = compute_magnitude_mask(W, 0.75)
+        self.assertEqual(mask.shape, W.shape)
+        self.assertEqual(int(mask.sum()), 50)
+        kept = numpy.abs(W[mask == 1])
+        pruned = numpy.abs(W[mask == 0])
+        self.assertTrue(kept.min() >= pruned.max())
+        self.assertTrue(numpy.all(compute_magnitude_mask(W, 0.0) == 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
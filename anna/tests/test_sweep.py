@@ -0,0 +1,338 @@
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import unittest
+
+from anna.parallel import sweep
+
+# train.py of a fake experiment: its error is the configuration's 'x' and
+# it logs like a Monitor
+TRAIN_SCRIPT = '''
+import json
+import os
+import sys
+
+out_path = sys.argv[2]
+config = json.load(open(os.path.join(out_path, 'config.json')))
+calls = open(os.path.join(out_path, 'calls.txt'), 'a')
+calls.write(json.dumps(config) + '\\n')
+calls.close()
+if config.get('fail'):
+    sys.exit(2)
+for step in [1, 2]:
+    print('%d, train error: %f' % (step, 2.0 * config['x']))
+print('*2, train error: %f' % config['x'])
+print('&2, test error: %f' % (config['x'] + 1.0))
+print('&2, test error: %f' % config['x'])
+'''
+
+# train.py for successive halving: resumes from its checkpoint, which holds
+# the step it was saved at, and saves one (with moving averages) at the end
+HALVING_SCRIPT = '''
+import json
+import os
+import sys
+
+out_path = sys.argv[2]
+config = json.load(open(os.path.join(out_path, 'config.json')))
+calls = open(os.path.join(out_path, 'calls.txt'), 'a')
+calls.write(json.dumps(config) + '\\n')
+calls.close()
+if config.get('fail'):
+    sys.exit(2)
+step = 0
+if 'resume_checkpoint' in config:
+    step = int(open(config['resume_checkpoint']).read())
+assert step == config.get('start_step', 0)
+checkpoint_path = os.path.join(out_path, 'checkpoints',
+                               'model-%d.pkl' % config['num_steps'])
+if not os.path.exists(os.path.dirname(checkpoint_path)):
+    os.makedirs(os.path.dirname(checkpoint_path))
+open(checkpoint_path, 'w').write(str(config['num_steps']))
+open(checkpoint_path[:-4] + '_ema.pkl', 'w').write('moving averages')
+print('&%d, test error: %f' % (config['num_steps'], config['x']))
+'''
+
+
+class TestConfigs(unittest.TestCase):
+    def test_expand_grid(self):
+        configs = sweep.expand_grid({'b': [1, 2], 'a': ['x', 'y', 'z']})
+        self.assertEqual(len(configs), 6)
+        self.assertEqual(configs[0], {'a': 'x', 'b': 1})
+        self.assertEqual(configs[1], {'a': 'x', 'b': 2})
+        self.assertEqual(
+            sorted([(config['a'], config['b']) for config in configs]),
+            [(a, b) for a in 'xyz' for b in [1, 2]])
+
+    def test_sample_random(self):
+        space = {'lr': {'log_uniform': [1e-4, 1e-1]},
+                 'dropout': {'uniform': [0.2, 0.5]},
+                 'layers': {'int': [1, 3]},
+                 'act': {'choice': ['relu', 'tanh']},
+                 'batch': 128}
+        configs = sweep.sample_random(space, 50, seed=3)
+        self.assertEqual(configs, sweep.sample_random(space, 50, seed=3))
+        self.assertNotEqual(configs, sweep.sample_random(space, 50, seed=4))
+        for config in configs:
+            self.assertTrue(1e-4 <= config['lr'] <= 1e-1)
+            self.assertTrue(0.2 <= config['dropout'] <= 0.5)
+            self.assertIn(config['layers'], [1, 2, 3])
+            self.assertIn(config['act'], ['relu', 'tanh'])
+            self.assertEqual(config['batch'], 128)
+        self.assertEqual(set([config['layers'] for config in configs]),
+                         set([1, 2, 3]))
+
+    def test_sample_unknown_entry(self):
+        self.assertRaises(ValueError, sweep.sample_random,
+                          {'lr': {'normal': [0, 1]}}, 1)
+
+    def test_get_configs(self):
+        spec = {'grid': {'a': [1, 2]}, 'random': {'b': {'int': [0, 9]}},
+                'num_samples': 3, 'fixed': {'c': 'same'}}
+        configs = sweep.get_configs(spec)
+        self.assertEqual(len(configs), 5)
+        self.assertTrue(all([config['c'] == 'same' for config in configs]))
+        self.assertEqual([config.get('a') for config in configs],
+                         [1, 2, None, None, None])
+        self.assertEqual(sweep.get_configs({'fixed': {'c': 1}}), [{'c': 1}])
+
+    def test_run_name_is_stable(self):
+        name = sweep.get_run_name({'a': 1, 'b': 0.5})
+        self.assertEqual(name, sweep.get_run_name({'b': 0.5, 'a': 1}))
+        self.assertNotEqual(name, sweep.get_run_name({'a': 1, 'b': 0.25}))
+        self.assertTrue(name.startswith('run-'))
+
+
+class TestResults(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def write_log(self, lines):
+        log_path = os.path.join(self.path, sweep.LOG_NAME)
+        f = open(log_path, 'w')
+        f.write('\n'.join(lines) + '\n')
+        f.close()
+        return log_path
+
+    def test_parse_log(self):
+        log_path = self.write_log([
+            'Compiling...', '10, train error: 0.9', '*20, train error: 0.5',
+            '&20, test error: 0.6', '30, train error: 0.4',
+            '*40, train error: 0.7', '&40, test error: 0.65',
+            '45, train error: nan'])
+        self.assertEqual(sweep.parse_log(log_path), {
+            'steps': 45, 'final_train_error': 0.7, 'best_train_error': 0.5,
+            'final_test_error': 0.65, 'best_test_error': 0.6})
+
+    def test_parse_log_short_train_errors(self):
+        log_path = self.write_log(['1, train error: 0.9',
+                                   '2, train error: 0.3'])
+        metrics = sweep.parse_log(log_path)
+        self.assertEqual(metrics['final_train_error'], 0.3)
+        self.assertEqual(metrics['best_test_error'], None)
+
+    def test_missing_log(self):
+        metrics = sweep.parse_log(os.path.join(self.path, 'missing.txt'))
+        self.assertEqual(metrics['steps'], None)
+
+    def test_write_and_read_result(self):
+        self.write_log(['&5, test error: 0.1'])
+        result = sweep.write_result(self.path, {'a': 1}, 0,
+                                    extra={'num_steps': 5})
+        self.assertEqual(sweep.read_result(self.path), result)
+        self.assertEqual(result['best_test_error'], 0.1)
+        self.assertEqual(result['num_steps'], 5)
+        self.assertEqual(sweep.read_result(self.path, 'other.json'), None)
+
+    def test_sort_key(self):
+        results = [{'returncode': 1, 'best_test_error': 0.0},
+                   {'returncode': 0, 'best_test_error': 0.3},
+                   {'returncode': 0, 'best_train_error': 0.1},
+                   {'returncode': 0, 'best_test_error': 0.2}]
+        results.sort(key=sweep.get_sort_key)
+        # Runs without test errors are ranked by their train error, failed
+        # runs last
+        self.assertEqual([result.get('best_test_error')
+                          for result in results], [None, 0.2, 0.3, 0.0])
+
+
+def make_experiment(path, script=TRAIN_SCRIPT):
+    train_path = os.path.join(path, 'experiment')
+    os.mkdir(train_path)
+    f = open(os.path.join(train_path, 'train.py'), 'w')
+    f.write(script)
+    f.close()
+    return train_path
+
+
+def read_calls(run_path):
+    return [json.loads(line)
+            for line in open(os.path.join(run_path, 'calls.txt'))]
+
+
+class TestSweep(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.train_path = make_experiment(self.path)
+        self.out_path = os.path.join(self.path, 'runs')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_runs_and_ranks_configs(self):
+        spec = {'grid': {'x': [0.3, 0.1, 0.2]}, 'fixed': {'fail': False}}
+        runner = sweep.Sweep(spec, self.train_path, self.out_path)
+        results = runner.run()
+
+        self.assertEqual([result['config']['x'] for result in results],
+                         [0.1, 0.2, 0.3])
+        best = results[0]
+        self.assertEqual(best['returncode'], 0)
+        self.assertEqual(best['best_test_error'], 0.1)
+        self.assertEqual(best['final_train_error'], 0.1)
+        self.assertEqual(best['steps'], 2)
+        run_path = runner.get_run_path(best['config'])
+        self.assertEqual(best['run'], os.path.basename(run_path))
+        self.assertEqual(sweep.get_config(run_path), best['config'])
+        self.assertIn('train.py', os.listdir(run_path))
+
+    def test_rerun_skips_finished_configs(self):
+        spec = {'grid': {'x': [0.1, 0.2], 'fail': [False, True]}}
+        runner = sweep.Sweep(spec, self.train_path, self.out_path)
+        results = runner.run()
+        self.assertEqual([result['returncode'] for result in results],
+                         [0, 0, 2, 2])
+
+        runner.run()
+        for config in runner.configs:
+            num_calls = len(read_calls(runner.get_run_path(config)))
+            # Failed runs are retried
+            self.assertEqual(num_calls, 2 if config['fail'] else 1)
+
+    def test_format_results(self):
+        runner = sweep.Sweep({'grid': {'x': [0.5]}}, self.train_path,
+                             self.out_path)
+        table = sweep.format_results(runner.run()).split('\n')
+        self.assertEqual(len(table), 2)
+        self.assertEqual(table[0].split()[0:2], ['run', 'x'])
+        self.assertIn('0.5', table[1].split())
+
+    def test_rejects_more_cores_than_the_host(self):
+        self.assertRaises(ValueError, sweep.Sweep, {'grid': {'x': [0.5]}},
+                          self.train_path, self.out_path,
+                          max_concurrent=multiprocessing.cpu_count() + 1)
+
+
+class TestSuccessiveHalving(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.train_path = make_experiment(self.path, HALVING_SCRIPT)
+        self.out_path = os.path.join(self.path, 'runs')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def make_runner(self, xs, **kwargs):
+        spec = {'grid': {'x': xs}}
+        return sweep.SuccessiveHalving(spec, self.train_path, self.out_path,
+                                       **kwargs)
+
+    def test_rungs_keep_best_configs(self):
+        runner = self.make_runner([0.4, 0.1, 0.3, 0.2], min_steps=1,
+                                  max_steps=4, eta=2)
+        history = runner.run()
+
+        self.assertEqual([[result['config']['x'] for result in results]
+                          for results in history],
+                         [[0.1, 0.2, 0.3, 0.4], [0.1, 0.2], [0.1]])
+        self.assertEqual([results[0]['num_steps'] for results in history],
+                         [1, 2, 4])
+        self.assertEqual(history[2][0]['final_test_error'], 0.1)
+
+        # The best configuration resumed from the checkpoint of every rung
+        best_path = runner.get_run_path({'x': 0.1})
+        calls = read_calls(best_path)
+        self.assertEqual([call['num_steps'] for call in calls], [1, 2, 4])
+        self.assertNotIn('resume_checkpoint', calls[0])
+        self.assertEqual(calls[1]['start_step'], 1)
+        self.assertEqual(calls[1]['resume_checkpoint'],
+                         os.path.join(best_path, 'checkpoints', 'model-1.pkl'))
+        self.assertEqual(calls[2]['resume_checkpoint'],
+                         os.path.join(best_path, 'checkpoints', 'model-2.pkl'))
+        for i in xrange(3):
+            self.assertTrue(os.path.exists(os.path.join(
+                best_path, 'log.rung%d.txt' % i)))
+        # Stopped configurations ran one rung only
+        self.assertEqual(len(read_calls(runner.get_run_path({'x': 0.4}))), 1)
+
+    def test_rerun_skips_finished_rungs(self):
+        runner = self.make_runner([0.2, 0.1], min_steps=2, max_steps=4)
+        history = runner.run()
+        self.assertEqual(runner.run(), history)
+        for x in [0.2, 0.1]:
+            calls = read_calls(runner.get_run_path({'x': x}))
+            self.assertEqual(len(calls), 1 if x == 0.2 else 2)
+
+    def test_stops_at_max_steps(self):
+        runner = self.make_runner([0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8,
+                                   0.9], min_steps=2, max_steps=5, eta=3)
+        history = runner.run()
+        self.assertEqual([len(results) for results in history], [9, 3])
+        self.assertEqual([results[0]['num_steps'] for results in history],
+                         [2, 5])
+
+    def test_failed_configs_are_stopped(self):
+        spec = {'grid': {'x': [0.1, 0.2], 'fail': [False, True]}}
+        runner = sweep.SuccessiveHalving(spec, self.train_path,
+                                         self.out_path, 1, 8)
+        history = runner.run()
+        self.assertEqual([result['returncode'] for result in history[0]],
+                         [0, 0, 2, 2])
+        self.assertEqual([result['config'] for result in history[1]],
+                         [{'x': 0.1, 'fail': False},
+                          {'x': 0.2, 'fail': False}])
+
+    def test_missing_checkpoint_fails_the_run(self):
+        runner = self.make_runner([0.1, 0.2], min_steps=1, max_steps=2)
+        configs = [{'x': 0.1}, {'x': 0.2}]
+        runner._run_rung(0, configs, 0, 1)
+        shutil.rmtree(os.path.join(runner.get_run_path({'x': 0.1}),
+                                   'checkpoints'))
+
+        results = runner._run_rung(1, configs, 1, 2)
+        self.assertEqual([(result['config'], result['returncode'])
+                          for result in results],
+                         [({'x': 0.2}, 0), ({'x': 0.1}, None)])
+        # The run did not restart from scratch
+        self.assertEqual(len(read_calls(runner.get_run_path({'x': 0.1}))), 1)
+
+    def test_run_without_result_is_ranked_last(self):
+        runner = self.make_runner([0.1, 0.2], min_steps=1, max_steps=2)
+        get_job = runner._get_job
+
+        def get_job_without_result(config, *args):
+            job = get_job(config, *args)
+            if config['x'] == 0.1:
+                job.on_finish = None
+            return job
+        runner._get_job = get_job_without_result
+
+        history = runner.run()
+        self.assertEqual([(result['config'], result['returncode'])
+                          for result in history[0]],
+                         [({'x': 0.2}, 0), ({'x': 0.1}, None)])
+        self.assertEqual([result['config'] for result in history[1]],
+                         [{'x': 0.2}])
+
+    def test_eta_must_be_at_least_2(self):
+        self.assertRaises(ValueError, self.make_runner, [0.1], min_steps=1,
+                          max_steps=2, eta=1)
+
+
+if __name__ == '__main__':
+    unittest.main()
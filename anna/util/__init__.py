@@ -8,6 +8,7 @@ from copy import deepcopy
 import cPickle
 
 import numpy
+from numpy.lib.format import open_memmap
 from skimage import color
 
 import theano
@@ -21,21 +22,68 @@ from pylearn2.utils._window_flip import random_window_and_flip_c01b
 
 from anna.layers import layers
 from anna.datasets import supervised_dataset
+from anna.datasets.streaming import PaddedBatchIterator, BatchPrefetcher
 
 
-def load_checkpoint(model, checkpoint_path):
-    all_parameters = model.all_save_parameters_symbol
+def read_checkpoint(checkpoint_path):
     f = open(checkpoint_path, 'rb')
     checkpoint = cPickle.load(f)
     f.close()
+    return checkpoint
+
+
+def get_ema_checkpoint_path(checkpoint_path):
+    # Moving averages of model-<time>.pkl are saved in model-<time>_ema.pkl,
+    # so that the checkpoint itself stays a plain list of parameter values
+    return os.path.splitext(checkpoint_path)[0] + '_ema.pkl'
+
+
+def read_ema_checkpoint(checkpoint_path):
+    # Moving averages saved with a checkpoint, or None
+    ema_checkpoint_path = get_ema_checkpoint_path(checkpoint_path)
+    if not os.path.exists(ema_checkpoint_path):
+        return None
+    return read_checkpoint(ema_checkpoint_path)
+
+
+def load_checkpoint(model, checkpoint_path):
+    set_checkpoint_values(model, read_checkpoint(checkpoint_path),
+                          read_ema_checkpoint(checkpoint_path))
+
+
+def set_checkpoint_values(model, checkpoint, ema_checkpoint=None):
+    all_parameters = model.all_save_parameters_symbol
+    # Half-precision checkpoints are upcast to the parameters' dtype
+    [model_param.set_value(numpy.asarray(checkpoint_param,
+                                         dtype=model_param.dtype))
+     for model_param, checkpoint_param in zip(all_parameters, checkpoint)]
+
+    # Without saved moving averages (for these parameters), the averages
+    # restart from the loaded parameters
+    shadows = get_ema_shadows(model)
+    if ema_checkpoint is None or len(ema_checkpoint) != len(shadows):
+        ema_checkpoint = [param.get_value() for param in all_parameters
+                          if layers.get_ema_shadow(param) is not None]
+    [shadow.set_value(numpy.asarray(shadow_value, dtype=shadow.dtype))
+     for shadow, shadow_value in zip(shadows, ema_checkpoint)]
+
 
-    [model_param.set_value(checkpoint_param) for model_param, checkpoint_param
-     in zip(all_parameters, checkpoint)]
+def get_ema_shadows(model):
+    return [layers.get_ema_shadow(param)
+            for param in model.all_save_parameters_symbol
+            if layers.get_ema_shadow(param) is not None]
 
 
-def save_checkpoint(model, checkpoint_directory_name):
+def save_checkpoint(model, checkpoint_directory_name, dtype=None):
+    # dtype=numpy.float16 halves the size of the checkpoint on disk
     all_parameters = model.all_save_parameters_symbol
     checkpoint = [param.get_value() for param in all_parameters]
+    ema_checkpoint = [shadow.get_value() for shadow in get_ema_shadows(model)]
+    if dtype is not None:
+        checkpoint = [numpy.asarray(param, dtype=dtype)
+                      for param in checkpoint]
+        ema_checkpoint = [numpy.asarray(shadow, dtype=dtype)
+                          for shadow in ema_checkpoint]
     tt = datetime.now()
     time_string = tt.strftime('%mm-%dd-%Hh-%Mm-%Ss')
     checkpoint_name = '%s-%s.pkl' % (model.name, time_string)
@@ -47,6 +95,11 @@ def save_checkpoint(model, checkpoint_directory_name):
     f = open(checkpoint_path, 'wb')
     cPickle.dump(checkpoint, f)
     f.close()
+    if ema_checkpoint:
+        f = open(get_ema_checkpoint_path(checkpoint_path), 'wb')
+        cPickle.dump(ema_checkpoint, f)
+        f.close()
+    return checkpoint_path
 
 
 def rescale(data):
@@ -385,14 +438,17 @@ class FilterVisualizerGrayscale(object):
 
 
 class Monitor(object):
-    errors = []
-    times = []
-    big_errors = []
-    big_times = []
-
     def __init__(self, model, step_number=0, best=1, short_steps=10,
                  long_steps=50, save_steps=2000, test_steps=50,
-                 checkpoint_directory='checkpoints'):
+                 checkpoint_directory='checkpoints', checkpoint_dtype=None,
+                 log_file=None):
+        # Per instance, so that several models can be monitored at once
+        self.errors = []
+        self.times = []
+        self.big_errors = []
+        self.big_times = []
+        # Open file to write the log lines to instead of stdout
+        self.log_file = log_file
         self.step_number = step_number
         self.best = best
         self.short_steps = short_steps
@@ -402,6 +458,7 @@ class Monitor(object):
         self.test = False
         self.test_steps = test_steps
         self.checkpoint_directory = checkpoint_directory
+        self.checkpoint_dtype = checkpoint_dtype
 
         # Check if model.path exists, if not create it
         # (with a checkpoint folder)
@@ -417,8 +474,8 @@ class Monitor(object):
         if self.test:
             self.toc = time()
             _time = self.toc - self.tic
-            print '&%d, test error: %.5f, time: %.2f' % (self.step_number,
-                                                         error, _time)
+            self._log('&%d, test error: %.5f, time: %.2f' % (
+                self.step_number, error, _time))
 
     def stop(self, error):
         self.toc = time()
@@ -432,25 +489,31 @@ class Monitor(object):
         else:
             self.test = False
         if self.step_number % self.save_steps == 0:
-            save_checkpoint(self.model, self.checkpoint_directory)
+            save_checkpoint(self.model, self.checkpoint_directory,
+                            dtype=self.checkpoint_dtype)
         if self.step_number % self.long_steps == 0:
             mean_error = numpy.mean(self.big_errors)
             mean_time = numpy.mean(self.big_times)
-            print '*%d, train error: %.5f, time: %.2f' % (self.step_number,
-                                                          mean_error,
-                                                          mean_time)
+            self._log('*%d, train error: %.5f, time: %.2f' % (
+                self.step_number, mean_error, mean_time))
             self.big_errors = []
             self.big_times = []
         if self.step_number % self.short_steps == 0:
             mean_error = numpy.mean(self.errors)
             mean_time = numpy.mean(self.times)
-            print '%d, train error: %.5f, time: %.2f' % (self.step_number,
-                                                         mean_error,
-                                                         mean_time)
+            self._log('%d, train error: %.5f, time: %.2f' % (
+                self.step_number, mean_error, mean_time))
             self.errors = []
             self.times = []
         self.step_number += 1
 
+    def _log(self, line):
+        if self.log_file is None:
+            print line
+        else:
+            self.log_file.write(line + '\n')
+            self.log_file.flush()
+
 
 class EvaluatorPylearn2(object):
     def __init__(self, model, dataset, steps=100):
@@ -739,7 +802,8 @@ def set_parameters_from_unsupervised_model(model, checkpoint):
                 list(model_params_flipped[i].shape.eval())):
             raise Exception('Size mismatch!')
 
-        model_params_flipped[i].set_value(checkpoint_params_flipped[i])
+        model_params_flipped[i].set_value(numpy.asarray(
+            checkpoint_params_flipped[i], dtype=model_params_flipped[i].dtype))
 
 
 class DataAugmenter(object):
@@ -790,15 +854,20 @@ class DataAugmenter(object):
 
 class Evaluator(object):
     def __init__(self, model, data_container, checkpoint,
-                 preprocessor_module_list):
+                 preprocessor_module_list, use_ema=False):
         self.model = model
         self.data_container = data_container
         self.checkpoint = checkpoint
+        # Evaluate the moving averages of the parameters (see
+        # AbstractModel.ema_decay) instead of the parameters themselves
+        self.use_ema = use_ema
         self.preprocessor = Preprocessor(preprocessor_module_list)
         self.batch_size = model.batch
+        # Models with a symbolic minibatch size take the last batch as is
+        self.pad_last_batch = layers.has_static_batch(model.output)
 
         # Load parameters from checkpoint
-        load_checkpoint(self.model, self.checkpoint)
+        self._load_checkpoint()
         self._switch_off_dropout_flags()
 
     def run(self):
@@ -820,15 +889,20 @@ class Evaluator(object):
         last_batch_start_ind = int(last_batch_start_ind)
         last_batch = self.data_container.X[last_batch_start_ind:, :, :, :]
 
-        dummy_batch = numpy.zeros((self.batch_size, num_channels,
-                                   height, width), dtype=numpy.float32)
-        dummy_batch[0:last_batch.shape[0], :, :, :] = last_batch
-        dummy_batch = dummy_batch.transpose(1, 2, 3, 0)
-        dummy_batch = self.preprocessor.run(dummy_batch)
-        batch_pred = self.model.prediction(dummy_batch)
-        batch_pred = batch_pred[0:last_batch.shape[0], :]
-        batch_pred = numpy.argmax(batch_pred, axis=1)
-        predictions.append(batch_pred)
+        if last_batch.shape[0] > 0:
+            if self.pad_last_batch:
+                dummy_batch = numpy.zeros((self.batch_size, num_channels,
+                                           height, width),
+                                          dtype=numpy.float32)
+                dummy_batch[0:last_batch.shape[0], :, :, :] = last_batch
+            else:
+                dummy_batch = numpy.float32(last_batch)
+            dummy_batch = dummy_batch.transpose(1, 2, 3, 0)
+            dummy_batch = self.preprocessor.run(dummy_batch)
+            batch_pred = self.model.prediction(dummy_batch)
+            batch_pred = batch_pred[0:last_batch.shape[0], :]
+            batch_pred = numpy.argmax(batch_pred, axis=1)
+            predictions.append(batch_pred)
 
         # Get all predictions
         predictions = numpy.hstack(predictions)
@@ -842,12 +916,17 @@ class Evaluator(object):
 
     def set_checkpoint(self, checkpoint):
         self.checkpoint = checkpoint
-        load_checkpoint(self.model, self.checkpoint)
+        self._load_checkpoint()
         self._switch_off_dropout_flags()
 
     def set_preprocessor(self, preprocessor_module_list):
         self.preprocessor = Preprocessor(preproessor_module_list)
 
+    def _load_checkpoint(self):
+        load_checkpoint(self.model, self.checkpoint)
+        if self.use_ema:
+            self.model.swap_ema_parameters()
+
     def _switch_off_dropout_flags(self):
         # Switch off dropout flag (if present) in every layer
         all_layers = layers.all_layers(self.model.output)
@@ -865,6 +944,328 @@ class Evaluator(object):
         return iterator
 
 
+class TTAEvaluator(Evaluator):
+    """
+    Evaluator with test-time augmentation: every sample is scored as the
+    sum of the model outputs (e.g. softmax probabilities) over several
+    views, each a (row, col, flip) crop of the image zero-padded by
+    amount_pad, with the model's input size.
+
+    The views of consecutive samples are packed into full model batches, so
+    the dataset is read once and the model runs views * samples / batch
+    times.
+    """
+    def __init__(self, model, data_container, checkpoint,
+                 preprocessor_module_list, amount_pad=0, flip=True,
+                 corners=False, views=None, use_ema=False):
+        super(TTAEvaluator, self).__init__(model, data_container, checkpoint,
+                                           preprocessor_module_list,
+                                           use_ema=use_ema)
+        self.amount_pad = amount_pad
+        input_shape = model.input.get_output_shape()
+        if layers.batch_axis(model.input) == 3:
+            self.window_shape = tuple(input_shape[1:3])
+        else:
+            self.window_shape = tuple(input_shape[2:4])
+
+        if views is None:
+            views = self._get_views(flip, corners)
+        self.views = views
+
+    def _get_views(self, flip, corners):
+        # Centre crop, optionally the four corner crops, each optionally
+        # flipped horizontally
+        __, __, height, width = self.data_container.X.shape
+        max_row = height + 2 * self.amount_pad - self.window_shape[0]
+        max_col = width + 2 * self.amount_pad - self.window_shape[1]
+        offsets = [(max_row // 2, max_col // 2)]
+        if corners:
+            offsets += [(0, 0), (0, max_col), (max_row, 0),
+                        (max_row, max_col)]
+        flips = [False, True] if flip else [False]
+        return [(row, col, view_flip) for row, col in offsets
+                for view_flip in flips]
+
+    def _iterate_samples(self):
+        # Yields the first flat view index of every model batch and the
+        # zero-padded samples its views come from.
+        X = self.data_container.X
+        num_views = len(self.views)
+        pad = self.amount_pad
+        for view_start in xrange(0, X.shape[0] * num_views, self.batch_size):
+            view_stop = min(view_start + self.batch_size,
+                            X.shape[0] * num_views)
+            sample_start = view_start // num_views
+            sample_stop = (view_stop - 1) // num_views + 1
+            samples = X[sample_start:sample_stop]
+            padded = numpy.zeros(samples.shape[0:2] +
+                                 (samples.shape[2] + 2 * pad,
+                                  samples.shape[3] + 2 * pad),
+                                 dtype=numpy.float32)
+            padded[:, :, pad:pad + samples.shape[2],
+                   pad:pad + samples.shape[3]] = samples
+            yield view_start, view_stop, padded
+
+    def run(self):
+        num_samples = self.data_container.X.shape[0]
+        num_views = len(self.views)
+        num_channels = self.data_container.X.shape[1]
+        height, width = self.window_shape
+
+        batch = numpy.zeros((self.batch_size, num_channels, height, width),
+                            dtype=numpy.float32)
+        predictions = numpy.zeros(num_samples, dtype=numpy.int64)
+        # Summed outputs of the sample whose views straddle two batches
+        carry = None
+
+        iterator = BatchPrefetcher(self._iterate_samples())
+        for view_start, view_stop, padded in iterator:
+            num_valid = view_stop - view_start
+            flat_index = numpy.arange(view_start, view_stop)
+            sample_start = view_start // num_views
+            sample_index = flat_index // num_views - sample_start
+            view_index = flat_index % num_views
+
+            positions = []
+            for view, (row, col, flip) in enumerate(self.views):
+                position = numpy.nonzero(view_index == view)[0]
+                positions.append(position)
+                crop = padded[sample_index[position], :, row:row + height,
+                              col:col + width]
+                if flip:
+                    crop = crop[:, :, :, ::-1]
+                batch[position] = crop
+
+            if self.pad_last_batch:
+                batch[num_valid:] = 0.0
+                x_batch = batch
+            else:
+                x_batch = batch[0:num_valid]
+            if layers.batch_axis(self.model.input) == 3:
+                x_batch = x_batch.transpose(1, 2, 3, 0)
+            x_batch = self.preprocessor.run(x_batch)
+            batch_pred = numpy.asarray(self.model.prediction(x_batch))
+
+            probabilities = numpy.zeros((padded.shape[0],
+                                         batch_pred.shape[1]),
+                                        dtype=numpy.float32)
+            if carry is not None:
+                probabilities[0] += carry
+            for position in positions:
+                probabilities[sample_index[position]] += batch_pred[position]
+
+            # Samples whose views are all done
+            sample_done = view_stop // num_views
+            num_done = sample_done - sample_start
+            predictions[sample_start:sample_done] = numpy.argmax(
+                probabilities[0:num_done], axis=1)
+            if num_done < padded.shape[0]:
+                carry = probabilities[num_done]
+            else:
+                carry = None
+
+        # Compute accuracy
+        accuracy = (100.0*numpy.sum(
+            predictions == self.data_container.y))/len(self.data_container.y)
+
+        return accuracy
+
+
+class CheckpointSweeper(object):
+    """
+    Evaluates many checkpoints of one model on the same data. The
+    dropout-free prediction is compiled once, the preprocessed batches are
+    cached in memory (as cache_dtype, e.g. numpy.float16 to halve it) on the
+    first run, and checkpoints are read in a background thread while the
+    previous one is evaluated.
+    """
+    def __init__(self, model, data_container, preprocessor_module_list,
+                 cache_dtype=numpy.float32):
+        self.model = model
+        self.data_container = data_container
+        self.preprocessor = Preprocessor(preprocessor_module_list)
+        self.cache_dtype = cache_dtype
+        self.batch_size = model.batch
+        self.pad_last_batch = layers.has_static_batch(model.output)
+        self.batches = None
+
+        if layers.batch_axis(self.model.input) == 3:
+            self.input_axes = (1, 2, 3, 0)
+        else:
+            self.input_axes = None
+
+    def run(self, checkpoint_paths):
+        """
+        Returns (checkpoint_path, accuracy) pairs sorted by decreasing
+        accuracy and leaves the best checkpoint loaded in the model.
+        """
+        if self.batches is None:
+            self._cache_batches()
+
+        results = []
+        iterator = BatchPrefetcher(
+            iter(checkpoint_paths),
+            func=lambda path: (path, read_checkpoint(path),
+                               read_ema_checkpoint(path)))
+        for checkpoint_path, checkpoint, ema_checkpoint in iterator:
+            set_checkpoint_values(self.model, checkpoint, ema_checkpoint)
+            results.append((checkpoint_path, self.evaluate()))
+
+        results.sort(key=lambda result: result[1], reverse=True)
+        if results:
+            load_checkpoint(self.model, results[0][0])
+        return results
+
+    def evaluate(self):
+        # Accuracy of the parameters currently in the model
+        predictions = []
+        for num_valid, x_batch in self.batches:
+            x_batch = numpy.asarray(x_batch, dtype=numpy.float32)
+            batch_pred = self.model.deterministic_prediction(x_batch)
+            predictions.append(numpy.argmax(batch_pred[0:num_valid], axis=1))
+        predictions = numpy.hstack(predictions)
+
+        accuracy = (100.0*numpy.sum(
+            predictions == self.data_container.y))/len(self.data_container.y)
+        return accuracy
+
+    def print_results(self, results):
+        print '%10s  %s' % ('accuracy', 'checkpoint')
+        for checkpoint_path, accuracy in results:
+            print '%10.2f  %s' % (accuracy, checkpoint_path)
+
+    def _cache_batches(self):
+        self.batches = []
+        iterator = BatchPrefetcher(PaddedBatchIterator(
+            self.data_container.X, self.batch_size, pad=self.pad_last_batch,
+            axes=self.input_axes))
+        for __, num_valid, x_batch in iterator:
+            x_batch = self.preprocessor.run(x_batch)
+            self.batches.append((num_valid, numpy.asarray(
+                x_batch, dtype=self.cache_dtype)))
+
+
+class EnsembleEvaluator(object):
+    """
+    Accuracy of the average of the model outputs (e.g. softmax
+    probabilities) over several checkpoints of one model.
+
+    The checkpoints are held as snapshots next to the parameters (on the
+    GPU when the model is), and every batch is predicted once per snapshot
+    after an on-device parameter swap, accumulating into one running buffer
+    of averaged outputs. The model's own parameters are restored afterwards.
+    """
+    def __init__(self, model, data_container, checkpoint_paths,
+                 preprocessor_module_list):
+        self.model = model
+        self.data_container = data_container
+        self.preprocessor = Preprocessor(preprocessor_module_list)
+        self.batch_size = model.batch
+        self.pad_last_batch = layers.has_static_batch(model.output)
+        self.snapshots = []
+        self.swap_funcs = []
+
+        if layers.batch_axis(self.model.input) == 3:
+            self.input_axes = (1, 2, 3, 0)
+        else:
+            self.input_axes = None
+
+        for checkpoint_path in checkpoint_paths:
+            self.add_snapshot(read_checkpoint(checkpoint_path))
+
+    def add_snapshot(self, checkpoint):
+        # Half-precision checkpoints are upcast to the parameters' dtype so
+        # that swapping in a snapshot is a plain copy
+        all_parameters = self.model.all_save_parameters_symbol
+        snapshot = [theano.shared(numpy.asarray(checkpoint_param,
+                                                dtype=model_param.dtype))
+                    for model_param, checkpoint_param
+                    in zip(all_parameters, checkpoint)]
+        self.snapshots.append(snapshot)
+        self.swap_funcs.append(layers.gen_copy_function(all_parameters,
+                                                        snapshot))
+
+    def run(self):
+        all_parameters = self.model.all_save_parameters_symbol
+        original = [theano.shared(param.get_value())
+                    for param in all_parameters]
+        restore_func = layers.gen_copy_function(all_parameters, original)
+
+        num_samples = self.data_container.X.shape[0]
+        predictions = numpy.zeros(num_samples, dtype=numpy.int64)
+        probabilities = None
+
+        iterator = BatchPrefetcher(PaddedBatchIterator(
+            self.data_container.X, self.batch_size, pad=self.pad_last_batch,
+            axes=self.input_axes))
+        try:
+            for start, num_valid, x_batch in iterator:
+                x_batch = self.preprocessor.run(x_batch)
+                for i, swap_func in enumerate(self.swap_funcs):
+                    swap_func()
+                    batch_pred = numpy.asarray(
+                        self.model.deterministic_prediction(x_batch))
+                    if (probabilities is None or
+                            probabilities.shape != batch_pred.shape):
+                        probabilities = numpy.zeros(batch_pred.shape,
+                                                    dtype=numpy.float32)
+                    # Running mean over the snapshots
+                    probabilities *= i / (i + 1.0)
+                    probabilities += batch_pred / (i + 1.0)
+                predictions[start:start + num_valid] = numpy.argmax(
+                    probabilities[0:num_valid], axis=1)
+        finally:
+            restore_func()
+
+        # Compute accuracy
+        accuracy = (100.0*numpy.sum(
+            predictions == self.data_container.y))/len(self.data_container.y)
+
+        return accuracy
+
+
+class ReconstructionScorer(object):
+    """
+    Streams a dataset through UnsupervisedModel.score and writes the
+    per-sample (or per-sample, per-channel) reconstruction errors to a
+    memory-mapped .npy file.
+    """
+    def __init__(self, model, preprocessor_module_list, per_channel=False):
+        self.model = model
+        self.preprocessor = Preprocessor(preprocessor_module_list)
+        self.per_channel = per_channel
+        self.batch_size = model.batch
+        self.pad_last_batch = layers.has_static_batch(model.output)
+
+        if layers.batch_axis(self.model.input) == 3:
+            self.input_axes = (1, 2, 3, 0)
+        else:
+            self.input_axes = None
+
+    def run(self, data_container, output_path):
+        X = data_container.X
+        num_samples = X.shape[0]
+        if self.per_channel:
+            shape = (num_samples, self.model.input.n_features)
+        else:
+            shape = (num_samples,)
+        scores = open_memmap(output_path, mode='w+', dtype=numpy.float32,
+                             shape=shape)
+
+        # Batches are read in a background thread while the model runs.
+        iterator = BatchPrefetcher(PaddedBatchIterator(
+            X, self.batch_size, pad=self.pad_last_batch,
+            axes=self.input_axes))
+        for batch_start, num_valid, x_batch in iterator:
+            x_batch = self.preprocessor.run(x_batch)
+            batch_scores = self.model.score(x_batch, self.per_channel)
+            scores[batch_start:batch_start + num_valid] = numpy.asarray(
+                batch_scores)[0:num_valid]
+
+        scores.flush()
+        return scores
+
+
 class Preprocessor(object):
     def __init__(self, module_list):
         self.module_list = module_list